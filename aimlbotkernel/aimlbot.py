@@ -9,8 +9,48 @@ An extension over pyAIML's Kernel class, to add some modifications:
  * define substitutions from iterables
  * improve date rendering by adding strftime() formatting, locale-dependent
  * set locale by defining the \c lang bot predicate
- * add a 'trace' command that processes input keeping the stack of evaluated
-   elements
+ * trace requests into a bounded buffer of structured events (inputs,
+   matches and element timings), sampled and filtered, exportable as JSONL,
+   and a 'trace' command that shows the events of a single input
+ * optionally use a compiled, non-recursive pattern matcher instead of
+   the pyAIML PatternMgr
+ * cache responses produced by deterministic templates
+ * compile templates into Python closures, instead of interpreting their
+   element lists each time they are used
+ * resolve <srai> elements with constant content to their target template
+   (with the compiled matcher), and memoize side-effect free <srai> results
+   within a request
+ * use brains saved by the compiled matcher in place, by mapping them
+   from the .bot file
+ * parse AIML files in parallel, in a pool of worker processes
+ * keep track of the source (notebook cell or file) of each category, and
+   apply only the differences when a source is learnt again
+ * compile rules in simplified text format directly into categories,
+   parsing as XML only the rules that contain markup
+ * parse AIML with an ElementTree-based ingestion engine (or, optionally,
+   the pyAIML SAX handler)
+ * respond to batches of inputs, reporting the category matched by each
+   one, and optionally processing independent sessions in worker processes
+ * keep sessions in a bounded store, spilling the least recently used or
+   idle ones to disk
+ * keep the conversation histories in fixed-size ring buffers
+ * apply substitutions with a trie-based engine, loaded in bulk
+ * normalize inputs in a single memoized stage, also available as an API
+ * profile category usage, template element timings and slow inputs
+ * share identical templates and template elements across categories, and
+   report the memory used by the brain
+ * import the modules needed only by some operations (zip files, worker
+   processes) when they are first used
+ * keep the categories parsed from AIML files in a content-addressed cache,
+   to skip parsing the files learnt again unchanged
+ * report the progress of learn & load operations to a callback (which
+   can abort them), and undo the categories learnt since a checkpoint
+ * write .bot files streaming each component into its zip member (stored,
+   deflated or LZMA-compressed), under a temporary name that is renamed
+   when complete, and read them back without extracting any file
+ * optionally save all the sessions (predicates and histories) in a session
+   table inside the .bot file, loaded lazily: each session is decoded the
+   first time it is used
 """
 
 from __future__ import absolute_import, division, print_function
@@ -24,22 +64,36 @@ import locale
 import datetime
 import time
 import unicodedata
-import zipfile
 import tempfile
+import struct
+import mmap
+import glob
+import shutil
 from functools import partial
-from itertools import count
-from xml.sax import parseString, SAXParseException
+from contextlib import contextmanager
+from collections import OrderedDict
+from itertools import count, repeat
+from xml.sax import SAXParseException
+import xml.sax
 try:
     import ConfigParser
 except ImportError:
     import configparser as ConfigParser
-
 from aiml.constants import VERSION as pyaiml_version
 from aiml import Kernel
-from aiml.AimlParser import AimlHandler
-from aiml.WordSub import WordSub
 
-from .utils import KrnlException
+from .utils import KrnlException, atomic_write
+from .matcher import CompiledPatternMgr, PyaimlPatternMgr, BRAIN_MAGIC
+from .respcache import ResponseCache, template_deps
+from .tplcompile import TemplateCompiler
+from .aimlparse import ENGINES, DEFAULT_ENGINE, parse_file, parse_string
+from .sessions import SessionStore, SessionTable, History
+from .wordsub import TrieWordSub
+from .normalize import Normalizer
+from .profiler import Profiler, clock
+from .tracing import Tracer
+from .tplpool import TemplatePool, deep_size, format_size
+from .learncache import LearnCache
 
 
 PY3 = sys.version_info[0] == 3
@@ -49,6 +103,102 @@ else:
     iteritems = lambda x : x.iteritems()
 
 
+# Placeholder for template data not computed yet
+_UNKNOWN = object()
+
+# The available pattern matchers, and the one used when none is requested
+MATCHERS = { 'pyaiml' : PyaimlPatternMgr,
+             'compiled' : CompiledPatternMgr }
+DEFAULT_MATCHER = 'pyaiml'
+
+
+
+def process_pool( workers, **kwargs ):
+    """
+    Create a pool of worker processes. The modules needed are imported
+    here, since most sessions never use one
+      @return (ProcessPoolExecutor): the pool, or None if not available
+    """
+    try:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+    except ImportError:
+        return None
+    # Start new processes instead of forking, since the Jupyter kernel has
+    # threads running
+    ctx = multiprocessing.get_context( 'spawn' )
+    return ProcessPoolExecutor( workers, mp_context=ctx, **kwargs )
+
+
+
+def zip_member_buffer( zipf, name ):
+    """
+    Return the contents of a zip file member as a buffer. If the member is
+    stored uncompressed, this is a memory map of its region in the zip file;
+    otherwise it is the decompressed data
+    """
+    import zipfile
+    info = zipf.getinfo( name )
+    if info.compress_type != zipfile.ZIP_STORED or not zipf.filename:
+        return zipf.read( name )
+    with open( zipf.filename, 'rb' ) as f:
+        # Skip the local file header (its extra field may differ from the
+        # one in the central directory)
+        f.seek( info.header_offset )
+        namelen, extralen = struct.unpack( '<26xHH', f.read(30) )
+        start = info.header_offset + 30 + namelen + extralen
+        mm = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+    return memoryview( mm )[start:start+info.file_size]
+
+
+def zip_compression( name ):
+    """
+    Return the zipfile compression method for a name: stored, deflate or
+    lzma
+    """
+    import zipfile
+    method = { 'stored' : zipfile.ZIP_STORED,
+               'deflate' : zipfile.ZIP_DEFLATED,
+               'lzma' : getattr(zipfile, 'ZIP_LZMA', None) }.get( name )
+    if method is None:
+        raise KrnlException( 'unsupported compression: {}', name )
+    return method
+
+
+@contextmanager
+def zip_member_writer( zipf, name ):
+    """
+    Open a zip file member for writing, as a file object
+    """
+    if sys.version_info >= (3, 6):
+        # (data is compressed & written as it comes)
+        with zipf.open( name, 'w' ) as f:
+            yield f
+    else:
+        # (older versions can only write a member at once)
+        f = io.BytesIO()
+        yield f
+        zipf.writestr( name, f.getvalue() )
+
+
+def parse_aiml( filename, encoding, engine=DEFAULT_ENGINE ):
+    """
+    Parse an AIML file (this is also the task run by worker processes when
+    learning in parallel)
+      @param filename (str): the file to parse
+      @param encoding (str): the text encoding for the parsed strings
+      @param engine (str): the XML ingestion engine (see aimlparse)
+      @return (tuple): a tuple (categories, parse time, error), where
+        categories is a dict (pattern, that, topic) -> template, and error is
+        an error message (in which case categories is None)
+    """
+    start = time.time()
+    try:
+        categories = parse_file( filename, encoding, engine )
+    except xml.sax.SAXParseException as msg:
+        err = "\nFATAL PARSE ERROR in file %s:\n%s\n" % (filename,msg)
+        return None, time.time() - start, err
+    return categories, time.time() - start, None
 
 
 
@@ -64,20 +214,34 @@ def normalize_string(input_str):
     #return u"".join( [c for c in nkfd_form if not unicodedata.combining(c)] )
 
 
+def read_config( parser, f, source ):
+    """
+    Read a configuration file object into a ConfigParser, with read_file()
+    (readfp() in Python 2, where there is no read_file())
+      @param source (str): the name of the file, for error messages
+    """
+    read = getattr( parser, 'read_file', None ) or parser.readfp
+    read( f, source )
+
 
-def split_rules( lines ):
+
+def split_rules( lines, numbered=False ):
     """
     Take a list of lines and group them by bunches separated with blank lines
+      @param numbered (bool): yield tuples (index of first line, rule)
+        instead of just rules
     """
     rule = []
-    for l in lines:
+    for n, l in enumerate(lines):
         if l:
+            if not rule:
+                start = n
             rule.append( l )
         elif rule:
-            yield rule
+            yield (start, rule) if numbered else rule
             rule = []
     if rule:
-        yield rule
+        yield (start, rule) if numbered else rule
 
 
 def srai_sub( repl, g ):
@@ -136,6 +300,167 @@ def build_aiml( lines, topic=None, re_clean=None, debug=False ):
     return aiml
 
 
+def parse_xml( xml, encoding, rows=None, engine=DEFAULT_ENGINE ):
+    """
+    Parse an XML buffer containing AIML categories
+      @param xml (str): the buffer
+      @param encoding (str): charset encoding to use for the buffer
+      @param rows (list): an optional list of tuples (row, offset), one per
+        buffer line, mapping it to its position in the original source (or
+        None for lines not in the source). It is used to report errors
+      @param engine (str): the XML ingestion engine (see aimlparse)
+      @return (dict): the parsed categories, (pattern, that, topic) -> template
+    """
+    try:
+        return parse_string( xml.encode(encoding), encoding, engine )
+    except SAXParseException as e:
+        # Find where the parser broke
+        lines = xml.split('\n')
+        row, col = e.getLineNumber(), e.getColumnNumber()
+        line = lines[row-1]
+        start = col-25 if col>25 else 0
+        errbuf = line[start:start+50]
+        below = '-' * (col-start) + '^'
+        if start > 0:
+            errbuf = u'...' + errbuf
+            below = '---' + below
+        if start+50 < len(line):
+            errbuf += u'...'
+        errbuf = errbuf + '\n' + below
+        if rows and rows[row-1]:
+            # Report the position in the source
+            row, offset = rows[row-1]
+            col = max( col - offset, 0 )
+        msg = u'{}: row={} col={}:\n{!s}', e.getMessage(), row, col, errbuf
+        raise KrnlException( *msg )
+
+
+# Rules in text format containing any of these need to go through XML parsing
+XML_CHARS = re.compile( u'[<&\r\x00-\x08\x0b\x0c\x0e-\x1f]|]]>' )
+
+
+def compile_text( lines, topic=None, re_clean=None, encoding='utf-8',
+                  engine=DEFAULT_ENGINE ):
+    """
+    Compile rules written with the simplified syntax accepted by build_aiml()
+    directly into categories. Rules with plain text templates are converted
+    as the AimlHandler would do; only rules containing XML markup are parsed
+    as XML, all together in a single buffer (unless a plain rule redefines
+    one of them, which forces parsing the rules before it).
+
+    Errors report their row and column in \c lines
+      @return (dict): the categories, (pattern, that, topic) -> template
+    """
+    categories = {}
+    tkey = u'*' if topic is None else topic.upper().strip()
+    xml_topic = topic is not None and ( XML_CHARS.search(topic) or
+                                        re.search(u'["\t\n]',topic) )
+    fsrai = partial( srai_sub, re_clean ) if re_clean else None
+    head = u'<?xml version="1.0" encoding="{}"?>\n<aiml version="1.0">{}'.format(
+        encoding, u'' if topic is None else u'<topic name="{}">'.format(topic.upper()) )
+    batch, rows = [ head ], [ None, None ]
+    # Keys of the rules in the XML buffer (None if some key is unknown)
+    pending = set()
+
+    def flush():
+        # Parse the XML buffer, and add the resulting categories
+        batch.append( u'{}</aiml>'.format(u'' if topic is None else u'</topic>') )
+        rows.append( None )
+        categories.update( parse_xml(u'\n'.join(batch), encoding, rows,
+                                     engine) )
+        del batch[1:], rows[2:]
+        pending.clear()
+
+    clean = re.compile( re_clean ).sub if re_clean else None
+    for n, rule in split_rules( lines, True ):
+        if len(rule)<2:
+            raise KrnlException( u'invalid rule:\n{}', u'\n'.join(rule) )
+        # Clean the pattern
+        pattern = clean( ' ', rule[0] ).upper() if clean else rule[0].upper()
+        # See if the 2nd line is a pattern-side that
+        that = None
+        if rule[1].startswith('<that>'):
+            that = rule[1][6:-7] if rule[1].endswith('</that>') else rule[1][6:]
+            that = that.upper()
+            if clean:
+                that = clean( ' ', that )
+            rule = rule[1:]
+        tpl = rule[1:]
+        text = u'\n'.join( tpl )
+        markup = ( xml_topic or XML_CHARS.search(pattern) or
+                   that is not None and XML_CHARS.search(that) )
+        if markup or XML_CHARS.search(text):
+            # Needs XML: add it to the buffer, one line per source line
+            if fsrai:
+                tpl = [ re.sub('(<srai>.+</srai>)', fsrai, l) for l in tpl ]
+            pending.add( None if markup else
+                         (pattern.strip(), u'*' if that is None else that.strip()) )
+            batch.append( u'<category><pattern>{}</pattern>'.format(pattern) )
+            rows.append( (n+1, 19) )
+            if that is not None:
+                batch.append( u'<that>{}</that>'.format(that) )
+                rows.append( (n+2, 6) )
+                n += 1
+            if not tpl:
+                tpl = [ u'' ]
+            tpl[0] = u'<template>' + tpl[0]
+            tpl[-1] += u'</template></category>'
+            batch += tpl
+            rows += [ (n+2, 10) ] + [ (n+i, 0) for i in range(3,len(tpl)+2) ]
+            continue
+        # Plain text: build the category directly
+        key = ( pattern.strip(), u'*' if that is None else that.strip(), tkey )
+        if pending and ( None in pending or key[:2] in pending ):
+            flush()
+        tem = [ 'template', {} ]
+        if text:
+            tem.append( [ 'text', {'xml:space':'default'}, text ] )
+        categories.pop( key, None )
+        categories[key] = tem
+    if len(batch) > 1:
+        flush()
+    return categories
+
+
+def _pack_keys( keys ):
+    """
+    Pack a collection of (pattern, that, topic) keys into a single string,
+    one key per line (normalized keys contain no tabs or newlines)
+    """
+    return u'\n'.join( u'\t'.join(k) for k in keys )
+
+
+def _unpack_keys( packed ):
+    """
+    Return the list of (pattern, that, topic) keys in a _pack_keys() string
+    """
+    return [ tuple(k.split(u'\t')) for k in packed.split(u'\n') ]
+
+
+# The bot used by a respond_many() worker process
+_batch_bot = None
+
+def _batch_init( filename, matcher ):
+    """
+    Initialize a respond_many() worker process, loading the bot
+    """
+    global _batch_bot
+    _batch_bot = AimlBot( matcher=matcher )
+    _batch_bot.verbose( False )
+    _batch_bot.load( filename )
+
+
+def _batch_session( sessionID, data, inputs ):
+    """
+    Respond to the inputs of a session in a respond_many() worker process
+      @param data (dict): the session data at the start
+      @return (tuple): the respond_many() rows, and the final session data
+    """
+    _batch_bot._sessions[sessionID] = data
+    rows = _batch_bot.respond_many( inputs, sessionID )
+    return rows, _batch_bot._sessions.pop( sessionID )
+
+
 # -------------------------------------------------------------------------
 
 class AimlBot( Kernel, object ):
@@ -148,11 +473,118 @@ class AimlBot( Kernel, object ):
       * define string substitutions
       * improve date processing, including making it responsible to the
         "lang" bot predicate (which should contain a locale)
+      * select the pattern matcher to use
+      * cache responses for templates that do not use random, time-dependent
+        or side-effecting elements
+      * shortcut <srai> redirections
+      * parse AIML files in parallel, with a faster XML parser
+      * track the source of each category, and re-learn sources incrementally
+      * respond to batches of inputs, in parallel across sessions
+      * bound the number of sessions kept in memory
+      * reuse the categories parsed from unchanged AIML files
+
+    Constructor keyword arguments:
+      - name (str): the bot name
+      - matcher (str): the pattern matcher, \c pyaiml or \c compiled
+        (default: DEFAULT_MATCHER, i.e. \c pyaiml)
+      - cache_size (int): size of the response cache (0 disables it)
+      - workers (int): number of processes used to parse AIML files
+      - parser (str): the XML ingestion engine, \c etree (default) or \c sax
+      - max_sessions (int): maximum number of sessions kept in memory
+      - session_ttl (float): idle seconds after which a session leaves memory
+      - session_file (str): the file for sessions evicted from memory
+      - session_store (object): a session store to use instead of the
+        default one (a mapping with the interface of SessionStore)
+      - history (int): the depth of the input & output histories
+      - learn_cache (str or bool): the directory of the cache of parsed
+        AIML files (True to use the default one, None to use no cache)
     """
 
     def __init__( self, *args, **kwargs ):
+        # Response cache. Must exist before the parent constructor runs,
+        # since it sets bot predicates
+        size = kwargs.get( 'cache_size', 1000 )
+        self._cache = ResponseCache( size ) if size else None
+        # Data for each template: id -> [template, predicates read, compiled,
+        # instrumented compiled] (the predicates read are classified, and the
+        # instrumented variant compiled, when first needed)
+        self._tplinfo = {}
+        # A stack of [predicates read, volatile] for responses being computed
+        self._recording = []
+        # Targets for constant <srai> inputs: (template, guards) or None
+        self._srai_targets = {}
+        # Input normalization (normal substitutions), memoized
+        self._normalizer = Normalizer( lambda : self._subbers['normal'] )
+        # Profiling counters, while profiling is on, and the last ones
+        self._profiler = self._profile = None
+        # Request tracer, while tracing is on, and the last one
+        self._tracer = self._trace = None
+        # The <srai> results memoized in the current request
+        self._memo = None
+        # When not None, the list where the category keys matched by the
+        # top-level sentences of a request are appended
+        self._matched = None
+        # <srai> hops avoided: [resolved, memoized] for the last request,
+        # and [requests, resolved, memoized] overall
+        self._srai_last = [0, 0]
+        self._srai_total = [0, 0, 0]
+        # Parallel learning: worker processes, and per-file timings
+        self._workers = kwargs.get( 'workers', 1 )
+        # XML ingestion engine
+        self._engine = kwargs.get( 'parser' ) or DEFAULT_ENGINE
+        if self._engine not in ENGINES:
+            raise KrnlException( 'unknown AIML parser: {}', self._engine )
+        # Cache of parsed AIML files
+        cache = kwargs.get( 'learn_cache' )
+        self._learn_cache = None if not cache else \
+            LearnCache( None if cache is True else cache )
+        self._learn_log = []
+        # The directory relative file names to learn are taken from (None
+        # for the current directory)
+        self._learn_dir = None
+        # A callback for the progress of learn & load operations
+        self._progress = None
+        # Category provenance: the brain tags each category with the id of
+        # its source (0 for none). Here we keep source -> (id, packed keys
+        # it defines), in the order the sources were last learnt, and key ->
+        # list of the (source id, template) definitions it overrides
+        self._sources = OrderedDict()
+        self._shadow = {}
+        self._nextsrc = 1
+        # The changes to the brain since the last checkpoint(), as a list of
+        # (key, previous template, previous source id), or None
+        self._journal = None
+        # The shared elements of the templates learnt
+        self._pool = TemplatePool()
+        # Depth of the input & output history buffers
+        self._maxHistorySize = max( 1, kwargs.get('history',
+                                                  Kernel._maxHistorySize) )
         # Start parent
         super( AimlBot, self ).__init__()
+        # Replace the session dict with a session store
+        self._session_opts = dict( (k, kwargs[k]) for k in
+                                   ('max_sessions', 'session_ttl', 'session_file')
+                                   if k in kwargs )
+        self._session_opts['history'] = self._maxHistorySize
+        store = kwargs.get( 'session_store' )
+        if store is None:
+            store = SessionStore( kwargs.get('max_sessions',0),
+                                  kwargs.get('session_ttl',0),
+                                  kwargs.get('session_file') )
+        for sid, data in list( self._sessions.items() ):
+            store[sid] = data
+        self._sessions = store
+        self._compiler = TemplateCompiler( self )
+        # Use the trie-based substitution engine for the default subs
+        self._subbers = dict( (name, TrieWordSub.from_subber(sub))
+                              for name, sub in iteritems(self._subbers) )
+        # Replace the pattern matcher, if requested
+        self._matcher = kwargs.get( 'matcher' ) or DEFAULT_MATCHER
+        if self._matcher not in MATCHERS:
+            raise KrnlException( 'unknown pattern matcher: {}', self._matcher )
+        if not isinstance( self._brain, MATCHERS[self._matcher] ):
+            self._brain = MATCHERS[self._matcher]()
+            self._brain.setBotName( self.getBotPredicate('name') )
         # Charset encoding we will always deliver to the AIML kernel
         self._enc = 'utf-8'
         self.setTextEncoding( self._enc )
@@ -164,11 +596,9 @@ class AimlBot( Kernel, object ):
         self._patclean = re.compile("[" + re.escape(punctuation) + "]")
         # A place to optionally store the parsed AIML cells
         self._aiml = None
-        # This is for the trace command
-        self._traceStack = None
 
 
-    def learn_buffer( self, lines, fmt='aiml', opts={} ):
+    def learn_buffer( self, lines, fmt='aiml', opts={}, source=None ):
         """
         Learn the AIML stored in a buffer
          @param lines (list): a list of text lines
@@ -176,8 +606,10 @@ class AimlBot( Kernel, object ):
          @param opts (dict): options for text format:
              - topic (str): an optional \c <topic> wrapper
              - clean_pattern (bool): clean pattern & <srai> fields
+         @param source (str): an identifier for the buffer (e.g. a cell id).
+           If the same source is learnt again, its categories are replaced
+         @return (tuple): number of categories added, replaced and removed
         """
-        # Prepare the buffer
         if fmt == 'aiml':
             # Native XML. Join lines, remove the preamble & <aiml> element
             buf = re.sub( r'''^ \s* (?:<\?xml[^>]+>)?
@@ -185,114 +617,675 @@ class AimlBot( Kernel, object ):
                                 (.+)
                                 </aiml>\s*$''',
                           r'\1', u'\n'.join(lines), flags=re.X|re.I|re.S )
+            # Add the <aiml> XML wrapping & parse it
+            xml = u'<?xml version="1.0" encoding="{}"?>\n<aiml version="1.0">\n{}\n</aiml>'.format(self._enc, buf)
+            categories = parse_xml( xml, self._enc, engine=self._engine )
         else:
-            # Simplified text: process it
+            # Simplified text: compile it
             clean = self._patclean if opts.get('clean_pattern') else None
-            buf = build_aiml( lines, opts.get('topic'), clean )
-
-        # Create a handler
-        handler = AimlHandler( self._enc )
-        handler.setEncoding( self._textEncoding )
-
-        # Parse the XML buffer with that handler
-        try: 
-            # Add the <aiml> XML wrapping & do charset encoding
-            xml = u'<?xml version="1.0" encoding="{}"?>\n<aiml version="1.0">\n{}\n</aiml>'.format(self._enc, buf).encode(self._enc)
-            parseString(xml,handler)
-        except SAXParseException as e:
-            # Find where the parser broke
-            lines = xml.decode(self._enc).split('\n')
-            #print( '\n'.join(lines) )
-            row, col = e.getLineNumber(), e.getColumnNumber()
-            start = col-25 if col>25 else 0
-            errbuf = lines[row-1][start:start+50]
-            below = '-' * (col-start) + '^'
-            if start > 0:
-                errbuf = u'...' + errbuf
-                below = '---' + below
-            if start+50 < len(lines[row-1]):
-                errbuf += u'...'
-            errbuf = errbuf + '\n' + below
-            #LOG.warn( u'%s :\n%s', e,  errbuf )
-            msg = u'{}: row={} col={}:\n{!s}', e.getMessage(), row, col, errbuf
-            raise KrnlException( *msg )
+            categories = compile_text( lines, opts.get('topic'), clean,
+                                       self._enc, self._engine )
+            # The AIML version is only needed for recording
+            if self._aiml is not None:
+                buf = build_aiml( lines, opts.get('topic'), clean )
 
         # Store the pattern/template pairs in the PatternMgr
-        for key,tem in iteritems(handler.categories):
-            self._brain.add(key,tem)
+        changes = self._add_categories( categories, source )
         #self._brain.dump()
         # Add the processed AIML to the aiml buffer
         if self._aiml is not None:
             self._aiml.append( buf )
+        return changes
+
+
+    def learn( self, filename ):
+        """
+        Load and learn the contents of the specified AIML file (or files,
+        if the name contains wildcards). Same as the parent method, but
+        routing the parsed categories through _add_categories() (with the
+        file path as source), taking the parsed files from the learn cache
+        when possible and optionally parsing the rest in a pool of worker
+        processes. Categories are always added in file order, so that a
+        category in a file overrides the same one in a previous file.
+        Relative names are taken from the learn directory, if set
+        """
+        if self._learn_dir is not None:
+            filename = os.path.join( self._learn_dir, filename )
+        files = glob.glob( filename )
+        cache = self._learn_cache
+        keys = [ cache.key(f, self._textEncoding, self._engine)
+                 if cache is not None else None for f in files ]
+        cached = [ cache is not None and k in cache for k in keys ]
+        missing = [ f for f, c in zip(files, cached) if not c ]
+        workers = min( self._workers, len(missing) )
+        pool = process_pool( workers ) if workers > 1 else None
+        if pool is None:
+            parsed = ( parse_aiml(f, self._textEncoding, self._engine)
+                       for f in missing )
+            self._merge_files( files, self._cached(files, keys, cached, parsed) )
+            return
+        with pool:
+            parsed = pool.map( parse_aiml, missing, repeat(self._textEncoding),
+                               repeat(self._engine) )
+            self._merge_files( files, self._cached(files, keys, cached, parsed) )
+
+
+    def _cached( self, files, keys, cached, parsed ):
+        """
+        Generate the parse_aiml() results for a list of files, reading them
+        from the learn cache if they are there, and otherwise taking them
+        from an iterator over the results for the files not in the cache
+        (and storing them in the cache)
+          @param keys (list): the cache key for each file
+          @param cached (list): whether each file is in the cache
+        """
+        cache = self._learn_cache
+        for f, key, hit in zip( files, keys, cached ):
+            if not hit:
+                result = next( parsed )
+                if cache is not None and result[0] is not None:
+                    cache.put( key, result[0] )
+                yield result
+                continue
+            start = time.time()
+            categories = cache.get( key )
+            if categories is None:
+                # (the entry went away or is damaged)
+                result = parse_aiml( f, self._textEncoding, self._engine )
+                if result[0] is not None:
+                    cache.put( key, result[0] )
+                yield result
+            else:
+                yield categories, time.time() - start, None
+
+
+    def _merge_files( self, files, results ):
+        """
+        Add the categories parsed from a list of files, recording the time
+        spent on each file
+          @param files (list): the file names
+          @param results (iterable): the parse_aiml() results for each file
+        """
+        for f, (categories, elapsed, err) in zip( files, results ):
+            if err:
+                sys.stderr.write( err )
+                continue
+            start = time.time()
+            self._add_categories( categories, os.path.abspath(f) )
+            merge = time.time() - start
+            self._learn_log.append( (f, len(categories), elapsed, merge) )
+            if self._verboseMode:
+                print( "Loading %s...done (%.2f seconds)" % (f,elapsed+merge) )
+            self._report( 'file', f, len(categories) )
+
+
+    def set_workers( self, num ):
+        """
+        Set the number of worker processes used to parse AIML files (1 means
+        parse them in this process). Return the previous value
+        """
+        prev, self._workers = self._workers, max( 1, num )
+        return prev
+
+
+    def set_parser( self, engine ):
+        """
+        Set the XML ingestion engine used to parse AIML (\c etree or \c sax).
+        Return the previous one
+        """
+        if engine not in ENGINES:
+            raise KrnlException( 'unknown AIML parser: {}', engine )
+        prev, self._engine = self._engine, engine
+        return prev
+
+
+    def set_learn_dir( self, directory ):
+        """
+        Set the directory relative file names are learnt from, both by
+        learn() and by <learn> elements (None for the current directory).
+        This avoids changing the current directory of the process, which is
+        shared by all its threads. Return the previous one
+        """
+        prev = self._learn_dir
+        self._learn_dir = None if directory is None else os.path.abspath( directory )
+        return prev
+
+
+    def set_progress( self, callback ):
+        """
+        Set a function to be called as learn & load operations progress,
+        with an event name and its arguments:
+          - file (filename, categories): a file has been learnt
+          - sessions (sessions): a session table has been opened
+          - brain (filename): a brain file is about to be read
+          - read (categories): the brain file has been read (it will now
+            replace the current brain)
+        An exception raised by the callback aborts the operation (see
+        checkpoint() to undo the files already learnt). Return the
+        previous callback
+        """
+        prev, self._progress = self._progress, callback
+        return prev
+
+
+    def _report( self, event, *args ):
+        if self._progress is not None:
+            self._progress( event, *args )
+
+
+    def learn_log( self, clear=False ):
+        """
+        Return the files learnt, as a list of (filename, number of categories,
+        parse time, merge time) tuples
+          @param clear (bool): empty the log after returning it
+        """
+        log = self._learn_log
+        if clear:
+            self._learn_log = []
+        return log
+
+
+    def _add_categories( self, categories, source=None ):
+        """
+        Store a dict of (pattern, that, topic) -> template in the brain,
+        compiling each template.
+
+        If a source is given and it was learnt before, only the differences
+        with its previous contents are applied: categories no longer there
+        are removed (or, if they were overriding another definition, that
+        definition is restored), and categories not changed since then are
+        skipped (unless another source has overridden them meanwhile).
+        Overridden definitions, including those with no source (e.g. from
+        a loaded brain), are kept aside until they are restored or their
+        source drops them.
+          @return (tuple): number of categories added, replaced and removed
+        """
+        added = replaced = removed = 0
+        shadow = self._shadow
+        # Normalize keys, so that they can be compared across sources, and
+        # share templates & template elements with those already learnt
+        keys = list( categories )
+        tems = self._pool.share_many( [ categories[k] for k in keys ] )
+        new = dict( (tuple(u' '.join(k.split()) for k in key), tem)
+                    for key, tem in zip(keys, tems) )
+        sid, old = 0, None
+        if source is not None:
+            sid, old = self._sources.pop( source, (None, None) )
+            if sid is None:
+                sid, self._nextsrc = self._nextsrc, self._nextsrc + 1
+            if new:
+                self._sources[source] = sid, _pack_keys( new )
+
+        if old is not None:
+            # Forget the overridden definitions of this source; it either
+            # dropped them, or it is about to override the current ones
+            for key in [ k for k, d in iteritems(shadow)
+                         if any(s == sid for s, _ in d) ]:
+                defs = [ d for d in shadow[key] if d[0] != sid ]
+                if defs:
+                    shadow[key] = defs
+                else:
+                    del shadow[key]
+            # Remove the categories it no longer has, restoring the
+            # definitions they were overriding
+            for key in _unpack_keys( old ):
+                if key in new or self._brain.get( key )[1] != sid:
+                    continue
+                removed += 1
+                tem = self._change( key, None )[0]
+                self._tplinfo.pop( id(tem), None )
+                defs = shadow.get( key )
+                if defs:
+                    src, tem = defs.pop()
+                    if not defs:
+                        del shadow[key]
+                    self._change( key, tem, src )
+
+        for key, tem in iteritems(new):
+            prev, cur = self._change( key, tem, sid )
+            if prev is None:
+                added += 1
+            elif cur != sid:
+                # Keep the definition overridden, in case this source drops
+                # the category later
+                shadow.setdefault( key, [] ).append( (cur, prev) )
+                replaced += 1
+            elif old is None or prev != tem:
+                replaced += 1
+            elif prev is not tem:
+                # Unchanged: keep the template already there
+                self._change( key, prev, sid )
+                continue
+            else:
+                continue
+            self._template_info( tem )
+        if added or replaced or removed:
+            self._invalidate()
+        return added, replaced, removed
+
+
+    def _change( self, key, template, source=0 ):
+        """
+        Set (or remove, if None) the template & source id for a category
+        key in the brain, recording the change if there is a checkpoint.
+        Return the previous template & source id, or (None, 0)
+        """
+        if template is None:
+            prev = self._brain.get( key )
+            self._brain.remove( key )
+        else:
+            prev = self._brain.add( key, template, source )
+        if self._journal is not None:
+            self._journal.append( (key,) + tuple(prev) )
+        return prev
+
+
+    def sources( self ):
+        """
+        Return the sources of the categories in the brain, as a list of
+        tuples (source, list of (pattern, that, topic) keys). Categories
+        overridden by a later source are not included in a source
+        """
+        get = self._brain.get
+        return [ (src, [ k for k in _unpack_keys(keys) if get(k)[1] == sid ])
+                 for src, (sid, keys) in iteritems(self._sources) ]
+
+
+    def checkpoint( self ):
+        """
+        Record the state of the brain, so that the categories learnt from
+        now on can be undone by rollback(). The state is valid until the
+        next checkpoint() or release()
+        """
+        self._journal = []
+        return ( OrderedDict(self._sources),
+                 dict( (k, list(d)) for k, d in iteritems(self._shadow) ),
+                 self._nextsrc, dict(self._tplinfo), self._pool.checkpoint() )
+
+
+    def release( self, state ):
+        """
+        Stop recording the changes to the brain for a checkpoint
+        """
+        self._journal = None
+
+
+    def rollback( self, state ):
+        """
+        Undo the categories learnt since a checkpoint: those added are
+        removed, and those replaced or removed are restored. Only valid
+        while the brain has not been replaced (e.g. by loadBrain())
+        """
+        (self._sources, self._shadow, self._nextsrc, self._tplinfo,
+         pool) = state
+        journal, self._journal = self._journal or [], None
+        for key, prev, source in reversed( journal ):
+            if prev is None:
+                self._brain.remove( key )
+            else:
+                self._brain.add( key, prev, source )
+        self._pool.rollback( pool )
+        # A request aborted halfway (e.g. in a <learn> element) leaves its
+        # input stack behind
+        self.setPredicate( self._inputStack, [], self._globalSessionID )
+        self._invalidate()
+
+
+    def _template_info( self, elem ):
+        """
+        Return the data for a template: a list [template, predicates read,
+        compiled function, instrumented compiled function]. The predicates
+        read are _UNKNOWN until _template_deps() is called for the template,
+        and the instrumented function is None until the template is used
+        while profiling or tracing. Data is computed when first requested
+        """
+        info = self._tplinfo.get( id(elem) )
+        if info is None or info[0] is not elem:
+            info = self._tplinfo[id(elem)] = [ elem, _UNKNOWN,
+                                               self._compiler.compile(elem),
+                                               None ]
+        return info
+
+
+    def _template_deps( self, info ):
+        """
+        Return the predicates read by a template (None if it is not
+        cacheable), classifying it the first time. Only needed when its
+        output goes into a response that may be cached
+          @param info (list): the template data, from _template_info()
+        """
+        deps = info[1]
+        if deps is _UNKNOWN:
+            deps = info[1] = template_deps( info[0] )
+        return deps
+
+
+    def _invalidate( self ):
+        """
+        Invalidate all data derived from the brain contents, the bot
+        predicates or the substitutions
+        """
+        if self._cache is not None:
+            self._cache.clear()
+        self._srai_targets = {}
+        self._normalizer.clear()
+
+
+    def loadBrain( self, filename ):
+        """
+        Load a brain file, dropping all data derived from the previous one
+        """
+        self._use_brain( self._read_brain(filename) )
+
+
+    def _read_brain( self, filename, f=None ):
+        """
+        Read a brain file into a new pattern matcher, leaving the current
+        brain untouched
+          @param f (file): a file object to read the brain from, instead of
+            opening the file (e.g. a zip file member)
+        """
+        if self._verboseMode: print( "Loading brain from %s..." % filename, end="" )
+        start = time.time()
+        brain = MATCHERS[self._matcher]()
+        if f is None:
+            brain.restore( filename )
+        else:
+            brain.read( f )
+        if self._verboseMode:
+            print( "done (%d categories in %.2f seconds)" %
+                   (brain.numTemplates(), time.time() - start) )
+        return brain
+
+
+    def saveBrain( self, filename ):
+        """
+        Save the brain to a file, written under a temporary name and then
+        renamed (so that a mapped copy of a previous version remains valid)
+        """
+        with atomic_write( filename ) as f:
+            self._write_brain( f, filename )
+
+
+    def _write_brain( self, f, filename ):
+        """
+        Write the brain to a file object
+        """
+        if self._verboseMode: print( "Saving brain to %s..." % filename, end="" )
+        start = time.time()
+        self._brain.write( f )
+        if self._verboseMode:
+            print( "done (%.2f seconds)" % (time.time() - start) )
+
+
+    def _use_brain( self, brain ):
+        """
+        Replace the brain, dropping all data derived from the previous one
+        """
+        self._tplinfo = {}
+        self._sources, self._shadow = OrderedDict(), {}
+        self._journal = None
+        self._pool.clear()
+        self._brain = brain
+        self._invalidate()
+
+
+    def resetBrain( self, matcher=None ):
+        """
+        Reset the brain to its initial state, keeping the pattern matcher
+        (unless another one is given), the response cache size, the number
+        of workers, the XML parser, the learn cache and the session store
+        limits
+        """
+        if matcher is not None and matcher not in MATCHERS:
+            raise KrnlException( 'unknown pattern matcher: {}', matcher )
+        del self._brain
+        close = getattr( self._sessions, 'close', None )
+        if close:
+            close()
+        cache = self._learn_cache
+        self.__init__( matcher=matcher or self._matcher,
+                       cache_size=self._cache.size if self._cache is not None else 0,
+                       workers=self._workers, parser=self._engine,
+                       **self._session_opts )
+        self._learn_cache = cache
+
+
+    def cache_stats( self ):
+        """
+        Return the response cache statistics, as a list of (name, value)
+        tuples
+        """
+        if self._cache is None:
+            return [ ('status', 'disabled') ]
+        return self._cache.stats()
+
+
+    def learn_cache_stats( self ):
+        """
+        Return the learn cache statistics, as a list of (name, value)
+        tuples
+        """
+        if self._learn_cache is None:
+            return [ ('status', 'disabled') ]
+        return self._learn_cache.stats()
+
+
+    def clear_learn_cache( self ):
+        """
+        Remove all the entries in the learn cache
+          @return (int): the number of entries removed
+        """
+        return self._learn_cache.clear() if self._learn_cache else 0
+
+
+    def _addSession( self, sessionID ):
+        """
+        Override the parent method to create the histories as ring buffers
+        """
+        if sessionID in self._sessions:
+            return
+        depth = self._maxHistorySize
+        self._sessions[sessionID] = {
+            self._inputHistory: History( depth ),
+            self._outputHistory: History( depth ),
+            self._inputStack: []
+        }
+
+
+    def set_history( self, depth ):
+        """
+        Set the depth of the input & output histories, resizing those of
+        the existing sessions. Return the previous depth
+        """
+        prev, self._maxHistorySize = self._maxHistorySize, max( 1, depth )
+        self._session_opts['history'] = self._maxHistorySize
+        if self._maxHistorySize != prev:
+            for sid in list( self._sessions.keys() ):
+                data = self._sessions[sid]
+                for name in (self._inputHistory, self._outputHistory):
+                    data[name] = History( self._maxHistorySize,
+                                          data.get(name,()) )
+        return prev
+
+
+    def session_stats( self ):
+        """
+        Return the session store statistics (sessions resident in memory
+        and spilled to disk), as a list of (name, value) tuples
+        """
+        stats = getattr( self._sessions, 'stats', None )
+        return stats() if stats else [ ('resident', len(self._sessions)) ]
+
+
+    def memory_stats( self ):
+        """
+        Return the size of the brain and the (approximate) memory used by
+        its parts, as a list of (name, value) tuples: the pattern matcher
+        index and templates, the template pool and the compiled templates
+        """
+        stats = [ ('matcher', self._matcher),
+                  ('categories', self._brain.numTemplates()) ]
+        brain = getattr( self._brain, 'memory_stats', None )
+        if brain:
+            stats += brain()
+        stats += self._pool.stats()
+        stats.append( ('compiled templates', len(self._tplinfo)) )
+        # (the overridden templates are mostly shared with the brain)
+        size = deep_size( [self._sources] ) + \
+               sum( sys.getsizeof(d) for d in self._shadow.values() )
+        stats.append( ('category sources', '{} ({})'.format(
+            len(self._sources), format_size(size))) )
+        return stats
+
+
+    def set_profiling( self, on ):
+        """
+        Start or stop profiling. Counters are kept when profiling stops,
+        and profiling resumes with them. Return the previous state
+        """
+        prev = self._profiler is not None
+        if bool(on) != prev:
+            if on and self._profile is None:
+                self._profile = Profiler()
+            self._profiler = self._profile if on else None
+        return prev
+
+
+    def reset_profile( self ):
+        """
+        Discard the profiling counters
+        """
+        self._profile = Profiler()
+        if self._profiler is not None:
+            self._profiler = self._profile
+
+
+    def profile_stats( self, top=10 ):
+        """
+        Return the profiling results, as a tuple with
+         * a summary: a list of (name, value) tuples
+         * the most used categories: a list of (uses, key) tuples, where key
+           is the [pattern/that/topic] tuple
+         * the element timings: a list of (element name, evaluations,
+           total seconds, max seconds) tuples, by decreasing total time
+         * the slowest inputs: a list of (seconds, input, session) tuples
+          @param top (int): number of categories & inputs to return
+        """
+        prof = self._profile or Profiler()
+        categories = prof.top_categories( top )
+        summary = [ ('status', 'on' if self._profiler is not None else 'off'),
+                    ('requests', prof.requests),
+                    ('time', '{:.3f}s'.format(prof.elapsed)),
+                    ('categories used', len(prof.hits)),
+                    ('unmatched inputs', prof.nomatch) ]
+        inputs = [ (e, self._cod.dec(i) if isinstance(i,bytes) else i, s)
+                   for e, i, s in prof.top_inputs()[:top] ]
+        return summary, categories, prof.top_elements(), inputs
+
+
+    def srai_stats( self ):
+        """
+        Return the number of <srai> hops avoided (by resolving them in
+        advance or by reusing a previous result in the same request), as a
+        list of (name, value) tuples. Resolving in advance needs a pattern
+        matcher that supports it (the compiled one)
+        """
+        requests, resolved, memoized = self._srai_total
+        avg = (resolved + memoized)/requests if requests else 0
+        targets = sum( 1 for t in self._srai_targets.values() if t )
+        static = 'on' if hasattr( self._brain, 'resolve' ) else \
+                 'off ({} matcher)'.format( self._matcher )
+        return [ ('static resolution', static),
+                 ('resolved targets', targets),
+                 ('last request: resolved', self._srai_last[0]),
+                 ('last request: memoized', self._srai_last[1]),
+                 ('requests', requests),
+                 ('total resolved', resolved),
+                 ('total memoized', memoized),
+                 ('avoided per request', '{:.2f}'.format(avg)) ]
 
 
     def predicates( self, bot=False, session=None ):
         """
         Return session predicates (False) or bot predicates (True), as an
-        iterator over (key, value) tuples
+        iterator over (key, value) tuples, in no particular order
         """
         if bot:
             return iteritems(self._botPredicates)
         if session is None:
-            session = '_global'
-        sdata = self.getSessionData()
-        return ( (k,sdata[session][k]) 
-                 for k in sorted(sdata[session].keys())
-                 if not k[0].startswith('_') )
+            session = self._globalSessionID
+        sdata = self._sessions.get( session ) or {}
+        return ( (k,v) for k, v in iteritems(sdata) if not k.startswith('_') )
 
 
     def addSub( self, name, items, reset=False ):
         ''' 
-        Add a new WordSub instance
+        Add a new WordSub instance. Subs are loaded in bulk into a
+        TrieWordSub, which is rebuilt once for the whole set
           @param name (str): Wordsub name
           @param items (iterable of tuples): subs to add
           @param reset (bool): delete all current subs in this WordSub
           @return (int): number of subs added
         '''
+        # Substitutions change the normalized input and some template output
+        self._invalidate()
         # Just define default (English) subbers
         if name == 'default':
             import aiml.DefaultSubs as DefaultSubs
             self._subbers = {}
-            self._subbers['gender'] = WordSub(DefaultSubs.defaultGender)
-            self._subbers['person'] = WordSub(DefaultSubs.defaultPerson)
-            self._subbers['person2'] = WordSub(DefaultSubs.defaultPerson2)
-            self._subbers['normal'] = WordSub(DefaultSubs.defaultNormal)
+            self._subbers['gender'] = TrieWordSub(DefaultSubs.defaultGender)
+            self._subbers['person'] = TrieWordSub(DefaultSubs.defaultPerson)
+            self._subbers['person2'] = TrieWordSub(DefaultSubs.defaultPerson2)
+            self._subbers['normal'] = TrieWordSub(DefaultSubs.defaultNormal)
             return 'default subs defined'
 
         # Reset current dictionary, if requested
         if reset and name in self._subbers:
             del self._subbers[name]
-        # and ensure it exists
-        if name not in self._subbers:
-            self._subbers[name] = WordSub()
+        # and ensure it exists (an empty subber is valid)
+        if not isinstance( self._subbers.get(name), TrieWordSub ):
+            self._subbers[name] = TrieWordSub.from_subber( self._subbers.get(name,{}) )
         # Add all subs
-        n = -1
-        for n, kv in enumerate(items):
-            #print("Sub", n+1, kv)
-            self._subbers[name][kv[0]] = kv[1]
-        # We need at least one, or substitution will crash
-        if n == -1:
-            self._subbers[name]['DUMMYSUB'] = 'DUMMYSUB'
-        return n+1
+        return self._subbers[name].load( items )
+
+
+    def loadSubs( self, filename ):
+        """
+        Override the parent method to load each section of a substitutions
+        file in bulk, through addSub()
+        """
+        parser = ConfigParser.ConfigParser()
+        with open( filename ) as f:
+            read_config( parser, f, filename )
+        for name in parser.sections():
+            self.addSub( name, parser.items(name), reset=True )
 
 
-    def save( self, filename, options=[] ):
+    def save( self, filename, options=[], compression='stored' ):
         """
         Save the complete bot state (patterns, session predicates, bot
         predicates, subs) to disk. Any of those data elements can be skipped.
 
           @param filename (str): name of file to save to (appropriate suffixes 
             will be added)
-          @param options (list): options to select what gets saved
+          @param options (list): options to select what gets saved: \c no*
+            options skip a component, \c allsessions saves all the sessions
+            (not only the predicates of the global session)
+          @param compression (str): compression for the .bot file: \c stored,
+            \c deflate or \c lzma (a stored brain can be mapped when loaded)
+          @return (str): a summary of the data saved
 
         We will use a .ini config file + a serialized brain file. The first
         one references the second. Both will be packed into a .bot file.
         """
         options = set( (v[:5] for v in options) )
+        start = time.time()
         cfg = ConfigParser.SafeConfigParser()
         cfg.add_section( 'general' )
         cfg.set( 'general', 'date', 
                  datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S%z') )
+        cfg.set( 'general', 'history.depth', str(self._maxHistorySize) )
         if filename.endswith('.ini') or filename.endswith('.bot'):
             filename = filename[:-4]
         # Python 3 encodes when writing, but in Python 2 we must supply
@@ -310,6 +1303,14 @@ class AimlBot( Kernel, object ):
                 cfg.set('session',*map(encode,kv) )
             if self._verboseMode: print(num+1,'predicates')
 
+        # All the sessions, as a session table
+        sesname = None
+        if 'allse' in options and 'noses' not in options:
+            if not hasattr( self._sessions, 'dump' ):
+                raise KrnlException( 'the session store cannot save all sessions' )
+            sesname = filename + '.sessions'
+            cfg.set( 'general', 'sessions.filename', os.path.basename(sesname) )
+
         # Bot predicates
         cfg.add_section( 'bot' )
         if 'nobot' in options:
@@ -341,41 +1342,105 @@ class AimlBot( Kernel, object ):
                     subs.append( name )
             cfg.set( 'general', 'subs', ','.join(subs) )
 
-        # Save brain patterns
+        # Brain patterns
         if 'nobra' in options:
             if self._verboseMode: print('Skipping brain patterns')
             brainname = None
         else:
             brainname = filename + '.brain'
-            self.saveBrain( brainname )
             cfg.set( 'general', 'brain.filename', os.path.basename(brainname) )
-        
-        # Save main file
+            cfg.set( 'general', 'brain.matcher', self._matcher )
+
+        # Main file
         ininame = filename + '.ini'
-        if self._verboseMode: print( 'Writing main bot file:', ininame )
-        if PY3:
-            with io.open( ininame, 'wt', encoding='utf-8') as f:
-                cfg.write( f )
-        else:
-            with open( ininame, 'wt' ) as f:
-                cfg.write( f )
-
-        # Zip the two files into a .bot file
-        if 'rawfi' not in options:
-            zipname = filename + '.bot'
-            if self._verboseMode: print( 'Packing into:', zipname )
-            zf = zipfile.ZipFile( zipname, 'w' )
-            zf.write( ininame, os.path.basename(ininame) )
-            os.unlink( ininame )
+        buf = io.StringIO() if PY3 else io.BytesIO()
+        cfg.write( buf )
+        ini = buf.getvalue().encode('utf-8') if PY3 else buf.getvalue()
+
+        # As separate files, each one written under a temporary name
+        if 'rawfi' in options:
             if brainname:
-                zf.write( brainname, os.path.basename(brainname) )
-                os.unlink( brainname )
+                self.saveBrain( brainname )
+            if sesname:
+                with atomic_write( sesname ) as f:
+                    self._write_sessions( f )
+            if self._verboseMode: print( 'Writing main bot file:', ininame )
+            with atomic_write( ininame ) as f:
+                f.write( ini )
+            size = sum( os.path.getsize(n)
+                        for n in (ininame, brainname, sesname) if n )
+            return u'Saved bot state to "{}": {:,} bytes ({:.2f}s)'.format(
+                ininame, size, time.time() - start )
+
+        # Packed into a .bot file, writing each component straight into its
+        # zip member. The file is written under a temporary name, so that
+        # if its previous version is mapped it stays valid
+        import zipfile
+        zipname = filename + '.bot'
+        if self._verboseMode: print( 'Packing into:', zipname )
+        with atomic_write( zipname ) as f:
+            with zipfile.ZipFile( f, 'w', zip_compression(compression) ) as zf:
+                zf.writestr( os.path.basename(ininame), ini )
+                if brainname:
+                    with zip_member_writer( zf, os.path.basename(brainname) ) as bf:
+                        self._write_brain( bf, brainname )
+                if sesname:
+                    with zip_member_writer( zf, os.path.basename(sesname) ) as sf:
+                        self._write_sessions( sf )
+                raw = sum( i.file_size for i in zf.infolist() )
+        return u'Saved bot state to "{}": {:,} bytes ({:,} uncompressed, {}) ({:.2f}s)'.format(
+            zipname, os.path.getsize(zipname), raw, compression,
+            time.time() - start )
+
+
+    def _write_sessions( self, f ):
+        """
+        Write all the sessions to a file object, as a session table
+        """
+        if self._verboseMode: print( 'Saving all sessions... ', end='' )
+        num = self._sessions.dump( f )
+        if self._verboseMode: print( num, 'sessions' )
+        return num
+
+
+    def _load_sessions( self, cfg, zipf, cfgdir ):
+        """
+        Open the session table of a saved bot state. The table is used from
+        a memory map of the file (or of the zip member, if stored); its
+        sessions are decoded later, when used
+          @return (SessionTable): the table, or None if there is none
+        """
+        if not cfg.has_option( 'general', 'sessions.filename' ):
+            return None
+        if not hasattr( self._sessions, 'load_table' ):
+            raise KrnlException( 'the session store cannot load all sessions' )
+        sesfile = cfg.get( 'general', 'sessions.filename' )
+        if zipf:
+            if sesfile not in zipf.namelist():
+                raise KrnlException( 'session file "{}" not found in zip',
+                                     sesfile )
+            buf = zip_member_buffer( zipf, sesfile )
+        else:
+            if not os.path.exists( sesfile ):
+                sesfile = os.path.join( cfgdir, sesfile )
+            with io.open( sesfile, 'rb' ) as f:
+                buf = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+        try:
+            table = SessionTable( buf )
+        except (ValueError, EOFError, TypeError) as e:
+            raise KrnlException( 'invalid session file "{}": {}', sesfile, e )
+        self._report( 'sessions', len(table) )
+        return table
 
 
     def _load_vars( self, cfg, options ):
         """
         Load all data from the .ini file
         """
+        # Set the history depth
+        if cfg.has_option( 'general', 'history.depth' ):
+            self.set_history( cfg.getint('general','history.depth') )
+
         # Set session predicates
         if 'noses' in options:
             if self._verboseMode: print('Skipping session predicates')
@@ -414,38 +1479,65 @@ class AimlBot( Kernel, object ):
 
     def _load_brain( self, cfg, zipf, cfgdir ):
         """
-        Load the brain file
+        Read the brain file into a new pattern matcher
+          @return (tuple): the pattern matcher (None if no brain file is
+            defined) and the size of the brain file, if it is not in the zip
         """
         try:
             brainfile = cfg.get('general','brain.filename')
-            if not zipf:
-                if not os.path.exists( brainfile ):
-                    brainfile = os.path.join( cfgdir, brainfile )
-                self.loadBrain( brainfile )
-            else:
-                if brainfile not in zipf.namelist():
-                    raise KrnlException('brainfile "{}" not found in zip',
-                                        brainfile)
-                # We need to extract the file
-                # (PatternMgr can't read from file-like objects)
-                tmpf = None
-                try:
-                    tmpf = zipf.extract( brainfile, tempfile.gettempdir() )
-                    self.loadBrain( tmpf )
-                finally:
-                    if tmpf:
-                        os.unlink(tmpf)
-
         except ConfigParser.NoOptionError:
             if self._verboseMode: print('No brain file defined')
+            return None, 0
+        # The compiled matcher can read pyAIML brains, but not the opposite
+        if cfg.has_option('general','brain.matcher'):
+            matcher = cfg.get('general','brain.matcher')
+            if matcher != 'pyaiml' and self._matcher == 'pyaiml':
+                raise KrnlException('brain was saved with the "{}" matcher',
+                                    matcher)
+        self._report( 'brain', brainfile )
+        if not zipf:
+            if not os.path.exists( brainfile ):
+                brainfile = os.path.join( cfgdir, brainfile )
+            return self._read_brain( brainfile ), os.path.getsize( brainfile )
+        if brainfile not in zipf.namelist():
+            raise KrnlException('brainfile "{}" not found in zip',
+                                brainfile)
+        # A brain in mappable format is used directly from the zip
+        if hasattr( self._brain, 'map' ):
+            with zipf.open( brainfile ) as f:
+                magic = f.read( len(BRAIN_MAGIC) )
+            if magic == BRAIN_MAGIC:
+                return self._map_brain( zip_member_buffer(zipf,brainfile),
+                                        brainfile ), 0
+        # Otherwise it is read from the zip member
+        with zipf.open( brainfile ) as f:
+            return self._read_brain( brainfile, f ), 0
+
+
+    def _map_brain( self, buf, name ):
+        """
+        Create a pattern matcher using a brain in mappable format held in
+        a buffer
+        """
+        if self._verboseMode: print( "Mapping brain from %s..." % name, end="" )
+        start = time.time()
+        brain = MATCHERS[self._matcher]()
+        brain.map( buf )
+        if self._verboseMode:
+            print( "done (%d categories in %.2f seconds)" %
+                   (brain.numTemplates(), time.time() - start) )
+        return brain
 
 
     def load( self, filename, options=[] ):
         """
         Load the complete bot state (patterns, session predicates, bot
         predicates, substitutions) from disk.
+          @return (str): a summary of the data loaded
         """
+        import zipfile
         options = set( (v[:5] for v in options) )
+        start = time.time()
 
         # Detect file type (plain INI file or zipped file)
         is_zip = None
@@ -479,24 +1571,46 @@ class AimlBot( Kernel, object ):
                 zipf.close()
                 raise KrnlException( "Can't find ini file in bot file: {}", filename )
 
-        # Read data
+        # Read data. The brain is read first, into a new pattern matcher,
+        # so that the bot is not changed until everything has been read
+        brain, sessions, size = None, None, os.path.getsize( filename )
         try:
             # Read INI configuration file
             cfg = ConfigParser.SafeConfigParser()
-            cfg.readfp( io.TextIOWrapper(cfgfile,encoding='utf-8'), filename )
-            # Load variables (session, bot, subs )
-            self._load_vars( cfg, options )
+            read_config( cfg, io.TextIOWrapper(cfgfile,encoding='utf-8'),
+                         filename )
+
+            # Open the session table
+            if 'noses' not in options:
+                sessions = self._load_sessions( cfg, is_zip and zipf,
+                                                None if is_zip else cfgdir )
 
-            # Load brain
+            # Read brain
             if 'nobra' in options:
                 if self._verboseMode: print('Skipping brain patterns')
             elif is_zip:
-                self._load_brain( cfg, zipf, None )
+                brain, _ = self._load_brain( cfg, zipf, None )
             else:
-                self._load_brain( cfg, None, cfgdir )
+                brain, brainsize = self._load_brain( cfg, None, cfgdir )
+                size += brainsize
         finally:
             if is_zip:
                 zipf.close()
+        if brain is not None:
+            self._report( 'read', brain.numTemplates() )
+
+        # Load variables (session, bot, subs), add the sessions and replace
+        # the brain
+        self._load_vars( cfg, options )
+        if sessions is not None:
+            self._sessions.load_table( sessions )
+        if brain is not None:
+            self._use_brain( brain )
+        msg = u'Loaded bot state from "{}": {:,} bytes, {} categories'.format(
+            filename, size, self.numCategories() )
+        if sessions is not None:
+            msg += u', {} sessions'.format( len(sessions) )
+        return msg + u' ({:.2f}s)'.format( time.time() - start )
 
 
     def record( self, cmd, *param ):
@@ -535,10 +1649,328 @@ class AimlBot( Kernel, object ):
         some special bot predicates.
         '''
         super(AimlBot,self).setBotPredicate( name, value )
+        self._invalidate()
         if name == 'lang':
             locale.setlocale( locale.LC_ALL, str(value) )
 
 
+    def respond( self, input_, *args, **kwargs ):
+        """
+        Override the parent method to delimit the scope of the <srai> memo
+        and to count the <srai> hops avoided in the request
+        """
+        prev, self._memo = self._memo, {}
+        self._srai_last = [0, 0]
+        profiler, tracer = self._profiler, self._tracer
+        traced = None
+        if profiler is not None or tracer is not None:
+            sessionID = args[0] if args else kwargs.get( 'sessionID',
+                                                         self._globalSessionID )
+            if tracer is not None:
+                traced = tracer.begin( self._cod.dec(input_)
+                                       if isinstance(input_,bytes) else input_,
+                                       sessionID )
+            start = clock()
+        try:
+            return super(AimlBot,self).respond( input_, *args, **kwargs )
+        finally:
+            self._memo = prev
+            self._srai_total[0] += 1
+            self._srai_total[1] += self._srai_last[0]
+            self._srai_total[2] += self._srai_last[1]
+            if profiler is not None:
+                profiler.request( input_, sessionID, clock() - start )
+            if traced is not None:
+                tracer.end( traced, clock() - start )
+
+
+    def _valid( self, deps, sessionID ):
+        """
+        Check if a tuple of (predicate, value) pairs still holds, and if so
+        register those predicates in the response being computed
+        """
+        if not all( self.getPredicate(n,sessionID) == v for n, v in deps ):
+            return False
+        if self._recording:
+            self._recording[-1][0].update( n for n, _ in deps )
+        return True
+
+
+    def _respond( self, input_, sessionID ):
+        """
+        Override the parent method to serve responses from the <srai> memo or
+        the cache when possible, and to store the reusable ones.
+
+        A response is reusable if none of the templates used to produce it
+        (including those reached through <srai>) contains a volatile element.
+        Cache entries are keyed by the normalized input, <that> and topic,
+        and keep the values of the session predicates read by the templates;
+        an entry is valid only while those predicates hold the same values.
+        Memo entries are the same, but keyed by the raw strings, and last
+        only for the current request.
+        """
+        inputStack = self.getPredicate( self._inputStack, sessionID )
+        if self._matched is not None and not inputStack:
+            self._matched.append( self._match_key(input_, sessionID) )
+        if len(input_) == 0 or len(inputStack) > self._maxRecursionDepth:
+            return super(AimlBot,self)._respond( input_, sessionID )
+
+        outHist = self.getPredicate( self._outputHistory, sessionID )
+        that = outHist[-1] if outHist else u''
+        topic = self.getPredicate( 'topic', sessionID )
+        normal = self._normalizer.sub
+        tracer = self._tracer
+        if tracer is not None and tracer.active:
+            tracer.event( 'input', len(inputStack),
+                          (input_, normal(that), normal(topic)) )
+
+        cache = self._cache
+        memo = self._memo if inputStack else None
+        if (cache is None and memo is None) or \
+           len(inputStack) == self._maxRecursionDepth:
+            return self._respond_match( input_, (normal(input_), normal(that),
+                                                 normal(topic)), sessionID )
+
+        # A <srai> already evaluated in this request
+        if memo is not None:
+            mkey = ( input_, that, topic )
+            entry = memo.get( mkey )
+            if entry is not None and self._valid( entry[0], sessionID ):
+                self._srai_last[1] += 1
+                if tracer is not None and tracer.active:
+                    tracer.event( 'cache', len(inputStack) )
+                return entry[1]
+
+        # Normalize the input & check if we've got a valid cache entry
+        key = ( normal(input_), normal(that), normal(topic) )
+        if cache is not None:
+            entry = cache.get( key )
+            if entry is not None and self._valid( entry[0], sessionID ):
+                cache.hits += 1
+                if tracer is not None and tracer.active:
+                    tracer.event( 'cache', len(inputStack) )
+                if memo is not None:
+                    memo[mkey] = entry
+                return entry[1]
+            cache.misses += 1
+
+        # Compute the response, recording which predicates are read
+        self._recording.append( [set(), False] )
+        try:
+            response = self._respond_match( input_, key, sessionID )
+        finally:
+            deps, volatile = self._recording.pop()
+        if self._recording:
+            self._recording[-1][0].update( deps )
+            self._recording[-1][1] |= volatile
+        if not volatile:
+            deps = tuple( (n, self.getPredicate(n,sessionID))
+                          for n in sorted(deps) )
+            if cache is not None:
+                cache.put( key, deps, response )
+            if memo is not None:
+                memo[mkey] = deps, response
+        return response
+
+
+    def normalize( self, text ):
+        """
+        Normalize a string as the bot does before matching it: apply the
+        normal substitutions, convert to upper case and remove punctuation.
+        Results are memoized
+          @param text (str): the string to normalize
+          @return (str): the normalized string, words separated by a space
+        """
+        return self._normalizer( text )
+
+
+    def _match_key( self, input_, sessionID ):
+        """
+        Return the [pattern/that/topic] key of the category that an input
+        matches in the current session state, or None if there is no match
+        """
+        outHist = self.getPredicate( self._outputHistory, sessionID )
+        that = outHist[-1] if outHist else u''
+        topic = self.getPredicate( 'topic', sessionID )
+        normal = self._normalizer.sub
+        return self._brain.matched( normal(input_), normal(that), normal(topic) )
+
+
+    def respond_many( self, inputs, session=None, workers=1 ):
+        """
+        Respond to a sequence of inputs. The inputs for each session are
+        processed in order. With more than one worker, sessions are
+        distributed across a pool of worker processes, all using the brain
+        saved to temporary files (which the compiled matcher maps, so that
+        its pages are shared); the final state of each session is then
+        copied back to this bot
+          @param inputs (iterable): the inputs, either strings or
+            (session, string) tuples
+          @param session (str): the session for string inputs (default:
+            the global session)
+          @param workers (int): number of worker processes
+          @return (list): a list of (session, input, response, matched)
+            tuples, in input order. \c matched is a tuple with the
+            [pattern/that/topic] key matched by each sentence of the input
+            (None for a sentence with no match)
+        """
+        if session is None:
+            session = self._globalSessionID
+        items = [ i if isinstance(i,tuple) else (session, i) for i in inputs ]
+        sessions = OrderedDict()
+        for n, (sid, _) in enumerate(items):
+            sessions.setdefault( sid, [] ).append( n )
+        workers = min( workers, len(sessions) )
+        if workers < 2:
+            return [ self._respond_row(sid, text) for sid, text in items ]
+
+        rows = [ None ] * len(items)
+        tmpdir = tempfile.mkdtemp()
+        verbose, self._verboseMode = self._verboseMode, False
+        try:
+            botfile = os.path.join( tmpdir, 'batch' )
+            self.save( botfile, ['nosession', 'rawfile'] )
+            pool = process_pool( workers, initializer=_batch_init,
+                                 initargs=(botfile+'.ini', self._matcher) )
+            if pool is None:
+                return [ self._respond_row(sid, text) for sid, text in items ]
+            with pool:
+                tasks = []
+                for sid, idx in iteritems(sessions):
+                    self._addSession( sid )
+                    tasks.append( (sid, idx, pool.submit(
+                        _batch_session, sid, self.getSessionData(sid),
+                        [ items[n][1] for n in idx ])) )
+                for sid, idx, task in tasks:
+                    out, self._sessions[sid] = task.result()
+                    for n, row in zip( idx, out ):
+                        rows[n] = row
+        finally:
+            self._verboseMode = verbose
+            shutil.rmtree( tmpdir, ignore_errors=True )
+        return rows
+
+
+    def _respond_row( self, sessionID, input_ ):
+        """
+        Respond to an input, returning a respond_many() row
+        """
+        self._matched = []
+        try:
+            response = self.respond( input_, sessionID )
+        finally:
+            matched, self._matched = self._matched, None
+        if isinstance(response,bytes):
+            response = self._cod.dec( response )
+        return sessionID, input_, response, tuple(matched)
+
+
+    def _respond_match( self, input_, subbed, sessionID, tem=None ):
+        """
+        The second half of the parent _respond(), once the input has been
+        checked and normalized: push the input onto the input stack, match
+        it (unless the template is already known) and process the template
+          @param subbed (tuple): the normalized input, that & topic
+        """
+        inputStack = self.getPredicate( self._inputStack, sessionID )
+        inputStack.append( input_ )
+        tracer = self._tracer
+        if tracer is not None and tracer.active:
+            depth, tracer.depth = tracer.depth, len(inputStack) - 1
+        else:
+            tracer = None
+        try:
+            if tem is None:
+                tem = self._brain.match( *subbed )
+            if self._profiler is not None:
+                # (by category key: identical templates are shared)
+                self._profiler.hit( None if tem is None else
+                                    self._brain.matched( *subbed )
+                                    if subbed is not None else
+                                    self._match_key( input_, sessionID ) )
+            if tracer is not None:
+                tracer.event( 'match', tracer.depth, tem )
+            if tem is None:
+                if self._verboseMode:
+                    err = "WARNING: No match found for input: %s\n" % self._cod.enc(input_)
+                    sys.stderr.write( err )
+                return u""
+            return self._processElement( tem, sessionID ).strip()
+        finally:
+            inputStack.pop()
+            if tracer is not None:
+                tracer.depth = depth
+
+
+    def _srai( self, input_, sessionID ):
+        """
+        Evaluate a <srai> element with constant content. If the brain can
+        tell in advance the template it leads to, go directly to it,
+        skipping input normalization and matching
+        """
+        try:
+            target = self._srai_targets[input_]
+        except KeyError:
+            resolve = getattr( self._brain, 'resolve', None )
+            target = resolve( self._normalizer.sub(input_) ) if resolve else None
+            self._srai_targets[input_] = target
+        inputStack = self.getPredicate( self._inputStack, sessionID )
+        if target is None or len(inputStack) >= self._maxRecursionDepth:
+            return self._respond( input_, sessionID )
+
+        # The target is not valid if there is a category for the same
+        # pattern with a <that> or <topic> matching the current ones
+        tem, guards = target
+        if guards:
+            outHist = self.getPredicate( self._outputHistory, sessionID )
+            normal = self._normalizer.sub
+            if self._brain.guarded( guards,
+                                    normal(outHist[-1] if outHist else u''),
+                                    normal(self.getPredicate('topic',sessionID)) ):
+                return self._respond( input_, sessionID )
+
+        self._srai_last[0] += 1
+        return self._respond_match( input_, None, sessionID, tem )
+
+
+    def _processTemplate( self, elem, sessionID ):
+        """
+        Override the parent method to register the template cacheability
+        in the response being computed, and to evaluate the compiled
+        version of the template (instrumented, while profiling or tracing)
+        """
+        info = self._template_info( elem )
+        if self._recording:
+            deps = self._template_deps( info )
+            if deps is None:
+                self._recording[-1][1] = True
+            else:
+                self._recording[-1][0].update( deps )
+        if self._profiler is None and self._tracer is None:
+            return info[2]( sessionID )
+        if info[3] is None:
+            info[3] = self._compiler.compile( elem, instrumented=True )
+        return info[3]( sessionID )
+
+
+    def _TRACE_processElement( self, elem, sessionID ):
+        """
+        Process an element with the interpreter, for the instrumented
+        templates (those used while profiling or tracing): the element is
+        timed and traced as a single element
+        """
+        process = super( AimlBot, self )._processElement
+        profiler, tracer = self._profiler, self._tracer
+        name = elem[0]
+        run = lambda sid : process( elem, sid )
+        if profiler is not None:
+            prof = run
+            run = lambda sid : profiler.call( name, prof, sid )
+        if tracer is not None and tracer.wants( name ):
+            return tracer.call( name, run, sessionID )
+        return run( sessionID )
+
+
     def _processDate(self, elem, sessionID):
         """
         Override parent's method to allow full formatting of dates,
@@ -556,56 +1988,103 @@ class AimlBot( Kernel, object ):
             return time.strftime( elem[1]['format'] )
 
 
-    def trace( self, inputMsg ):
-        '''
-        Process an input, but keeping track of all the elements processed
-        '''
-        # Store safely the original methods and initiallize the stack
-        bck = self._processElement, self._respond
-        self._traceStack = []
+    def set_tracing( self, on, **opts ):
+        """
+        Start or stop tracing requests. Starting creates a new event buffer
+        (see Tracer for the options); stopping keeps the buffer available
+        for display and export. Return the previous state
+          @param opts (dict): size, sample, sessions, inputs, elements
+        """
+        prev = self._tracer is not None
+        if on:
+            self._trace = self._tracer = Tracer( **opts )
+        else:
+            self._tracer = None
+        return prev
 
-        try:
-            # Replace for the tracing methods
-            self._processElement = self._TRACE_processElement
-            self._respond = self._TRACE_respond
-            # Call the evaluation method
-            result = self.respond( inputMsg.encode('utf-8') ).decode('utf-8')
-            # Format the tracing stack and return it
-            import pprint
-            n = count(1)
-            tr = [ (m[1],m[0]) if m[0].startswith('trace-') else
-                   ('{:2}: {}\n'.format(next(n),m[0])+pprint.pformat(m[1:]),
-                    'trace-res') for m in self._traceStack ]
-            return tr + [(result,'bot')]
-        finally:
-            # Restore the original methods and delete the stack
-            self._processElement, self._respond = bck
-            self._traceStack = None
+
+    def trace_stats( self ):
+        """
+        Return the tracing state, as a list of (name, value) tuples
+        """
+        on = self._tracer is not None
+        return [ ('status', 'on' if on else 'off') ] + \
+            ( self._trace.stats() if self._trace else [] )
 
 
-    def _TRACE_respond(self, input, sessionID):
+    def trace_records( self, last=None ):
         """
-        Override the parent method to store all input in the tracing stack
+        Return the buffered trace events, as a list of dicts (match events
+        get the [pattern, that, topic] of the matched category)
+          @param last (int): return only the events of the last requests
         """
-        # Find topic & that
-        topic = self._subbers['normal'].sub( self.getPredicate("topic") )
-        outHist = self.getPredicate(self._outputHistory)
-        that = self._subbers['normal'].sub( outHist[-1] if outHist else '' )
-        # Add the inputs to the stack
-        dat = ( 'trace-in', 
-                u'INPUT=[{}] THAT=[{}] TOPIC=[{}]'.format(input,that,topic) )
-        self._traceStack.append( dat )
-        # Route to parent
-        return super(AimlBot,self)._respond( input, sessionID )
+        if self._trace is None:
+            return []
+        return self._trace.records( self._template_key, last )
 
 
-    def _TRACE_processElement(self, elem, sessionID):
+    def export_trace( self, filename ):
         """
-        Override the parent method to store the element in the tracing stack
+        Write the buffered trace events to a JSON Lines file
+          @return (int): the number of events written
         """
-        # Add the element to the stack
-        self._traceStack.append( elem )
-        # Route to parent
-        return super(AimlBot,self)._processElement( elem, sessionID )
+        if self._trace is None:
+            return 0
+        return self._trace.export( filename, self._template_key )
 
 
+    def clear_trace( self ):
+        """
+        Discard the buffered trace events
+        """
+        if self._trace is not None:
+            self._trace.clear()
+
+
+    def _template_key( self, tem ):
+        """
+        Return the [pattern/that/topic] key of a template (None if it is
+        no longer in the brain)
+        """
+        keys = getattr( self._brain, 'template_keys', None )
+        return keys( [tem] ).get( id(tem) ) if keys else None
+
+
+    def trace( self, inputMsg ):
+        '''
+        Process an input, recording its trace events, and return them
+        formatted as a list of (text, type) messages, ending with the
+        response
+        '''
+        # Use a tracer for this request only
+        prev, self._tracer = self._tracer, Tracer()
+        tracer = self._tracer
+        try:
+            result = self.respond( inputMsg.encode('utf-8') ).decode('utf-8')
+        finally:
+            self._tracer = prev
+        out = []
+        n = count( 1 )
+        res = []
+        for ev in tracer.request_events():
+            indent = u'  ' * ev.depth
+            if ev.kind == 'input':
+                if res:
+                    out.append( (u'\n'.join(res), 'trace-res') )
+                    res = []
+                out.append( (u'{}INPUT=[{}] THAT=[{}] TOPIC=[{}]'.format(
+                    indent, *ev.data), 'trace-in') )
+            elif ev.kind == 'match':
+                key = None if ev.data is None else self._template_key(ev.data)
+                res.append( u'{}MATCH: {}'.format( indent,
+                    u'(no match)' if ev.data is None else
+                    u'?' if key is None else u' | '.join(key) ) )
+            elif ev.kind == 'cache':
+                res.append( u'{}(response from cache)'.format(indent) )
+            elif ev.kind == 'element':
+                res.append( u'{:2}: {}{}<{}> {:.3f} ms'.format(
+                    next(n), indent, u'  '*ev.level, ev.name,
+                    1000*ev.duration) )
+        if res:
+            out.append( (u'\n'.join(res), 'trace-res') )
+        return out + [ (result, 'bot') ]
@@ -0,0 +1,340 @@
+"""
+An alternative AIML ingestion engine.
+
+pyAIML parses AIML through xml.sax and its AimlHandler, which gets a
+Python callback for each element start, element end and text chunk, and
+walks a state machine in each of them. This engine lets the expat-based
+ElementTree parser build each category as an element subtree in C (reading
+the document incrementally, and discarding each category once processed),
+and then converts that subtree with a single Python pass.
+
+The result is the same dict (pattern, that, topic) -> template that
+AimlHandler produces. The fast path only covers well-formed, valid AIML:
+for any document in which AimlHandler would report an error (or that uses
+a construct not handled here) the document is parsed again with the
+standard handler, so that both the categories and the error reporting are
+identical.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import gc
+import xml.sax
+import xml.etree.ElementTree as ET
+
+from aiml.AimlParser import AimlHandler, AimlParserError, create_parser
+
+
+# Available ingestion engines, and the one used by default (both produce
+# the same categories)
+ENGINES = ( 'sax', 'etree' )
+DEFAULT_ENGINE = 'etree'
+
+# Size of the chunks read from files
+CHUNK_SIZE = 65536
+
+# Namespace of the xml: attributes, as ElementTree reports them
+_XML_NS = '{http://www.w3.org/XML/1998/namespace}'
+
+# Structural elements that are invalid inside a template
+_STRUCTURAL = frozenset( ('aiml', 'topic', 'category', 'pattern', 'template') )
+
+
+class _Fallback( Exception ):
+    """
+    Raised when a document must be parsed with the standard handler
+    """
+
+
+def _attributes( attrib ):
+    """
+    Convert ElementTree attributes into the names used by AimlHandler
+    """
+    if not attrib:
+        return {}
+    out = {}
+    for k, v in attrib.items():
+        if k[0] == '{':
+            if not k.startswith( _XML_NS ):
+                raise _Fallback
+            k = 'xml:' + k[len(_XML_NS):]
+        out[k] = v
+    return out
+
+
+def _whitespace( attr, current ):
+    """
+    Return the whitespace behaviour for an element (as in
+    AimlHandler._pushWhitespaceBehavior)
+    """
+    ws = attr.get( 'xml:space' )
+    if ws is None:
+        return current
+    elif ws in ('default', 'preserve'):
+        return ws
+    raise _Fallback
+
+
+class _Converter( object ):
+    """
+    Convert category element trees into the AimlHandler structures
+    """
+
+    def __init__( self, version, ns ):
+        # A handler instance, used for element validation
+        self._validator = AimlHandler()
+        self._validator._version = version
+        self._validator._forwardCompatibleMode = (version != "1.0.1")
+        self._valid = self._validator._validInfo
+        self._ns = ns
+
+
+    def tag( self, elem ):
+        """
+        Return the element name, removing the document default namespace
+        """
+        tag = elem.tag
+        if not isinstance(tag,str):
+            # A comment or processing instruction
+            raise _Fallback
+        if tag[0] == '{':
+            if not self._ns or not tag.startswith( self._ns ):
+                raise _Fallback
+            tag = tag[len(self._ns):]
+        return tag
+
+
+    def unknown( self, elem, complete=False ):
+        """
+        Check an unknown element, which is ignored together with its
+        contents (only in forward-compatible mode). The handler stops
+        ignoring at the first end tag with the same name, so nesting one
+        inside another is not supported here
+          @param complete (bool): the element has been completely parsed
+        """
+        if self.tag(elem) in _STRUCTURAL or not self._validator._forwardCompatibleMode:
+            raise _Fallback
+        if complete and any( d.tag == elem.tag for d in elem.iter()
+                             if d is not elem ):
+            raise _Fallback
+
+
+    def category( self, elem, topic, ws ):
+        """
+        Convert a <category> element
+          @return (tuple): a tuple (key, template)
+        """
+        ws = _whitespace( _attributes(elem.attrib), ws )
+        children = list( elem )
+        if len(children) == 3:
+            pattern, that, template = children
+            if self.tag(that) != 'that':
+                raise _Fallback
+            that = self.pattern( that )
+        elif len(children) == 2:
+            pattern, template = children
+            that = u'*'
+        else:
+            raise _Fallback
+        if self.tag(pattern) != 'pattern' or self.tag(template) != 'template':
+            raise _Fallback
+        tem = [ 'template', {} ]
+        self.template( template, tem,
+                       _whitespace(_attributes(template.attrib),ws) )
+        return (self.pattern(pattern).strip(), that.strip(), topic.strip()), tem
+
+
+    def pattern( self, elem ):
+        """
+        Get the text of a <pattern> or pattern-side <that> element
+        """
+        text = [ elem.text or u'' ]
+        for child in elem:
+            if ( self.tag(child) != 'bot' or len(child) or
+                 child.attrib.get('name') != u'name' ):
+                raise _Fallback
+            text += [ u' BOT_NAME ', child.text or u'', child.tail or u'' ]
+        return u''.join( text )
+
+
+    def text( self, node, text, ws ):
+        """
+        Add text to a template node (as AimlHandler._characters)
+        """
+        name, attr = node[0], node[1]
+        if not self._valid[name][2]:
+            raise _Fallback
+        if name == 'random' or (name == 'condition' and
+                                not ('name' in attr and 'value' in attr)):
+            # only whitespace is allowed (and ignored) here
+            if text.strip():
+                raise _Fallback
+            return
+        last = node[-1]
+        if isinstance(last,list) and last[0] == 'text':
+            last[2] += text
+        else:
+            node.append( [ 'text', {'xml:space': ws}, text ] )
+
+
+    def template( self, elem, node, ws ):
+        """
+        Convert the contents of a template element into a template node
+        """
+        validator = self._validator
+        if elem.text:
+            self.text( node, elem.text, ws )
+        for child in elem:
+            name = self.tag( child )
+            if name in _STRUCTURAL:
+                raise _Fallback
+            elif name in self._valid:
+                attr = _attributes( child.attrib )
+                validator._elemStack = [ node ]
+                try:
+                    validator._validateElemStart( name, attr,
+                                                  validator._version )
+                except AimlParserError:
+                    raise _Fallback
+                sub = [ name, attr ]
+                if name == 'condition':
+                    validator._foundDefaultLiStack.append( False )
+                self.template( child, sub, _whitespace(attr,ws) )
+                if name == 'condition':
+                    validator._foundDefaultLiStack.pop()
+                node.append( sub )
+            else:
+                self.unknown( child, True )
+            if child.tail:
+                self.text( node, child.tail, ws )
+
+
+
+def _etree_parse( chunks ):
+    """
+    Parse an AIML document with ElementTree, delivered as a sequence of
+    byte chunks
+      @return (dict): the categories, (pattern, that, topic) -> template
+    """
+    # The many objects created would trigger repeated garbage collections,
+    # each one traversing the whole brain learnt so far. Nothing created
+    # here contains reference cycles, so collection can be paused
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _etree_categories( chunks )
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _etree_categories( chunks ):
+    """
+    The ElementTree-based parsing loop
+    """
+    parser = ET.XMLPullParser( events=('start', 'end') )
+    categories = {}
+    depth = 0
+    # The open <aiml> and <topic>/<category> elements
+    stack = []
+    for data in chunks:
+        parser.feed( data )
+        for event, elem in parser.read_events():
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    # The <aiml> root element (with an optional namespace)
+                    tag = elem.tag
+                    ns = tag[:tag.index('}')+1] if tag[0] == '{' else None
+                    if tag[len(ns or ''):] != 'aiml':
+                        raise _Fallback
+                    attr = dict( (k, v) for k, v in elem.attrib.items()
+                                 if k[0] != '{' or k.startswith(_XML_NS) )
+                    attr = _attributes( attr )
+                    conv = _Converter( attr.get('version','1.0'), ns )
+                    ws = _whitespace( attr, 'default' )
+                    stack.append( elem )
+                elif depth == 2:
+                    tag = conv.tag( elem )
+                    if tag == 'topic' and 'name' not in elem.attrib:
+                        raise _Fallback
+                    elif tag not in ('topic', 'category'):
+                        conv.unknown( elem )
+                    stack.append( elem )
+                continue
+
+            depth -= 1
+            if depth == 1:
+                # A child of <aiml>
+                stack.pop()
+                tag = conv.tag( elem )
+                if tag == 'category':
+                    key, tem = conv.category( elem, u'*', ws )
+                    categories[key] = tem
+                elif tag != 'topic':
+                    conv.unknown( elem, True )
+            elif depth == 2 and conv.tag( stack[-1] ) == 'topic':
+                # A child of <topic>
+                if conv.tag( elem ) != 'category':
+                    raise _Fallback
+                key, tem = conv.category( elem, stack[-1].attrib['name'], ws )
+                categories[key] = tem
+            else:
+                continue
+            # Discard the elements already processed
+            del stack[-1][:]
+    parser.close()
+    return categories
+
+
+def _read_chunks( filename ):
+    """
+    Read a file as a sequence of chunks
+    """
+    with open( filename, 'rb' ) as f:
+        while True:
+            data = f.read( CHUNK_SIZE )
+            if not data:
+                break
+            yield data
+
+
+def parse_file( filename, encoding, engine=DEFAULT_ENGINE ):
+    """
+    Parse an AIML file
+      @param filename (str): the file to parse
+      @param encoding (str): the text encoding for the parsed strings
+      @param engine (str): the ingestion engine: \c sax or \c etree
+      @return (dict): the categories, (pattern, that, topic) -> template
+      @raise xml.sax.SAXParseException: the document is not well-formed
+    """
+    if engine == 'etree':
+        try:
+            return _etree_parse( _read_chunks(filename) )
+        except (_Fallback, ET.ParseError):
+            pass
+    parser = create_parser()
+    handler = parser.getContentHandler()
+    handler.setEncoding( encoding )
+    parser.parse( filename )
+    return handler.categories
+
+
+def parse_string( data, encoding, engine=DEFAULT_ENGINE ):
+    """
+    Parse an AIML document held in a string
+      @param data (bytes): the document
+      @param encoding (str): the text encoding for the parsed strings
+      @param engine (str): the ingestion engine: \c sax or \c etree
+      @return (dict): the categories, (pattern, that, topic) -> template
+      @raise xml.sax.SAXParseException: the document is not well-formed
+    """
+    if engine == 'etree':
+        try:
+            return _etree_parse( [data] )
+        except (_Fallback, ET.ParseError):
+            pass
+    handler = AimlHandler( encoding )
+    handler.setEncoding( encoding )
+    xml.sax.parseString( data, handler )
+    return handler.categories
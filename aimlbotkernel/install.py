@@ -155,7 +155,19 @@ class AimlBotInstall( InstallKernelSpec ):
         config=True,
         help="""Default directory to use for the logfile."""
     )
-    aliases =  { 'logdir' : 'AimlBotInstall.logdir' } 
+    preload = Unicode( '',
+        config=True,
+        help="""Brain to load in the background when the kernel starts: a
+        saved bot file (.bot), or a db as accepted by %learn."""
+    )
+    matcher = Unicode( '',
+        config=True,
+        help="""Pattern matcher for the bot: pyaiml (the default) or
+        compiled."""
+    )
+    aliases =  { 'logdir' : 'AimlBotInstall.logdir',
+                 'preload' : 'AimlBotInstall.preload',
+                 'matcher' : 'AimlBotInstall.matcher' }
 
     def parse_command_line(self, argv):
         """
@@ -174,8 +186,19 @@ class AimlBotInstall( InstallKernelSpec ):
         with TemporaryDirectory() as td:
             os.chmod(td, 0o755) # Starts off as 700, not user readable
             # Add kernel spec
+            env = {}
             if len(self.logdir):
-                kernel_json['env'] = { 'LOGDIR_DEFAULT' : self.logdir }
+                env['LOGDIR_DEFAULT'] = self.logdir
+            if len(self.preload):
+                # Files are given by absolute path (the kernel starts in the
+                # notebook directory); standard db names are kept as they are
+                env['AIMLBOT_PRELOAD'] = self.preload if \
+                    self.preload in ('alice','standard') else \
+                    os.path.abspath( self.preload )
+            if len(self.matcher):
+                env['AIMLBOT_MATCHER'] = self.matcher
+            if env:
+                kernel_json['env'] = env
             with open(os.path.join(td, 'kernel.json'), 'w') as f:
                 json.dump(kernel_json, f, sort_keys=True)
             # Add resources
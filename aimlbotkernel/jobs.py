@@ -0,0 +1,128 @@
+"""
+Background jobs for the magics that change the brain in bulk (%learn and
+%load), so that the kernel keeps serving requests while they run.
+
+A job works on the bot in a separate thread. The bot reports its progress
+(files learnt, brain read) to the job, which forwards it to the cell that
+started the job; that is also the point where a cancelled job stops. A job
+that fails or is cancelled leaves the brain as it was. Cells that need the
+bot wait until the job has finished.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os.path
+import threading
+
+from .utils import KrnlException
+
+
+class JobCancelled( KrnlException ):
+    """
+    Raised through the bot progress callback to stop a cancelled job
+    """
+
+
+class BrainJob( object ):
+    """
+    An operation on the bot running in a background thread
+    """
+
+    def __init__( self, name, bot, func, send, write ):
+        """
+          @param name (str): a description of the job, for messages
+          @param bot (AimlBot): the bot the job works on
+          @param func (callable): the job, called with the bot. It returns
+            the final message, as a (data, status) tuple
+          @param send (callable): send a message (data, status) to the cell
+            that started the job
+          @param write (callable): send progress text to that cell
+        """
+        self.name = name
+        self.bot = bot
+        self._func = func
+        self._send, self._write = send, write
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+        self._thread = threading.Thread( name='aimlbot-job', target=self._run )
+        self._thread.daemon = True
+
+
+    def start( self ):
+        self._thread.start()
+
+
+    def running( self ):
+        return not self._done.is_set()
+
+
+    def cancel( self ):
+        """
+        Ask the job to stop at its next progress report
+        """
+        self._cancel.set()
+
+
+    def wait( self ):
+        """
+        Wait for the job to finish. If the wait is interrupted (a kernel
+        interrupt), cancel the job and wait for it to stop
+        """
+        # (an event with a timeout, not Thread.join(): the interrupt must be
+        # received while waiting, and an interrupted join() can leave the
+        # thread looking finished)
+        try:
+            while not self._done.is_set():
+                self._done.wait( 0.1 )
+        except KeyboardInterrupt:
+            self.cancel()
+            self._done.wait()
+            raise KrnlException( 'interrupted while waiting for {}', self.name )
+
+
+    def progress( self, event, *args ):
+        """
+        The bot progress callback: forward the event to the frontend, and
+        stop the job if it has been cancelled
+        """
+        if event == 'file':
+            self._write( u'  {}: {} categories ({} in the brain)\n'.format(
+                os.path.basename(args[0]), args[1], self.bot.numCategories()) )
+        elif event == 'brain':
+            self._write( u'  reading brain "{}"\n'.format(args[0]) )
+        elif event == 'read':
+            self._write( u'  {} categories read\n'.format(args[0]) )
+        elif event == 'sessions':
+            self._write( u'  {} saved sessions\n'.format(args[0]) )
+        if self._cancel.is_set():
+            raise JobCancelled( '{}: cancelled, the brain is unchanged',
+                                self.name )
+
+
+    def _run( self ):
+        """
+        Run the job in the thread, undo its changes if it does not succeed,
+        and send the final message
+        """
+        bot = self.bot
+        state = bot.checkpoint()
+        prev = bot.set_progress( self.progress )
+        # Nothing must be printed, since stdout goes to the cell being run
+        bot.verbose( False )
+        try:
+            result = self._func( bot )
+        except KrnlException as e:
+            result = e, 'error'
+        except Exception as e:
+            result = KrnlException( e ), 'error'
+        finally:
+            bot.verbose( True )
+            bot.set_progress( prev )
+        try:
+            if result[1] == 'error':
+                bot.rollback( state )
+            else:
+                bot.release( state )
+            self._send( *result )
+        finally:
+            self._done.set()
@@ -1,27 +1,61 @@
 """
-The main file for the AIML Chatbot Jupyter kernel
+The main file for the AIML Chatbot Jupyter kernel.
+
+The bot (and pyAIML with it) is created when first needed, with the
+pattern matcher named in the AIMLBOT_MATCHER environment variable (if it is
+not set, the AimlBot default). If a brain to
+preload is configured (in the AIMLBOT_PRELOAD environment variable, set in
+the kernelspec by the installer), it is loaded in a background thread as
+the kernel starts; the first cell that needs the bot waits for it.
+
+%learn and %load run as background jobs: the cell returns at once, and the
+job streams its progress to it. Cells that need the bot wait for the job,
+and a kernel interrupt cancels it, leaving the brain unchanged.
 """
 
 from __future__ import absolute_import, division, print_function
 
 import sys
 import os
-import aiml
+import io
+import re
+import time
 import logging
+import threading
+import signal
 
 from ipykernel.kernelbase import Kernel
 from traitlets import List
 
 from . import __version__
-from .aimlbot import AimlBot, build_aiml, pyaiml_version
+from .aimlparse import ENGINES
 from .utils import KrnlException, data_msg
-from .setlogging import set_logging, logfilename
+from .jobs import BrainJob
+from .outstream import StdoutForwarder
+from .setlogging import set_logging, set_level, logfilename
 
 
 # Load commands for the standard DBs
 LOAD = { 'alice' : 'alice',
          'standard' : 'aiml b' }
 
+# The environment variable naming a brain to load at startup: a saved bot
+# state, or a db as accepted by %learn
+PRELOAD_ENV = 'AIMLBOT_PRELOAD'
+
+# The environment variable naming the pattern matcher for new bots
+MATCHER_ENV = 'AIMLBOT_MATCHER'
+
+# The environment variables setting the limits of the session store of new
+# bots: bot option, variable and type
+SESSION_ENV = ( ('max_sessions', 'AIMLBOT_MAX_SESSIONS', int),
+                ('session_ttl', 'AIMLBOT_SESSION_TTL', float),
+                ('session_file', 'AIMLBOT_SESSION_FILE', str) )
+
+
+# A session tag at the start of a %batch input line
+BATCH_SESSION = re.compile( r'\[([^\]\s]+)\]\s*' )
+
 
 # -----------------------------------------------------------------------
 
@@ -29,19 +63,31 @@ LOAD = { 'alice' : 'alice',
 magics = { 
     '%lsmagics' : [ '', 'list all magics'], 
     '%help' : [ '', 'show general help' ],
-    '%learn' : [ 'alice | standard | <dbdirectory> | <xml-file>',
-                 'learn an AIML db' ],
-    '%forget' : [ '', 'reset the bot' ],
+    '%learn' : [ 'alice | standard | <dbdirectory> | <xml-file> [workers=<n>] [parser=etree|sax]',
+                 'learn an AIML db (parsing files with <n> processes, and the given XML parser), in the background' ],
+    '%forget' : [ '[matcher=compiled|pyaiml]', 'reset the bot (optionally changing its pattern matcher)' ],
     '%aiml' : [ '', 'add additional AIML rules' ],
     '%show size' : [ '', 'show the number of categories loaded in the bot' ], 
     '%show session' : [ '', 'show the predicates defined in the session' ],
+    '%show sessions' : [ '', 'show the number of sessions in memory, spilled to disk and loaded but not used yet' ],
     '%show bot' : [ '', 'show the defined bot predicates' ],
+    '%show cache' : [ '', 'show the response cache statistics' ],
+    '%show srai' : [ '', 'show the number of <srai> hops avoided (resolved in advance, with the compiled matcher, or memoized)' ],
+    '%show memory' : [ '', 'show the memory used by the brain' ],
+    '%show sources' : [ '[<filter>]', 'show the categories learnt from each cell or file' ],
+    '%cache' : [ 'show | clear', 'show or clear the cache of parsed AIML files' ],
     '%setp' : [ '[bot] <name> <value>','set a predicate, or a bot predicate'],
-    '%save' : [ '<name> [no* ..]','save bot state to disk'],
-    '%load' : [ '<name> [no* ..]','load bot state from disk'],
+    '%save' : [ '<name> [no* ..] [allsessions] [compression=stored|deflate|lzma]','save bot state to disk (with allsessions, all the sessions and their histories)'],
+    '%load' : [ '<name> [no* ..]','load bot state from disk, in the background'],
     '%record' : [ '(on | off | save <name>)','record & save AIML cells'],
     '%subs' : [ '(<name> [reset] | default)','set substitution strings'],
-    '%log' : [ '<loglevel>','set log level'],
+    '%log' : [ '[<logger>] <loglevel>','set log level (of the kernel, or of a logger: a kernel module or any other one)'],
+    '%profile' : [ 'on | off | reset | show [<n>]',
+                   'profile category usage, element timings and slowest inputs (show the top <n>)' ],
+    '%trace' : [ '[on [sample=<rate>] [size=<n>] [session=<id>,..] [input=<regex>] [elements=<name>,..] | off | show [<n>] | export <file> | clear]',
+                 'trace the input in the cell, or start/stop tracing all requests, show the last <n> traced, or export them as JSON Lines' ],
+    '%batch' : [ '[<file>] [session=<name>] [workers=<n>]',
+                 'respond to the inputs in the cell (or file), one per line ("[<session>] <input>" to set the session of a line)' ],
 }
 
 
@@ -67,6 +113,8 @@ defined in it.
 Once loaded, you can start chatting with the bot. 
 
 New databases can be added by additional "%learn" commands.
+They are learnt in the background: chat cells wait until they
+finish, and interrupting the kernel cancels them.
 
 Use "%lsmagic" to see all the available magics.
 """
@@ -127,6 +175,96 @@ def token_at_cursor( code, pos=0 ):
     return code[start:end], start
 
 
+def db_directory( name ):
+    """
+    Find the directory of an AIML db: a standard one (alice, standard) or
+    a directory containing a startup file
+    """
+    if name in ('alice','standard'):
+        import aiml
+        return os.path.join( os.path.dirname(aiml.__file__), 'botdata', name )
+    elif os.path.isdir( name ):
+        if not os.path.isfile( os.path.join(name,'startup.xml') ):
+            raise KrnlException('Error: missing startup file in "{}"',name)
+        return name
+    raise KrnlException( 'unimplemented learn for "{}"', name )
+
+
+def learn_db( bot, name, dbdir ):
+    """
+    Learn an AIML db: its startup file, plus (for the standard dbs) the
+    load command that learns the rest of the files. File names in the db
+    are taken from its directory (without changing the current directory,
+    since this runs in a background thread)
+    """
+    log = logging.getLogger( __name__ )
+    prev = bot.set_learn_dir( dbdir )
+    try:
+        log.info( ' find db in: %s',dbdir)
+        log.info( ' learn startup.xml' )
+        bot.learn( 'startup.xml' )
+        if LOAD.get(name ):
+            log.info( ' load '+ LOAD[name] )
+            bot.respond( 'load ' + LOAD[name] )
+    finally:
+        bot.set_learn_dir( prev )
+
+
+def session_options():
+    """
+    Return the session store options for a new bot set in the environment,
+    as a dict of AimlBot keyword arguments
+    """
+    opts = {}
+    for name, var, conv in SESSION_ENV:
+        value = os.environ.get( var )
+        if not value:
+            continue
+        try:
+            opts[name] = conv( value )
+        except ValueError:
+            logging.getLogger( __name__ ).warn( "invalid %s value: %s",
+                                                var, value )
+    return opts
+
+
+def new_bot():
+    """
+    Create an empty bot, using the pattern matcher and the session store
+    limits set in the environment
+    """
+    from .aimlbot import AimlBot, DEFAULT_MATCHER, pyaiml_version
+    matcher = os.environ.get( MATCHER_ENV ) or DEFAULT_MATCHER
+    logging.getLogger( __name__ ).info( "Creating bot <python-aiml %s>, %s matcher",
+                                        pyaiml_version, matcher )
+    return AimlBot( learn_cache=True, matcher=matcher, **session_options() )
+
+
+def preload_brain( name ):
+    """
+    Create a bot and load a brain into it: a saved bot state (a .bot, .zip
+    or .ini file) or an AIML db or file. Run in the preload thread
+      @return (tuple): the bot, the elapsed seconds and the error (if any)
+    """
+    start = time.time()
+    bot = new_bot()
+    # Nothing must be printed, since stdout is sent to the frontend
+    bot.verbose( False )
+    try:
+        if name.endswith( ('.bot','.zip','.ini') ):
+            bot.load( name )
+        elif name.endswith('.xml') or name.endswith('aiml'):
+            bot.learn( name )
+        else:
+            learn_db( bot, name, db_directory(name) )
+        err = None
+    except Exception as e:
+        err = e
+    finally:
+        bot.verbose( True )
+    return bot, time.time() - start, err
+
+
 
 # -----------------------------------------------------------------------
 
@@ -162,25 +300,145 @@ class AimlBotKernel(Kernel):
         Initialize the object
         """
         # Define logging status before calling parent constructor
-        set_logging( level='WARN' )
+        set_logging( level='WARN', threaded=True )
         self._klog = logging.getLogger( __name__ )
-        self._klog.warn("Starting kernel %s <python-aiml %s> <Python %s>",
-                        __version__, pyaiml_version, sys.version)
+        self._klog.warn("Starting kernel %s <Python %s>",
+                        __version__, sys.version)
         # Start base kernel
         super(AimlBotKernel, self).__init__(*args, **kwargs)
         # Redirect stdout, so that we send AIML messages to the notebook
+        # (coalescing the writes into fewer messages)
+        self._stdout = StdoutForwarder( self._send_stream )
         try:
             sys.stdout.write = self._send_stdout
+            sys.stdout.flush = self._stdout.flush
         except:
             self._klog.warn( "can't redirect stdout" )
-        # Start the AIML kernel
-        self.bot = AimlBot()
+        # The AIML kernel, created when first used (or by the preload)
+        self._bot = None
+        # The job changing the brain in the background (if any)
+        self._job = None
+        self._preload = None
+        name = os.environ.get( PRELOAD_ENV )
+        if name:
+            self._klog.info( 'preloading brain: %s', name )
+            out = []
+            thread = threading.Thread( name='aimlbot-preload',
+                        target=lambda : out.append(preload_brain(name)) )
+            thread.daemon = True
+            self._preload = name, thread, out
+            thread.start()
+        # The id of the notebook cell being executed (if the frontend sends it)
+        self._cell_id = None
+
+
+    @property
+    def bot( self ):
+        """
+        The AIML kernel. If it is being preloaded, or a job is changing its
+        brain, wait for it
+        """
+        if self._job is not None:
+            self._wait_job()
+        elif self._bot is None:
+            if self._preload is not None:
+                self._wait_preload()
+            else:
+                self._bot = new_bot()
+        return self._bot
+
+
+    def _wait_preload( self ):
+        """
+        Wait for the preload thread to finish, take its bot and report the
+        result to the frontend
+        """
+        name, thread, out = self._preload
+        self._preload = None
+        if thread.is_alive():
+            self._send( ("Waiting for the brain preload: '{}'", name), 'ctrl' )
+            thread.join()
+        bot, elapsed, err = out[0] if out else (None, 0, 'preload failed')
+        if err is None:
+            self._send( ("Preloaded brain '{}': {} categories ({:.2f}s)",
+                         name, bot.numCategories(), elapsed), 'ctrl' )
+        else:
+            self._send( KrnlException("Can't preload brain '{}': {!s}",
+                                      name, err), status='error' )
+        self._bot = bot or new_bot()
+
+
+    def _wait_job( self ):
+        """
+        Wait for the background job to finish (an interrupt cancels it)
+        """
+        job = self._job
+        if job.running():
+            self._send( ("Waiting for {}", job.name), 'ctrl' )
+            job.wait()
+        self._job = None
+
+
+    def start_job( self, name, func ):
+        """
+        Run an operation that changes the brain as a background job, which
+        reports its progress and result to the current cell
+          @param name (str): a description of the operation
+          @param func (callable): the operation, called with the bot. It
+            returns the final message, as a (data, status) tuple
+        """
+        bot = self.bot
+        parent = self._parent()
+        self._job = BrainJob( name, bot, func,
+                              lambda data, status :
+                                  self._send( data, status, parent=parent ),
+                              lambda txt : self._send_stdout( txt, parent ) )
+        self._job.start()
+
+
+    def _interrupt_job( self, signum, frame ):
+        """
+        The interrupt handler between requests: cancel the running job
+        """
+        job = self._job
+        if job is not None and job.running():
+            self._klog.info( 'interrupt: cancelling %s', job.name )
+            job.cancel()
+
+
+    def post_handler_hook( self ):
+        """
+        Restore the interrupt handler after a request. While a job runs,
+        use one that cancels it, since the kernel ignores interrupts
+        received between requests
+        """
+        super(AimlBotKernel, self).post_handler_hook()
+        if self._job is not None and self._job.running():
+            try:
+                signal.signal( signal.SIGINT, self._interrupt_job )
+            except ValueError:
+                pass        # (not in the main thread)
 
 
     # -----------------------------------------------------------------
 
 
-    def _send( self, data, status='ok', silent=False ):
+    def _publish( self, msg_type, content, parent=None ):
+        """
+        Send an iopub message, as a response to the current request or to
+        the given one
+        """
+        if msg_type != 'stream':
+            # (keep the order of the output)
+            self._stdout.flush()
+        if parent is None:
+            self.send_response( self.iopub_socket, msg_type, content )
+        else:
+            self.session.send( self.iopub_socket, msg_type, content, parent,
+                               ident=self._topic(msg_type) )
+
+
+    def _send( self, data, status='ok', silent=False, parent=None ):
         """
         Send a response to the frontend and return an execute message
         """
@@ -190,7 +448,7 @@ class AimlBotKernel(Kernel):
             # Format the data
             data = data_msg( data, mtype=status )
             # Send the data to the frontend
-            self.send_response( self.iopub_socket, 'display_data', data )
+            self._publish( 'display_data', data, parent )
 
         # Result message
         return {'status': 'error' if status == 'error' else 'ok',
@@ -201,47 +459,76 @@ class AimlBotKernel(Kernel):
                }
 
 
-    def _send_stdout(self, txt):
+    def _send_stdout(self, txt, parent=None):
         """
-        Send to frontend the data received as stdout
+        Send to frontend the data received as stdout (for the current
+        request, or the given one). It is buffered, and sent by _send_stream()
+        """
+        self._stdout.write( txt, parent or self._parent() )
+
+
+    def _send_stream( self, txt, parent ):
+        """
+        Send a block of stdout data to the frontend
         """
         stream_content = { 'name': 'stdout', 'text': txt, 'metadata': {} }
         self._klog.debug('stdout: %s' % txt)
-        self.send_response(self.iopub_socket, 'stream', stream_content)
+        self._publish( 'stream', stream_content, parent )
 
 
-    def learn_file( self, name ):
+    def learn_file( self, name, workers=1, parser=None ):
         """
-        Load rules from AIML files
+        Load rules from AIML files, in a background job
         """
         # A direct file to load
         if name.endswith('.xml') or name.endswith('aiml'):
             self._send( ('Learning patterns in "{}"', name), 'ctrl' )
-            self.bot.learn( name )
-            return
-
-        # A directory containing: AIML files + a startup file
-        if name in ('alice','standard'):
-            dbdir = os.path.join( os.path.dirname(aiml.__file__), 'botdata', name )
-        elif os.path.isdir( name ):
-            if not os.path.isfile( os.path.join(name,'startup.xml') ):
-                raise KrnlException('Error: missing startup file in "{}"',name)
+            learn = lambda bot : bot.learn( name )
         else:
-            raise KrnlException( 'unimplemented learn for "{}"', name )
-        
-        self._send( ("Learning database: '{}'", name), status='ctrl' )
-        prev = os.getcwd()
-        try:
-            self._klog.info( ' find db in: %s',dbdir)
-            os.chdir( dbdir )
-            self._klog.info( ' learn startup.xml' )
-            self.bot.learn( 'startup.xml' )
-            if LOAD.get(name ):
-                self._klog.info( ' load '+ LOAD[name] )
-                self._send( "Loading patterns", 'ctrl' )
-                self.bot.respond( 'load ' + LOAD[name] )
-        finally:
-            os.chdir( prev )
+            # A directory containing: AIML files + a startup file
+            dbdir = db_directory( name )
+            self._send( ("Learning database: '{}'", name), status='ctrl' )
+            learn = lambda bot : learn_db( bot, name, dbdir )
+
+        def job( bot ):
+            before = bot.numCategories()
+            prev = bot.set_workers( workers )
+            prev_parser = bot.set_parser( parser ) if parser else None
+            bot.learn_log( clear=True )
+            start = time.time()
+            try:
+                learn( bot )
+            finally:
+                bot.set_workers( prev )
+                if prev_parser:
+                    bot.set_parser( prev_parser )
+            elapsed = time.time() - start
+            msg = [ u'Loaded {} new patterns'.format(bot.numCategories()-before) ]
+            log = bot.learn_log( clear=True )
+            if log:
+                msg.append( u'  {:32} {:>10} {:>8} {:>8}'.format('file',
+                                            'categories', 'parse', 'merge') )
+                msg += [ u'  {:32} {:10} {:7.2f}s {:7.2f}s'.format(
+                    os.path.basename(f), n, p, m) for f, n, p, m in log ]
+                msg.append( u'{} files, {} worker(s): {:.2f}s'.format(
+                    len(log), workers, elapsed) )
+            return u'\n'.join(msg), 'ctrl'
+
+        self.start_job( u'learn {}'.format(name), job )
+
+
+    def load_state( self, name, options ):
+        """
+        Load a saved bot state, in a background job
+        """
+        def job( bot ):
+            try:
+                return bot.load( name, options ), 'ctrl'
+            except IOError as e:
+                raise KrnlException( "can't load {}: {!s}", name, e )
+
+        self._send( ("Loading bot state: '{}'", name), 'ctrl' )
+        self.start_job( u'load {}'.format(name), job )
 
 
     def learn_cell( self, lines, topic=None ):
@@ -258,7 +545,150 @@ class AimlBotKernel(Kernel):
         fmt = 'aiml' if lines[0].startswith('<') else 'text'
         # Learn rules from the buffer
         opts = { 'topic' : topic, 'clean_pattern' : True }
-        self.bot.learn_buffer( lines, fmt, opts )
+        # Tag the rules with the cell they come from, so that re-executing
+        # the cell replaces them
+        source = u'cell:' + self._cell_id if self._cell_id else None
+        return self.bot.learn_buffer( lines, fmt, opts, source )
+
+
+    def batch( self, kw, lines ):
+        """
+        Respond to a batch of inputs and build a table with the results
+          @param kw (list): the magic line arguments
+          @param lines (list): the rest of the cell
+        """
+        session, workers, fname = None, 1, None
+        for opt in kw:
+            name, sep, value = opt.partition( '=' )
+            if not sep and fname is None:
+                fname = opt
+            elif name == 'session' and value:
+                session = value
+            elif name == 'workers' and value.isdigit() and int(value) > 0:
+                workers = int( value )
+            else:
+                raise KrnlException( 'invalid batch option: {}', opt )
+        if fname is not None:
+            try:
+                with io.open( fname, encoding='utf-8' ) as f:
+                    lines = [ l.strip() for l in f ]
+            except IOError as e:
+                raise KrnlException( "can't read {}: {!s}", fname, e )
+
+        inputs = []
+        for l in lines:
+            m = BATCH_SESSION.match( l )
+            if m:
+                inputs.append( (m.group(1), l[m.end():]) )
+            elif l:
+                inputs.append( l if session is None else (session, l) )
+        if not inputs:
+            raise KrnlException( 'no inputs in batch' )
+
+        start = time.time()
+        rows = self.bot.respond_many( inputs, workers=workers )
+        elapsed = time.time() - start
+
+        clip = lambda s, n : s if len(s) <= n else s[:n-3] + u'...'
+        sessions = set( r[0] for r in rows )
+        fmt = u'{:>4} {:30} {:40} {}'
+        if len(sessions) > 1:
+            fmt = u'{:>4} {:10} {:30} {:40} {}'
+        msg = [ fmt.format( *([u'#'] + [u'session']*(len(sessions) > 1) +
+                              [u'input', u'response', u'pattern']) ) ]
+        for n, (sid, text, response, matched) in enumerate( rows, 1 ):
+            pats = u' + '.join(
+                u'-' if k is None else
+                k[0] if k[1:] in (('*','*'), ('','')) else u' | '.join(k)
+                for k in matched )
+            cols = [ n ] + [ clip(sid,10) ]*(len(sessions) > 1)
+            msg.append( fmt.format( *(cols + [ clip(text,30),
+                                               clip(response.replace(u'\n',u' '),40),
+                                               pats ]) ) )
+        msg.append( u'{} inputs, {} session(s), {} worker(s): {:.2f}s ({:.1f} inputs/s)'.format(
+            len(rows), len(sessions), min(workers,len(sessions)), elapsed,
+            len(rows)/elapsed if elapsed else 0 ) )
+        return u'\n'.join( msg )
+
+
+    def trace_options( self, kw ):
+        """
+        Parse the options for %trace on
+          @param kw (list): the magic line arguments after "on"
+          @return (dict): keyword arguments for AimlBot.set_tracing()
+        """
+        opts = {}
+        for opt in kw:
+            name, sep, value = opt.partition( '=' )
+            try:
+                if name == 'sample' and sep:
+                    opts['sample'] = float( value )
+                elif name == 'size' and sep:
+                    opts['size'] = int( value )
+                elif name in ('session', 'elements') and value:
+                    opts[name if name == 'elements' else 'sessions'] = \
+                        value.split( ',' )
+                elif name == 'input' and value:
+                    opts['inputs'] = re.compile( value ).pattern
+                else:
+                    raise ValueError( opt )
+            except (ValueError, re.error):
+                raise KrnlException( 'invalid trace option: {}', opt )
+        return opts
+
+
+    def trace_report( self, last ):
+        """
+        Format the events of the last traced requests as text
+        """
+        msg = [ u'Tracing: ' + u', '.join( u'{} = {}'.format(k,v)
+                                           for k, v in self.bot.trace_stats() ) ]
+        for r in self.bot.trace_records( last ):
+            indent = u'  ' * (r['depth'] + 1)
+            ms = u' {:.3f} ms'.format( 1000*r['duration'] ) \
+                 if r.get('duration') is not None else u''
+            if r['event'] == 'request':
+                msg += [ u'', u'#{} [{}] {}{}'.format( r['request'],
+                                                      r['session'],
+                                                      r['input'], ms ) ]
+            elif r['event'] == 'input':
+                msg.append( u'{}INPUT=[{}] THAT=[{}] TOPIC=[{}]'.format(
+                    indent, r['input'], r['that'], r['topic']) )
+            elif r['event'] == 'match':
+                msg.append( u'{}MATCH: {}'.format( indent,
+                    u' | '.join(r['pattern']) if r['pattern'] else
+                    u'?' if r['matched'] else u'(no match)') )
+            elif r['event'] == 'cache':
+                msg.append( u'{}(response from cache)'.format(indent) )
+            else:
+                msg.append( u'{}{}<{}>{}'.format( indent, u'  '*r['level'],
+                                                  r['element'], ms ) )
+        return u'\n'.join( msg )
+
+
+    def profile_report( self, top ):
+        """
+        Format the bot profiling results as text tables
+        """
+        summary, categories, elements, inputs = self.bot.profile_stats( top )
+        msg = [ u'Profile: ' + u', '.join( u'{} = {}'.format(k,v)
+                                           for k, v in summary ) ]
+        if categories:
+            msg += [ u'', u'{:>8}  {}'.format('uses', 'category') ]
+            msg += [ u'{:8}  {}'.format( n, u'?' if k is None else
+                                         u' | '.join(k) )
+                     for n, k in categories ]
+        if elements:
+            msg += [ u'', u'{:12} {:>8} {:>10} {:>10} {:>10}'.format(
+                'element', 'count', 'total ms', 'mean ms', 'max ms') ]
+            msg += [ u'{:12} {:8} {:10.2f} {:10.3f} {:10.2f}'.format(
+                name, n, 1000*tot, 1000*tot/n, 1000*mx)
+                     for name, n, tot, mx in elements ]
+        if inputs:
+            msg += [ u'', u'{:>8}  {:10} {}'.format('ms', 'session', 'input') ]
+            msg += [ u'{:8.2f}  {:10} {}'.format( 1000*e, s, i )
+                     for e, i, s in inputs ]
+        return u'\n'.join( msg )
 
 
     def magic( self, lines ):
@@ -285,16 +715,21 @@ class AimlBotKernel(Kernel):
             
             if len(kw) < 2:
                 raise KrnlException( 'missing filename for save operation' )
-            return self.bot.save(kw[1],kw[2:]), 'ctrl'
+            options, compression = [], 'stored'
+            for opt in kw[2:]:
+                name, sep, value = opt.partition( '=' )
+                if name == 'compression' and sep:
+                    compression = value
+                else:
+                    options.append( opt )
+            return self.bot.save( kw[1], options, compression ), 'ctrl'
 
         elif magic == "load":
             
             if len(kw) < 2:
                 raise KrnlException( 'missing filename for load operation' )
-            try:
-                return self.bot.load(kw[1],kw[2:]), 'ctrl'
-            except IOError as e:
-                raise KrnlException( "can't load {}: {!s}", kw[1], e )
+            self.load_state( kw[1], kw[2:] )
+            return None, 'ctrl'
 
         elif magic == "record":
 
@@ -317,18 +752,29 @@ class AimlBotKernel(Kernel):
 
         elif magic == "learn":
 
-            before = self.bot.numCategories()
             if len(kw) < 2:
                 raise KrnlException( 'missing learn param' )
-            self.learn_file( kw[1] ), 'ctrl'
-            msg = 'Loaded {} new patterns', self.bot.numCategories() - before
-            return msg, 'ctrl'
+            workers, parser = 1, None
+            for opt in kw[2:]:
+                name, _, value = opt.partition( '=' )
+                if name == 'workers' and value.isdigit() and int(value) > 0:
+                    workers = int( value )
+                elif name == 'parser' and value in ENGINES:
+                    parser = value
+                else:
+                    raise KrnlException( 'invalid learn option: {}', opt )
+            self.learn_file( kw[1], workers, parser )
+            return None, 'ctrl'
 
         elif magic == "aiml":
 
-            before = self.bot.numCategories()
-            self.learn_cell( lines[1:], kw[1] if len(kw)>1 else None )
-            msg = 'Loaded {} new patterns', self.bot.numCategories() - before
+            added, replaced, removed = self.learn_cell( lines[1:],
+                                                kw[1] if len(kw)>1 else None )
+            if replaced or removed:
+                msg = ( 'Loaded {} new patterns ({} replaced, {} removed)',
+                        added, replaced, removed )
+            else:
+                msg = 'Loaded {} new patterns', added
             return msg, 'ctrl'
 
         elif magic == "setp":
@@ -361,8 +807,17 @@ class AimlBotKernel(Kernel):
 
         elif magic in ("forget","reset"):
 
-            self.bot.resetBrain()
-            return 'Resetting bot brain', 'ctrl'
+            matcher = None
+            for opt in kw[1:]:
+                name, sep, value = opt.partition( '=' )
+                if name != 'matcher' or not sep:
+                    raise KrnlException( 'invalid forget option: {}', opt )
+                matcher = value
+            self.bot.resetBrain( matcher )
+            msg = 'Resetting bot brain'
+            if matcher:
+                msg += ', {} matcher'.format( matcher )
+            return msg, 'ctrl'
 
         elif magic == "show":
 
@@ -371,14 +826,42 @@ class AimlBotKernel(Kernel):
             if kw[1].startswith('size'):
                 msg = "Number of loaded categories: {}",self.bot.numCategories()
                 return msg, 'info'
+            elif kw[1] == 'sessions':
+                fields = ( u'  {} = {}'.format(k,v)
+                           for k,v in self.bot.session_stats() )
+                return "Session store:\n" + "\n".join(fields), 'info'
             elif kw[1].startswith('ses'):
-                fields = ( u'  {} = {}'.format(k,v) 
-                           for k,v in self.bot.predicates() )
+                fields = ( u'  {} = {}'.format(k,v)
+                           for k,v in sorted(self.bot.predicates()) )
                 return "Session fields:\n" + "\n".join(fields), 'info'
             elif kw[1].startswith('bot'):
-                fields = ( u'  {} = {}'.format(k,v) 
-                           for k,v in self.bot.predicates(bot=True) )
+                fields = ( u'  {} = {}'.format(k,v)
+                           for k,v in sorted(self.bot.predicates(bot=True)) )
                 return "Bot predicates:\n" + "\n".join(fields), 'info'
+            elif kw[1].startswith('cache'):
+                fields = ( u'  {} = {}'.format(k,v)
+                           for k,v in self.bot.cache_stats() )
+                return "Response cache:\n" + "\n".join(fields), 'info'
+            elif kw[1].startswith('srai'):
+                fields = ( u'  {} = {}'.format(k,v)
+                           for k,v in self.bot.srai_stats() )
+                return "<srai> hops avoided:\n" + "\n".join(fields), 'info'
+            elif kw[1].startswith('mem'):
+                fields = ( u'  {} = {}'.format(k,v)
+                           for k,v in self.bot.memory_stats() )
+                return "Brain memory:\n" + "\n".join(fields), 'info'
+            elif kw[1].startswith('source'):
+                flt = kw[2] if len(kw) > 2 else None
+                out = []
+                for src, keys in self.bot.sources():
+                    if flt is None:
+                        out.append( u'  {} : {}'.format(src, len(keys)) )
+                    elif flt in src:
+                        out.append( u'  {} ({}):'.format(src, len(keys)) )
+                        out += [ u'    {} | {} | {}'.format(*k) for k in keys ]
+                if not out:
+                    return "No category sources", 'info'
+                return u"Category sources:\n" + u"\n".join(out), 'info'
             else:
                 raise KrnlException( 'unknown show magic: {}', kw[1] )
 
@@ -386,18 +869,68 @@ class AimlBotKernel(Kernel):
 
             if len(kw) < 2:
                 raise KrnlException( 'missing log param' )
+            name = kw[1] if len(kw) > 2 else None
+            l = kw[-1].upper()
             try:
-                l = kw[1].upper()
-                parent_logger = logging.getLogger( __name__.rsplit('.',1)[0] )
-                parent_logger.setLevel( l )
-                return ("Logging set to {}\nLogfile: {}", l, logfilename()), 'ctrl'
+                name = set_level( l, name )
+                return ("Logging for {} set to {}\nLogfile: {}", name, l,
+                        logfilename()), 'ctrl'
             except ValueError:
-                raise KrnlException( 'unknown log level: {}', kw[1] )
+                raise KrnlException( 'unknown log level: {}', kw[-1] )
+
+        elif magic == 'profile':
+
+            if len(kw) < 2:
+                raise KrnlException( 'missing profile param' )
+            if kw[1] in ('on', 'off'):
+                self.bot.set_profiling( kw[1] == 'on' )
+                return ('Profiling: {}', kw[1]), 'ctrl'
+            elif kw[1] == 'reset':
+                self.bot.reset_profile()
+                return 'Profiling counters reset', 'ctrl'
+            elif kw[1] == 'show':
+                top = int(kw[2]) if len(kw) > 2 and kw[2].isdigit() else 10
+                return self.profile_report( top ), 'info'
+            raise KrnlException( 'unknown profile command: {}', kw[1] )
+
+        elif magic == 'cache':
+
+            if len(kw) < 2 or kw[1] == 'show':
+                fields = ( u'  {} = {}'.format(k,v)
+                           for k,v in self.bot.learn_cache_stats() )
+                return "Learn cache:\n" + "\n".join(fields), 'info'
+            elif kw[1] == 'clear':
+                n = self.bot.clear_learn_cache()
+                return ('Learn cache cleared: {} entries removed', n), 'ctrl'
+            raise KrnlException( 'unknown cache command: {}', kw[1] )
+
+        elif magic == 'batch':
+
+            return self.batch( kw[1:], lines[1:] ), 'info'
 
         elif magic == 'trace':
 
-            res = self.bot.trace( u'\n'.join(lines[1:]) )
-            return res, '_MULTI_'
+            if len(kw) < 2:
+                res = self.bot.trace( u'\n'.join(lines[1:]) )
+                return res, '_MULTI_'
+            elif kw[1] == 'on':
+                self.bot.set_tracing( True, **self.trace_options(kw[2:]) )
+                return 'Tracing: on', 'ctrl'
+            elif kw[1] == 'off':
+                self.bot.set_tracing( False )
+                return 'Tracing: off', 'ctrl'
+            elif kw[1] == 'show':
+                last = int(kw[2]) if len(kw) > 2 and kw[2].isdigit() else 5
+                return self.trace_report( last ), 'info'
+            elif kw[1] == 'export':
+                if len(kw) < 3:
+                    raise KrnlException( 'missing filename for trace export' )
+                n = self.bot.export_trace( kw[2] )
+                return ('Exported {} trace events to "{}"', n, kw[2]), 'ctrl'
+            elif kw[1] == 'clear':
+                self.bot.clear_trace()
+                return 'Trace buffer cleared', 'ctrl'
+            raise KrnlException( 'unknown trace command: {}', kw[1] )
 
         else:
             raise KrnlException( 'unknown magic: {}', magic )
@@ -423,11 +956,32 @@ class AimlBotKernel(Kernel):
 
     # -----------------------------------------------------------------
 
+    def _parent( self ):
+        """
+        Get the header of the request being processed
+        """
+        return ( self.get_parent() if hasattr(self,'get_parent')
+                 else self._parent_header )
+
+
+    def _parent_cell_id( self ):
+        """
+        Get the cell id from the metadata of the current execute request
+        (for kernel versions that do not pass it to do_execute)
+        """
+        try:
+            return self._parent().get('metadata',{}).get('cellId')
+        except Exception:
+            return None
+
+
     def do_execute( self, code, silent, store_history=True,
-                    user_expressions=None, allow_stdin=False ):
+                    user_expressions=None, allow_stdin=False, cell_id=None,
+                    **kwargs ):
         """
         Jupyter kernel execute message
         """
+        self._cell_id = cell_id or self._parent_cell_id()
         try:
             return self._inner_execute( code, silent )
         except KrnlException as e:
@@ -438,6 +992,13 @@ class AimlBotKernel(Kernel):
         except Exception as e:
             #raise
             return self._send( KrnlException(e), silent=silent, status='error' )
+        finally:
+            self._stdout.flush()
+            writes, msgs, chars, secs = self._stdout.counts( clear=True )
+            if writes:
+                self._klog.info( 'stdout: %d writes sent in %d messages '
+                                 '(%d chars, %.2f ms)', writes, msgs, chars,
+                                 1000*secs )
             
 
     # -----------------------------------------------------------------
@@ -0,0 +1,175 @@
+"""
+A content-addressed cache of parsed AIML files.
+
+Parsing is most of the cost of learning an AIML file, and the same files
+(e.g. the ALICE set) are learnt again in every kernel session. The cache
+keeps the categories parsed from each file in a local directory, under a
+hash of the file contents plus the parsing options, so that an unchanged
+file is loaded with a single marshal read. A modified file gets a new key;
+its old entry is simply no longer used (until the cache is cleared).
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import os.path
+import io
+import gc
+import glob
+import hashlib
+import marshal
+import time
+
+from .tplpool import format_size
+
+
+# Increase when the parsers change the structure of the categories they
+# produce, so that entries from a previous version are not used
+CACHE_VERSION = 1
+
+# Extension of the cache entries
+_SUFFIX = '.cat'
+
+
+def default_cache_dir():
+    """
+    Return the default cache directory: \c AIMLBOT_CACHE_DIR if defined,
+    otherwise \c aimlbotkernel in the user cache directory
+    """
+    d = os.environ.get( 'AIMLBOT_CACHE_DIR' )
+    if d:
+        return d
+    base = os.environ.get( 'XDG_CACHE_HOME' ) or \
+           os.path.join( os.path.expanduser('~'), '.cache' )
+    return os.path.join( base, 'aimlbotkernel' )
+
+
+class LearnCache( object ):
+    """
+    A directory of parsed AIML files, indexed by content hash
+    """
+
+    def __init__( self, directory=None ):
+        self.directory = directory or default_cache_dir()
+        self.hits = self.misses = self.errors = 0
+
+
+    def key( self, filename, *options ):
+        """
+        Compute the cache key for a file: a hash of its contents and of
+        the options it is parsed with
+          @return (str): the key, or None if the file cannot be read
+        """
+        h = hashlib.sha1( u'{}:{}'.format(CACHE_VERSION,
+                                          u':'.join(options)).encode('utf-8') )
+        try:
+            with io.open( filename, 'rb' ) as f:
+                for block in iter( lambda : f.read(1 << 20), b'' ):
+                    h.update( block )
+        except (IOError, OSError):
+            return None
+        return h.hexdigest()
+
+
+    def __contains__( self, key ):
+        """
+        Check if there is an entry for a key (a miss if there is not)
+        """
+        found = key is not None and os.path.isfile( self._path(key) )
+        if not found:
+            self.misses += 1
+        return found
+
+
+    def get( self, key ):
+        """
+        Fetch the categories stored under a key
+          @return (dict): the categories, or None if not in the cache
+        """
+        if key is not None:
+            # (marshal.load() reads the file in small chunks, and decoding
+            # creates many containers that the collector would scan in vain)
+            enabled = gc.isenabled()
+            try:
+                with io.open( self._path(key), 'rb' ) as f:
+                    data = f.read()
+                gc.disable()
+                categories = marshal.loads( data )
+                self.hits += 1
+                return categories
+            except (IOError, OSError):
+                pass
+            except (EOFError, ValueError, TypeError):
+                # a damaged entry: it will be overwritten
+                self.errors += 1
+            finally:
+                if enabled:
+                    gc.enable()
+        self.misses += 1
+        return None
+
+
+    def put( self, key, categories ):
+        """
+        Store the categories parsed from a file. The entry is written under
+        a temporary name and then renamed, so that concurrent kernels never
+        read a partial entry. Failures (e.g. a read-only directory) are
+        ignored: the cache is only an optimization
+        """
+        if key is None:
+            return
+        path = self._path( key )
+        tmpname = '{}.{}.tmp'.format( path, os.getpid() )
+        try:
+            if not os.path.isdir( self.directory ):
+                os.makedirs( self.directory )
+            with io.open( tmpname, 'wb' ) as f:
+                f.write( marshal.dumps(categories) )
+            getattr( os, 'replace', os.rename )( tmpname, path )
+        except (IOError, OSError, ValueError):
+            self.errors += 1
+            try:
+                os.unlink( tmpname )
+            except OSError:
+                pass
+
+
+    def _path( self, key ):
+        return os.path.join( self.directory, key + _SUFFIX )
+
+
+    def _entries( self ):
+        return glob.glob( os.path.join(self.directory, '*' + _SUFFIX) )
+
+
+    def clear( self ):
+        """
+        Remove all the entries in the cache directory
+          @return (int): the number of entries removed
+        """
+        removed = 0
+        for path in self._entries():
+            try:
+                os.unlink( path )
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+
+    def stats( self ):
+        """
+        Return the cache statistics, as a list of (name, value) tuples
+        """
+        entries = self._entries()
+        size = sum( os.path.getsize(p) for p in entries )
+        oldest = min( os.path.getmtime(p) for p in entries ) if entries else None
+        return [ ('directory', self.directory),
+                 ('entries', len(entries)),
+                 ('size', format_size(size)),
+                 ('oldest entry', time.strftime('%Y-%m-%d %H:%M',
+                                                time.localtime(oldest))
+                                  if oldest else '-'),
+                 ('hits', self.hits),
+                 ('misses', self.misses),
+                 ('errors', self.errors) ]
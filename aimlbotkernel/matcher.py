@@ -0,0 +1,1256 @@
+"""
+A compiled, non-recursive replacement for the pyAIML PatternMgr.
+
+The stock PatternMgr keeps the brain as a tree of nested dicts keyed by word
+strings, and matches every input sentence through recursive backtracking.
+This module keeps the same information as a flat index:
+ * every word is interned into an integer id
+ * per-node data lives in parallel arrays indexed by node id: the children
+   reached through the \c _ and \c * wildcards, the bot name, the <that>
+   and <topic> separators, and the index of the node template
+ * regular word transitions are held in a single dict, keyed by the
+   combination of node id and word id
+ * pattern nodes whose only continuation is the "<that>*" + "<topic>*" tail
+   (which is the case for most categories) point directly to its template
+
+Matching walks that index iteratively, with an explicit stack of choice
+points, and keeps the AIML 1.0.1 priority order (\c _ first, then the word
+itself, then the bot name, then \c *, shortest wildcard match first) across
+the pattern, <that> and <topic> segments.
+
+It can also resolve an input in advance, without a <that> or <topic>: the
+result holds unless one of a (usually short) list of guard patterns
+matches the actual ones. This is used to shortcut constant <srai> elements.
+
+Brains are saved in a binary format that can be memory-mapped: the node
+tables as raw arrays, the word transitions and the vocabulary as open
+addressing hash tables, and each distinct template as a separate marshal
+blob (categories sharing a template object share the blob). A mapped
+brain is queried in place (templates are decoded on first use), so
+loading it costs the same whatever its size. It is copied into memory
+only when it is modified.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import io
+import re
+import sys
+import mmap
+import zlib
+import struct
+import marshal
+from array import array
+
+from aiml.PatternMgr import PatternMgr
+
+from .utils import atomic_write
+from .normalize import Normalizer
+from .tplpool import deep_size, format_size
+
+
+# Word ids reserved for special tokens
+_UNDERSCORE, _STAR, _BOT_NAME, _THAT, _TOPIC = range(5)
+
+# Bit shift used to combine a node id and a word id into an edge key
+_WSHIFT = 32
+
+# Header for brain files saved by this class, a mappable binary file: the
+# magic string, the version and the length of a marshal-encoded directory
+# that follows. Since version 3 a table maps template slots to template
+# blobs, so that shared templates are stored once
+BRAIN_MAGIC = b'AIMLBRN\x00'
+BRAIN_VERSION = 3
+_HEADER = struct.Struct( '<8sII' )
+
+# The node tables, in serialization order
+_TABLES = ( '_under', '_star', '_botn', '_that', '_topic', '_tmpl', '_tail',
+            '_fanout' )
+
+# Segment names, as used by star()
+_STARTYPE = { 'star' : 0, 'thatstar' : 1, 'topicstar' : 2 }
+
+
+def _tobytes( a ):
+    """Serialize an array (tostring() is the Python 2 name)"""
+    return a.tobytes() if hasattr(a,'tobytes') else a.tostring()
+
+
+def _frombytes( buf ):
+    """Rebuild an integer node array from its serialized form"""
+    a = array('i')
+    if hasattr(a,'frombytes'):
+        a.frombytes( buf )
+    else:
+        a.fromstring( buf )
+    return a
+
+
+def _intview( buf ):
+    """
+    Return an integer array view over a memoryview (in Python 2, which has
+    no memoryview.cast(), return a copy)
+    """
+    try:
+        return buf.cast( 'i' )
+    except AttributeError:
+        return _frombytes( buf.tobytes() )
+
+
+def _capacity( n ):
+    """Size for an open addressing hash table holding n entries"""
+    size = 8
+    while size < 2*n:
+        size *= 2
+    return size
+
+
+def _edge_hash( node, wid ):
+    """Hash function for the edges table in mapped brains"""
+    return (node * 2654435761) ^ (wid * 2246822519)
+
+
+def _word_hash( word ):
+    """Hash function (stable across processes) for an UTF-8 word"""
+    return zlib.crc32( word ) & 0xffffffff
+
+
+# -------------------------------------------------------------------------
+
+class _MappedEdges( object ):
+    """
+    The word transitions of a mapped brain: a read-only dict replacement
+    over an open addressing hash table with three columns (node, word id,
+    child node). Since probing the table is much slower than a dict lookup,
+    the results of the last lookups are kept in a dict
+    """
+
+    MEMO_SIZE = 65536
+
+    def __init__( self, node, word, child ):
+        self._node, self._word, self._child = node, word, child
+        self._mask = len(node) - 1
+        self._memo = {}
+
+    def _probe( self, key ):
+        """Find a key in the hash table, return its value or -1"""
+        node, wid = key >> _WSHIFT, key & 0xffffffff
+        nodes, words, mask = self._node, self._word, self._mask
+        i = _edge_hash( node, wid ) & mask
+        while nodes[i] >= 0:
+            if nodes[i] == node and words[i] == wid:
+                return self._child[i]
+            i = (i + 1) & mask
+        return -1
+
+    def get( self, key, default=None ):
+        child = self._memo.get( key )
+        if child is None:
+            if len(self._memo) >= self.MEMO_SIZE:
+                self._memo.clear()
+            child = self._memo[key] = self._probe( key )
+        return default if child < 0 else child
+
+    def __contains__( self, key ):
+        return self.get( key, -1 ) >= 0
+
+    def __len__( self ):
+        return sum( 1 for n in self._node if n >= 0 )
+
+    def items( self ):
+        nodes, words, child = self._node, self._word, self._child
+        return ( (nodes[i] << _WSHIFT | words[i], child[i])
+                 for i in range(len(nodes)) if nodes[i] >= 0 )
+
+
+class _MappedWords( object ):
+    """
+    The vocabulary of a mapped brain. Acts both as the word list and as the
+    word -> id dict; words added after mapping are kept in memory. As with
+    _MappedEdges, the results of the last lookups are kept in a dict
+    """
+
+    MEMO_SIZE = 65536
+
+    def __init__( self, offsets, data, slots ):
+        self._offsets, self._data, self._slots = offsets, data, slots
+        self._mask = len(slots) - 1
+        self._size = len(offsets) - 1
+        self._extra = []
+        self._extraId = {}
+        self._memo = {}
+
+    def get( self, word, default=None ):
+        wid = self._memo.get( word )
+        if wid is None:
+            if len(self._memo) >= self.MEMO_SIZE:
+                self._memo.clear()
+            wid = self._extraId.get( word )
+            if wid is None:
+                wid = self._probe( word )
+            self._memo[word] = wid
+        return default if wid < 0 else wid
+
+    def _probe( self, word ):
+        """Find a word in the hash table, return its id or -1"""
+        enc = word.encode( 'utf-8' )
+        offsets, data, slots, mask = self._offsets, self._data, self._slots, self._mask
+        i = _word_hash( enc ) & mask
+        while slots[i] >= 0:
+            wid = slots[i]
+            if data[offsets[wid]:offsets[wid+1]] == enc:
+                return wid
+            i = (i + 1) & mask
+        return -1
+
+    def __setitem__( self, word, wid ):
+        self._extraId[word] = wid
+        self._memo.pop( word, None )
+
+    def append( self, word ):
+        self._extra.append( word )
+
+    def __len__( self ):
+        return self._size + len(self._extra)
+
+    def __getitem__( self, wid ):
+        if wid >= self._size:
+            return self._extra[wid - self._size]
+        off = self._offsets
+        return self._data[off[wid]:off[wid+1]].tobytes().decode( 'utf-8' )
+
+    def __iter__( self ):
+        return ( self[n] for n in range(len(self)) )
+
+
+class _MappedTemplates( object ):
+    """
+    The templates of a mapped brain: a read-only list replacement that
+    decodes each template when first requested. Template slots are mapped
+    to blobs through a reference table, and slots sharing a blob get the
+    same template object
+    """
+
+    def __init__( self, offsets, data, refs ):
+        self._offsets, self._data, self._refs = offsets, data, refs
+        self._decoded = {}
+        self._blobs = {}
+
+    def blob( self, idx ):
+        """Return the index of the blob holding a template"""
+        return self._refs[idx]
+
+    def raw( self, idx ):
+        """Return the serialized template"""
+        b = self.blob( idx )
+        return self._data[self._offsets[b]:self._offsets[b+1]]
+
+    def __getitem__( self, idx ):
+        tem = self._decoded.get( idx )
+        if tem is None:
+            b = self.blob( idx )
+            tem = self._blobs.get( b )
+            if tem is None:
+                tem = self._blobs[b] = marshal.loads( self.raw(idx) )
+            self._decoded[idx] = tem
+        return tem
+
+    def __len__( self ):
+        return len(self._refs)
+
+    def __iter__( self ):
+        return ( self[n] for n in range(len(self)) )
+
+
+# -------------------------------------------------------------------------
+
+class CompiledPatternMgr( object ):
+    """
+    Pattern matcher with the same interface as aiml.PatternMgr, but using
+    an integer-indexed flat representation and iterative matching
+    """
+
+    def __init__( self ):
+        self._templateCount = 0
+        self._botName = u'Nameless'
+        punctuation = r"""`~!@#$%^&*()-_=+[{]}\|;:'",<.>/?"""
+        self._puncStripRE = re.compile("[" + re.escape(punctuation) + "]")
+        self._whitespaceRE = re.compile(r"\s+", re.UNICODE)
+        # Input mutilation (upper case, no punctuation), memoized
+        self._mutilate = Normalizer().words
+        self._clear()
+
+
+    def _clear( self ):
+        """
+        Initialize an empty index
+        """
+        # Vocabulary: word -> id, plus the reverse list
+        self._wid = {}
+        self._words = []
+        for w in (u'_', u'*', u'BOT_NAME', u'<THAT>', u'<TOPIC>'):
+            self._intern( w )
+        self._botId = self._intern( self._botName )
+        # Word transitions, as a single dict: (node << _WSHIFT | word) -> node
+        self._edges = {}
+        # Node tables (-1 means "none")
+        self._under = array('i')
+        self._star = array('i')
+        self._botn = array('i')
+        self._that = array('i')
+        self._topic = array('i')
+        self._tmpl = array('i')
+        self._tail = array('i')
+        # Number of word transitions for each node
+        self._fanout = array('i')
+        self._templates = []
+        # The source id of each template slot (slots past its end have 0)
+        self._srcs = array('i')
+        # The buffer holding the index, when it is mapped from a file
+        self._mapped = None
+        self._newNode()     # the root node
+        # The last match done (star() repeats the match done by match())
+        self._last = None
+        # Template index -> category key, built on demand by matched()
+        self._keymap = None
+
+
+    def _intern( self, word ):
+        """
+        Return the id for a word, adding it to the vocabulary if needed
+        """
+        wid = self._wid.get( word )
+        if wid is None:
+            wid = self._wid[word] = len(self._words)
+            self._words.append( word )
+        return wid
+
+
+    def _newNode( self ):
+        """
+        Add a new empty node to the node tables, return its id
+        """
+        for a in (self._under, self._star, self._botn, self._that,
+                  self._topic, self._tmpl, self._tail):
+            a.append( -1 )
+        self._fanout.append( 0 )
+        return len(self._tmpl) - 1
+
+
+    def _child( self, table, node ):
+        """
+        Return the child of a node through a special transition, creating
+        it if it does not exist
+        """
+        child = table[node]
+        if child < 0:
+            child = table[node] = self._newNode()
+        return child
+
+
+    def _walk( self, node, words, botname=False ):
+        """
+        Navigate down from a node following a list of pattern words, adding
+        nodes as needed. Return the final node
+        """
+        for word in words:
+            if word == u'_':
+                node = self._child( self._under, node )
+            elif word == u'*':
+                node = self._child( self._star, node )
+            elif botname and word == u'BOT_NAME':
+                node = self._child( self._botn, node )
+            else:
+                node = self._edge( node, self._intern(word) )
+        return node
+
+
+    def _find( self, node, words, botname=False ):
+        """
+        Navigate down from a node following a list of pattern words, without
+        adding nodes. Return the final node, or -1 if there is no such path
+        """
+        for word in words:
+            if node < 0:
+                break
+            if word == u'_':
+                node = self._under[node]
+            elif word == u'*':
+                node = self._star[node]
+            elif botname and word == u'BOT_NAME':
+                node = self._botn[node]
+            else:
+                wid = self._wid.get( word )
+                node = -1 if wid is None else self._edges.get( node << _WSHIFT | wid, -1 )
+        return node
+
+
+    def _edge( self, node, wid ):
+        """
+        Return the child of a node through a word transition, creating it
+        if it does not exist
+        """
+        key = node << _WSHIFT | wid
+        child = self._edges.get( key )
+        if child is None:
+            child = self._edges[key] = self._newNode()
+            self._fanout[node] += 1
+        return child
+
+
+    def _anytail( self, node ):
+        """
+        Return the template reached from a pattern node through a "<that>*"
+        + "<topic>*" tail, if that tail is its only possible continuation.
+        Otherwise return -1
+        """
+        under, star, botn, fanout = self._under, self._star, self._botn, self._fanout
+        plain = lambda n : n >= 0 and under[n] < 0 and botn[n] < 0 and not fanout[n]
+        that = self._that[node]
+        if not plain(that) or not plain(star[that]) or star[star[that]] >= 0:
+            return -1
+        topic = self._topic[star[that]]
+        if not plain(topic) or not plain(star[topic]) or star[star[topic]] >= 0:
+            return -1
+        return self._tmpl[star[topic]]
+
+    # -----------------------------------------------------------------
+
+    def numTemplates( self ):
+        """Return the number of templates currently stored."""
+        return self._templateCount
+
+
+    def setBotName( self, name ):
+        """Set the name of the bot, used to match <bot name="name"> tags in
+        patterns. The name must be a single word!
+        """
+        self._botName = u' '.join( name.split() )
+        self._botId = self._intern( self._botName )
+        self._last = None
+
+
+    def add( self, data, template, source=0 ):
+        """Add a [pattern/that/topic] tuple and its corresponding template
+        to the index, optionally tagged with a source id (a small int, 0
+        for none). Return the template and source id replaced, or (None, 0)
+        """
+        if self._mapped is not None:
+            self._thaw()
+        pattern, that, topic = data
+        pnode = node = self._walk( 0, pattern.split(), True )
+        if len(that) > 0:
+            node = self._walk( self._child(self._that,node), that.split() )
+        if len(topic) > 0:
+            node = self._walk( self._child(self._topic,node), topic.split() )
+        # Add the template, or replace the one already there
+        idx = self._tmpl[node]
+        srcs = self._srcs
+        if idx < 0:
+            prev = None, 0
+            self._templateCount += 1
+            idx = self._tmpl[node] = len(self._templates)
+            self._templates.append( template )
+        else:
+            prev = self._templates[idx], srcs[idx] if idx < len(srcs) else 0
+            self._templates[idx] = template
+        if idx >= len(srcs) and source:
+            srcs.extend( [0] * (idx + 1 - len(srcs)) )
+        if idx < len(srcs):
+            srcs[idx] = source
+        self._tail[pnode] = self._anytail( pnode )
+        self._last = self._keymap = None
+        return prev
+
+
+    def _slot( self, data ):
+        """
+        Find the node for a [pattern/that/topic] tuple, without adding nodes.
+        Return the pattern node and the final node (-1 if there is no such
+        path)
+        """
+        pattern, that, topic = data
+        pnode = node = self._find( 0, pattern.split(), True )
+        if len(that) > 0 and node >= 0:
+            node = self._find( self._that[node], that.split() )
+        if len(topic) > 0 and node >= 0:
+            node = self._find( self._topic[node], topic.split() )
+        return pnode, node
+
+
+    def get( self, data ):
+        """Return the template for a [pattern/that/topic] tuple and its
+        source id, or (None, 0) if there is none.
+        """
+        node = self._slot( data )[1]
+        idx = self._tmpl[node] if node >= 0 else -1
+        if idx < 0:
+            return None, 0
+        return self._templates[idx], self._srcs[idx] if idx < len(self._srcs) else 0
+
+
+    def remove( self, data ):
+        """Remove the template for a [pattern/that/topic] tuple from the
+        index. Return the removed template, or None if there was none.
+        """
+        pnode, node = self._slot( data )
+        if node < 0 or self._tmpl[node] < 0:
+            return None
+        if self._mapped is not None:
+            self._thaw()
+        # Nodes are kept; the template slot is left empty
+        idx = self._tmpl[node]
+        template = self._templates[idx]
+        self._templates[idx] = None
+        self._tmpl[node] = -1
+        self._templateCount -= 1
+        self._tail[pnode] = self._anytail( pnode )
+        self._last = self._keymap = None
+        return template
+
+
+    def match( self, pattern, that, topic ):
+        """Return the template which is the closest match to pattern. The
+        'that' parameter contains the bot's previous response. The 'topic'
+        parameter contains the current topic of conversation.
+
+        Returns None if no template is found.
+        """
+        if len(pattern) == 0:
+            return None
+        result = self._lookup( pattern, that, topic )
+        return None if result is None else self._templates[result[0]]
+
+
+    def matched( self, pattern, that, topic ):
+        """Return the [pattern/that/topic] tuple of the category whose
+        template match() returns for the same arguments, or None if there
+        is no match.
+        """
+        if len(pattern) == 0:
+            return None
+        result = self._lookup( pattern, that, topic )
+        if result is None:
+            return None
+        if self._keymap is None:
+            self._keymap = self._category_keys()
+        return self._keymap.get( result[0] )
+
+
+    def template_keys( self, templates ):
+        """Return a dict with the [pattern/that/topic] tuple for each one of
+        a list of templates, indexed by template id(). Templates not in the
+        index are left out.
+        """
+        wanted = set( id(t) for t in templates )
+        tpls = self._templates
+        # (in a mapped brain, the templates in use are those decoded)
+        items = ( tpls._decoded.items() if self._mapped is not None
+                  else enumerate(tpls) )
+        if self._keymap is None:
+            self._keymap = self._category_keys()
+        return dict( (id(t), self._keymap[i]) for i, t in items
+                     if id(t) in wanted and i in self._keymap )
+
+
+    def resolve( self, pattern ):
+        """Find the template matched by pattern for most values of 'that'
+        and 'topic'. Returns a tuple (template, guards), where guards is a
+        list of pattern nodes whose <that>/<topic> patterns must be checked
+        with guarded(): if one of them matches, the template is not valid.
+        Returns None if there is no such template.
+        """
+        segs = self._segments( pattern, None, None )
+        if not segs[0]:
+            return None
+        guards = []
+        result = self._search( segs, guards=guards )
+        if result is None:
+            return None
+        return self._templates[result[0]], guards
+
+
+    def guarded( self, guards, that, topic ):
+        """Check if the <that>/<topic> patterns in any of the nodes of a
+        guard list (as returned by resolve()) match a that & topic.
+        """
+        segs = self._segments( u"", that, topic )
+        for node in guards:
+            if self._search( segs, start=self._that[node] ) is not None:
+                return True
+        return False
+
+
+    def star( self, starType, pattern, that, topic, index ):
+        """Returns a string, the portion of pattern that was matched by a *.
+
+        The 'starType' parameter specifies which type of star to find.
+        Legal values are:
+         - 'star': matches a star in the main pattern.
+         - 'thatstar': matches a star in the that pattern.
+         - 'topicstar': matches a star in the topic pattern.
+
+        Star spans are taken from the match itself, so they are always
+        consistent with the template that was selected.
+        """
+        try:
+            seg = _STARTYPE[starType]
+        except KeyError:
+            raise ValueError( "starType must be in ['star', 'thatstar', 'topicstar']" )
+        result = self._lookup( pattern, that, topic )
+        if result is None:
+            return u""
+        spans = [ s for s in result[1] if s[0] == seg ]
+        if not 0 < index <= len(spans):
+            return u""
+        _, start, end = spans[index-1]
+        # Extract the star words from the original, unmutilated input. Tokens
+        # made only of punctuation vanish when mutilating, so the span is
+        # mapped to source tokens: from the one after the previous matched
+        # word up to that of its last word (or to the end of the input)
+        source = (pattern, that, topic)[seg]
+        if seg and source.strip() == u"":
+            source = u"ULTRABOGUSDUMMYTHAT" if seg == 1 else u"ULTRABOGUSDUMMYTOPIC"
+        tokens = source.split()
+        pos = [ n for n, tok in enumerate(tokens) for _ in self._mutilate(tok) ]
+        first = pos[start-1] + 1 if start else 0
+        last = pos[end] + 1 if end + 1 < len(pos) else len(tokens)
+        return u' '.join( tokens[first:last] )
+
+
+    def _lookup( self, pattern, that, topic ):
+        """
+        Normalize the three input strings, match them and return a tuple
+        (template index, star spans), or None if there is no match. The last
+        result is memoized.
+        """
+        key = (pattern, that, topic)
+        if self._last is not None and self._last[0] == key:
+            return self._last[1]
+
+        result = self._search( self._segments(pattern, that, topic) )
+        self._last = key, result
+        return result
+
+
+    def _segments( self, pattern, that, topic ):
+        """
+        Mutilate the input as PatternMgr does, and convert it into a tuple
+        of (pattern, that, topic) word id lists. That & topic can be None
+        """
+        mutilate = self._mutilate
+        wid = self._wid.get
+        if that is not None and that.strip() == u"":
+            that = u"ULTRABOGUSDUMMYTHAT"
+        if topic is not None and topic.strip() == u"":
+            topic = u"ULTRABOGUSDUMMYTOPIC"
+        return tuple( None if s is None else
+                      [ wid(w,-1) for w in mutilate(s) ]
+                      for s in (pattern, that, topic) )
+
+
+    def _general( self, node ):
+        """
+        Check if the <that>/<topic> patterns below a pattern node include
+        one that matches anything
+        """
+        star, topic, tmpl = self._star, self._topic, self._tmpl
+        that = star[self._that[node]]
+        if that < 0:
+            return False
+        return tmpl[that] >= 0 or (topic[that] >= 0 and
+                                   star[topic[that]] >= 0 and
+                                   tmpl[star[topic[that]]] >= 0)
+
+
+    def _search( self, segs, start=None, guards=None ):
+        """
+        Perform the match of a tuple of (pattern, that, topic) word id lists.
+        Return a tuple (template index, star spans) or None. Each star span
+        is a tuple (segment, first word, last word).
+         @param start (int): match only the <that> & <topic> segments,
+           starting at this <that> node
+         @param guards (list): match only the pattern segment (that & topic
+           are None). Pattern nodes that have <that>/<topic> patterns are
+           considered not matching, and are appended to this list; but if
+           one of those could match anything, there is no result
+        """
+        under, star, botn, tmpl = self._under, self._star, self._botn, self._tmpl
+        tail = self._tail
+        seps = (None, self._that, self._topic)
+        edges = self._edges
+        botId = self._botId
+        stars = []
+        # A stack of choice points. Each one is a list:
+        #  [node, segment, word position, stage, wildcard end, num stars]
+        # where stage is the next alternative to explore at that point:
+        #  0 -> "_", 1 -> word, 2 -> bot name, 3 -> "*"
+        # (at the end of a segment: 0 -> next segment, 1 -> template)
+        # and wildcard end is the next position to try for the wildcard
+        stack = [ [0, 0, 0, 0, 0, 0] if start is None else [start, 1, 0, 0, 0, 0] ]
+        while stack:
+            frame = stack[-1]
+            node, seg, pos, stage, end, nst = frame
+            del stars[nst:]
+            words = segs[seg]
+            n = len(words)
+
+            # Out of words in this segment
+            if pos == n:
+                if guards is not None:
+                    if tail[node] >= 0:
+                        return tail[node], stars
+                    if seps[1][node] >= 0 and stage == 0:
+                        if self._general( node ):
+                            return None
+                        guards.append( node )
+                elif seg == 0 and tail[node] >= 0 and segs[1] and segs[2]:
+                    stars.append( (1, 0, len(segs[1])-1) )
+                    stars.append( (2, 0, len(segs[2])-1) )
+                    return tail[node], stars
+                if stage == 0:
+                    frame[3] = 1
+                    nxt = seg + 1
+                    while nxt < 3 and not segs[nxt]:
+                        nxt += 1
+                    if nxt < 3:
+                        child = seps[nxt][node]
+                        if child >= 0:
+                            stack.append( [child, nxt, 0, 0, 0, nst] )
+                            continue
+                if tmpl[node] >= 0:
+                    return tmpl[node], stars
+                stack.pop()
+                continue
+
+            # Find the next alternative to explore, in priority order
+            child = -1
+            while True:
+                if stage == 0 or stage == 3:
+                    # A wildcard. If its node only has word transitions, skip
+                    # the lengths not followed by one of those words
+                    wild = under[node] if stage == 0 else star[node]
+                    if wild >= 0:
+                        end = end or pos + 1
+                        if under[wild] < 0 and star[wild] < 0 and botn[wild] < 0:
+                            base = wild << _WSHIFT
+                            while end < n and (words[end] < 0 or
+                                               base | words[end] not in edges):
+                                end += 1
+                        if end <= n:
+                            frame[4] = end + 1
+                            stars.append( (seg, pos, end-1) )
+                            child, pos = wild, end
+                            break
+                    if stage == 3:
+                        break
+                    frame[4] = end = 0
+                    stage = 1
+                if stage == 1:
+                    frame[3] = 2
+                    if words[pos] >= 0:
+                        child = edges.get( node << _WSHIFT | words[pos], -1 )
+                        if child >= 0:
+                            pos += 1
+                            break
+                frame[3] = stage = 3
+                if botn[node] >= 0 and words[pos] == botId:
+                    child = botn[node]
+                    pos += 1
+                    break
+            if child < 0:
+                stack.pop()
+                continue
+
+            # Follow plain word transitions without adding choice points
+            # (they have no other alternatives to backtrack to)
+            while (pos < n and under[child] < 0 and star[child] < 0
+                   and botn[child] < 0):
+                if words[pos] < 0:
+                    break
+                child = edges.get( child << _WSHIFT | words[pos], -1 )
+                if child < 0:
+                    break
+                pos += 1
+            else:
+                stack.append( [child, seg, pos, 0, 0, len(stars)] )
+
+        return None
+
+    def _category_keys( self ):
+        """
+        Walk the whole index and return a dict with the [pattern/that/topic]
+        tuple for each template index
+        """
+        words = self._words
+        mask = (1 << _WSHIFT) - 1
+        children = {}
+        for k, child in self._edges.items():
+            children.setdefault( k >> _WSHIFT, [] ).append( (words[k & mask], child) )
+        wild = ( (self._under, u'_'), (self._star, u'*'), (self._botn, u'BOT_NAME') )
+        seps = ( (1, self._that), (2, self._topic) )
+        tmpl = self._tmpl
+        keys = {}
+        pending = [ (0, 0, ((), (), ())) ]
+        while pending:
+            node, seg, path = pending.pop()
+            if tmpl[node] >= 0:
+                keys[tmpl[node]] = tuple( u' '.join(p) for p in path )
+            out = [ (table[node], w) for table, w in wild if table[node] >= 0 ]
+            out += [ (child, w) for w, child in children.get(node, ()) ]
+            for child, w in out:
+                pending.append( (child, seg,
+                                 path[:seg] + (path[seg]+(w,),) + path[seg+1:]) )
+            for nxt, table in seps:
+                if nxt > seg and table[node] >= 0:
+                    pending.append( (table[node], nxt, path) )
+        return keys
+
+    # -----------------------------------------------------------------
+
+    def _import_tree( self, root ):
+        """
+        Add to the index all the patterns in a PatternMgr dict tree
+        """
+        P = PatternMgr
+        special = { P._UNDERSCORE : self._under, P._STAR : self._star,
+                    P._BOT_NAME : self._botn, P._THAT : self._that,
+                    P._TOPIC : self._topic }
+        pending = [ (root, 0) ]
+        while pending:
+            tree, node = pending.pop()
+            for key, sub in tree.items():
+                if key == P._TEMPLATE:
+                    if self._tmpl[node] < 0:
+                        self._templateCount += 1
+                        self._tmpl[node] = len(self._templates)
+                        self._templates.append( sub )
+                    continue
+                if key in special:
+                    child = self._child( special[key], node )
+                else:
+                    child = self._edge( node, self._intern(key) )
+                pending.append( (sub, child) )
+        for node in range(len(self._tmpl)):
+            if self._that[node] >= 0:
+                self._tail[node] = self._anytail( node )
+
+
+    def _thaw( self ):
+        """
+        Copy a mapped index into regular, modifiable, data structures
+        """
+        self._words = list( self._words )
+        self._wid = dict( (w,n) for n, w in enumerate(self._words) )
+        self._edges = dict( self._edges.items() )
+        self._templates = list( self._templates )
+        for name in _TABLES:
+            setattr( self, name, _frombytes(_tobytes(getattr(self,name))) )
+        self._mapped = None
+
+
+    def save( self, filename ):
+        """Dump the current index to the file specified by filename.  To
+        restore later, use restore(). The file is written under a temporary
+        name and then renamed, so that a mapped copy of it remains valid.
+        """
+        with atomic_write( filename ) as f:
+            self.write( f )
+
+
+    def write( self, f ):
+        """
+        Write the index to a file object in mappable format: a header and a
+        directory of sections, each one aligned to 8 bytes. The file is
+        written sequentially (it can be e.g. a zip file member)
+        """
+        # Vocabulary: word offsets & data, plus a hash table of word ids
+        words = [ w.encode('utf-8') for w in self._words ]
+        woffsets = array( 'i', [0] )
+        for w in words:
+            woffsets.append( woffsets[-1] + len(w) )
+        wslots = array( 'i', [-1] ) * _capacity( len(words) )
+        mask = len(wslots) - 1
+        for wid, w in enumerate(words):
+            i = _word_hash( w ) & mask
+            while wslots[i] >= 0:
+                i = (i + 1) & mask
+            wslots[i] = wid
+
+        # Word transitions, as a hash table
+        edges = list( self._edges.items() )
+        size = _capacity( len(edges) )
+        enode = array( 'i', [-1] ) * size
+        eword, echild = array( 'i', [0] ) * size, array( 'i', [0] ) * size
+        mask = size - 1
+        for key, child in edges:
+            node, wid = key >> _WSHIFT, key & 0xffffffff
+            i = _edge_hash( node, wid ) & mask
+            while enode[i] >= 0:
+                i = (i + 1) & mask
+            enode[i], eword[i], echild[i] = node, wid, child
+
+        # Templates, serialized once for each distinct object (or blob, in
+        # a mapped brain), plus the blob for each template slot
+        templates = self._templates
+        mapped = isinstance( templates, _MappedTemplates )
+        trefs, blobs, seen = array( 'i' ), [], {}
+        for n in range(len(templates)):
+            tid = templates.blob(n) if mapped else id(templates[n])
+            ref = seen.get( tid )
+            if ref is None:
+                ref = seen[tid] = len(blobs)
+                blobs.append( templates.raw(n).tobytes() if mapped
+                              else marshal.dumps(templates[n]) )
+            trefs.append( ref )
+        toffsets = array( 'i', [0] )
+        for b in blobs:
+            toffsets.append( toffsets[-1] + len(b) )
+
+        sections = [ (name, _tobytes(getattr(self,name))) for name in _TABLES ]
+        sections += [ ('woffsets', _tobytes(woffsets)),
+                      ('words', b''.join(words)),
+                      ('wslots', _tobytes(wslots)),
+                      ('enode', _tobytes(enode)),
+                      ('eword', _tobytes(eword)),
+                      ('echild', _tobytes(echild)),
+                      ('toffsets', _tobytes(toffsets)),
+                      ('trefs', _tobytes(trefs)),
+                      ('templates', b''.join(blobs)) ]
+        # Directory: offset & length of each section, relative to the end
+        # of the header
+        directory, pos = {}, 0
+        for name, data in sections:
+            directory[name] = pos, len(data)
+            pos += (len(data) + 7) & ~7
+        head = marshal.dumps( { 'templateCount' : self._templateCount,
+                                'botName' : self._botName,
+                                'sections' : directory } )
+        f.write( _HEADER.pack(BRAIN_MAGIC, BRAIN_VERSION, len(head)) )
+        f.write( head )
+        f.write( b'\0' * (-(_HEADER.size + len(head)) % 8) )
+        for name, data in sections:
+            f.write( data )
+            f.write( b'\0' * (-len(data) % 8) )
+
+
+    def restore( self, filename ):
+        """Restore a previously saved brain. It can be either a brain saved
+        by this class, or one saved by the standard PatternMgr. Brains saved
+        by this class are mapped into memory, not read.
+        """
+        with open( filename, 'rb' ) as f:
+            if f.read( len(BRAIN_MAGIC) ) == BRAIN_MAGIC:
+                self.map( mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) )
+                return
+            f.seek( 0 )
+            self._unmarshal( f )
+
+
+    def read( self, f ):
+        """Restore a brain from a file object (e.g. a zip file member), in
+        any of the formats accepted by restore(). A brain saved by this
+        class is read into memory and then used in place
+        """
+        data = f.read()
+        if data[:len(BRAIN_MAGIC)] == BRAIN_MAGIC:
+            self.map( data )
+        else:
+            self._unmarshal( io.BytesIO(data) )
+
+
+    def _unmarshal( self, f ):
+        """Restore a brain saved by the standard PatternMgr: template count,
+        bot name and dict tree, as marshal dumps
+        """
+        marshal.load( f )
+        botName = marshal.load( f )
+        root = marshal.load( f )
+        self._clear()
+        self.setBotName( botName )
+        self._import_tree( root )
+
+
+    def map( self, buf ):
+        """Use a brain in the current format held in a buffer (e.g. a mmap
+        object), without copying it. Only the header is read: the index is
+        used in place, and templates are decoded when needed.
+        """
+        buf = memoryview( buf )
+        magic, version, hlen = _HEADER.unpack_from( buf, 0 )
+        if magic != BRAIN_MAGIC:
+            raise ValueError( 'not a mappable brain' )
+        if version != BRAIN_VERSION:
+            raise ValueError( 'unsupported brain version: {}'.format(version) )
+        head = marshal.loads( buf[_HEADER.size:_HEADER.size+hlen].tobytes() )
+        base = (_HEADER.size + hlen + 7) & ~7
+        def section( name ):
+            off, size = head['sections'][name]
+            return buf[base+off:base+off+size]
+
+        self._clear()
+        self._mapped = buf
+        for name in _TABLES:
+            setattr( self, name, _intview(section(name)) )
+        self._wid = self._words = _MappedWords( _intview(section('woffsets')),
+                                                section('words'),
+                                                _intview(section('wslots')) )
+        self._edges = _MappedEdges( _intview(section('enode')),
+                                    _intview(section('eword')),
+                                    _intview(section('echild')) )
+        self._templates = _MappedTemplates( _intview(section('toffsets')),
+                                            section('templates'),
+                                            _intview(section('trefs')) )
+        self._templateCount = head['templateCount']
+        self._botName = head['botName']
+        self._botId = self._intern( self._botName )
+        self._last = None
+
+
+    def dump( self ):
+        """Print a summary of the index, for debugging purposes."""
+        print( u'{} templates, {} nodes, {} edges, {} words'.format(
+            self._templateCount, len(self._tmpl), len(self._edges),
+            len(self._words)) )
+
+
+    def memory_stats( self ):
+        """Return the size of the index and the (approximate) memory used
+        by each of its parts, as a list of (name, value) tuples. The parts
+        of a mapped index are in the file pages, and do not count.
+        """
+        templates = self._templates
+        if self._mapped is not None:
+            decoded = list( templates._blobs.values() )
+            return [ ('nodes', len(self._tmpl)),
+                     ('words', len(self._words)),
+                     ('mapped file', format_size(len(self._mapped))),
+                     ('templates decoded', '{} distinct, {} slots ({})'.format(
+                         len(decoded), len(templates),
+                         format_size(deep_size(decoded)))) ]
+        tables = sum( len(t)*t.itemsize for t in
+                      (getattr(self,name) for name in _TABLES) )
+        edges = sys.getsizeof( self._edges ) + sum(
+            sys.getsizeof(k) + sys.getsizeof(v) for k, v in self._edges.items() )
+        words = sys.getsizeof( self._words ) + sys.getsizeof( self._wid ) + \
+                sum( sys.getsizeof(w) for w in self._words )
+        distinct = len( set(id(t) for t in templates if t is not None) )
+        return [ ('nodes', '{} ({})'.format(len(self._tmpl),
+                                            format_size(tables))),
+                 ('word transitions', '{} ({})'.format(len(self._edges),
+                                                       format_size(edges))),
+                 ('words', '{} ({})'.format(len(self._words),
+                                            format_size(words))),
+                 ('templates', '{} distinct, {} slots ({})'.format(
+                     distinct, len(templates), format_size(deep_size(templates)))) ]
+
+
+# -------------------------------------------------------------------------
+
+class PyaimlPatternMgr( PatternMgr ):
+    """
+    The standard pyAIML pattern matcher, with the ability to remove templates
+    and to save & restore brains through file objects
+    """
+
+    # Node key for the source id of a template (not a PatternMgr key)
+    _SOURCE = 6
+    # Node tree keys for the special words in patterns
+    _special = { u'_' : PatternMgr._UNDERSCORE, u'*' : PatternMgr._STAR }
+    _first = dict( _special, **{ 'BOT_NAME' : PatternMgr._BOT_NAME } )
+
+    def save( self, filename ):
+        """Dump the current patterns to the file specified by filename, in
+        the standard PatternMgr format (with no source ids).
+        """
+        with open( filename, 'wb' ) as f:
+            self.write( f )
+
+
+    def write( self, f ):
+        """Write the patterns to a file object, in the format of save().
+        Source ids are not written
+        """
+        tagged = []
+        pending = [ self._root ]
+        while pending:
+            node = pending.pop()
+            source = node.pop( self._SOURCE, None )
+            if source is not None:
+                tagged.append( (node, source) )
+            pending += [ c for k, c in node.items() if k != self._TEMPLATE ]
+        try:
+            f.write( marshal.dumps(self._templateCount) )
+            f.write( marshal.dumps(self._botName) )
+            f.write( marshal.dumps(self._root) )
+        finally:
+            for node, source in tagged:
+                node[self._SOURCE] = source
+
+
+    def read( self, f ):
+        """Restore the patterns from a file object (e.g. a zip file member),
+        in the format of save()
+        """
+        f = io.BytesIO( f.read() )
+        self._templateCount = marshal.load( f )
+        self._botName = marshal.load( f )
+        self._root = marshal.load( f )
+
+
+    def _node( self, data, create=False ):
+        """
+        Return the node tree node for a [pattern/that/topic] tuple, or None
+        if there is no such path
+          @param create (bool): add the missing nodes
+        """
+        pattern, that, topic = data
+        node, words = self._root, self._first
+        for sep, seg in ( (None, pattern), (self._THAT, that),
+                          (self._TOPIC, topic) ):
+            if sep is not None:
+                if len(seg) == 0:
+                    continue
+                words = self._special
+                seg = [ sep ] + seg.split()
+            else:
+                seg = seg.split()
+            for word in seg:
+                word = words.get( word, word )
+                child = node.get( word )
+                if child is None:
+                    if not create:
+                        return None
+                    child = node[word] = {}
+                node = child
+        return node
+
+
+    def add( self, data, template, source=0 ):
+        """Add a [pattern/that/topic] tuple and its corresponding template
+        to the node tree, optionally tagged with a source id (a small int,
+        0 for none). Return the template and source id replaced, or
+        (None, 0)
+        """
+        node = self._node( data, True )
+        prev = node.get( self._TEMPLATE ), node.get( self._SOURCE, 0 )
+        if prev[0] is None:
+            self._templateCount += 1
+        node[self._TEMPLATE] = template
+        if source:
+            node[self._SOURCE] = source
+        elif prev[1]:
+            del node[self._SOURCE]
+        return prev
+
+
+    def get( self, data ):
+        """Return the template for a [pattern/that/topic] tuple and its
+        source id, or (None, 0) if there is none.
+        """
+        node = self._node( data )
+        if node is None or self._TEMPLATE not in node:
+            return None, 0
+        return node[self._TEMPLATE], node.get( self._SOURCE, 0 )
+
+
+    def remove( self, data ):
+        """Remove the template for a [pattern/that/topic] tuple from the node
+        tree. Return the removed template, or None if there was none.
+        """
+        node = self._node( data )
+        if node is None:
+            return None
+        template = node.pop( self._TEMPLATE, None )
+        node.pop( self._SOURCE, None )
+        if template is not None:
+            self._templateCount -= 1
+        return template
+
+
+    def matched( self, pattern, that, topic ):
+        """Return the [pattern/that/topic] tuple of the category whose
+        template match() returns for the same arguments, or None if there
+        is no match.
+        """
+        if len(pattern) == 0:
+            return None
+        # Mutilate the input, as match() does
+        punc = self._puncStripRE
+        if that.strip() == u"":
+            that = u"ULTRABOGUSDUMMYTHAT"
+        if topic.strip() == u"":
+            topic = u"ULTRABOGUSDUMMYTOPIC"
+        words = [ re.sub(punc, u" ", s.upper()).split()
+                  for s in (pattern, that, topic) ]
+        path, template = self._match( words[0], words[1], words[2], self._root )
+        if template is None:
+            return None
+        # Follow the path to find the node keys. A bot name match appears
+        # in it as the matched word
+        steps = []
+        node = self._root
+        for step in path:
+            if step not in node:
+                step = self._BOT_NAME
+            steps.append( step )
+            node = node[step]
+        return self._path_key( steps )
+
+
+    def template_keys( self, templates ):
+        """Return a dict with the [pattern/that/topic] tuple for each one of
+        a list of templates, indexed by template id(). Templates not in the
+        tree are left out.
+        """
+        wanted = set( id(t) for t in templates )
+        out = {}
+        pending = [ (self._root, ()) ]
+        while pending and len(out) < len(wanted):
+            node, path = pending.pop()
+            for k, child in node.items():
+                if k == self._SOURCE:
+                    continue
+                if k != self._TEMPLATE:
+                    pending.append( (child, path + (k,)) )
+                elif id(child) in wanted:
+                    out[id(child)] = self._path_key( path )
+        return out
+
+
+    def _path_key( self, path ):
+        """
+        Convert a list of node tree keys into a [pattern/that/topic] tuple
+        """
+        special = { self._UNDERSCORE : u'_', self._STAR : u'*',
+                    self._BOT_NAME : u'BOT_NAME' }
+        key = ( [], [], [] )
+        seg = 0
+        for step in path:
+            if step == self._THAT or step == self._TOPIC:
+                seg = 1 if step == self._THAT else 2
+            else:
+                key[seg].append( special.get(step, step) )
+        return tuple( u' '.join(k) for k in key )
+
+
+    def memory_stats( self ):
+        """Return the size of the node tree and the (approximate) memory
+        used by its nodes and templates, as a list of (name, value) tuples
+        """
+        nodes = size = 0
+        templates = []
+        pending = [ self._root ]
+        while pending:
+            node = pending.pop()
+            nodes += 1
+            size += sys.getsizeof( node )
+            for k, child in node.items():
+                if k == self._TEMPLATE:
+                    templates.append( child )
+                elif k != self._SOURCE:
+                    pending.append( child )
+        distinct = len( set(id(t) for t in templates) )
+        return [ ('nodes', '{} ({})'.format(nodes, format_size(size))),
+                 ('templates', '{} distinct, {} slots ({})'.format(
+                     distinct, len(templates), format_size(deep_size(templates)))) ]
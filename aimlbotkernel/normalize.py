@@ -0,0 +1,84 @@
+"""
+Input normalization for AimlBot and its pattern matchers.
+
+Before matching, pyAIML runs each input sentence, and the current <that>
+and topic, through the "normal" substitutions, and then the pattern
+matcher upper-cases it and replaces punctuation by spaces with a regex
+(a step PatternMgr calls "mutilation"). The same strings go through this
+again and again: <that> and topic change seldom, and inputs repeat.
+
+A Normalizer precompiles these steps: the punctuation is removed with a
+str.translate table, and the results are kept in a bounded memo.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+
+# The punctuation removed by PatternMgr
+PUNCTUATION = u"""`~!@#$%^&*()-_=+[{]}\\|;:'",<.>/?"""
+
+# A translate table (for unicode strings) replacing punctuation by spaces
+_PUNC_TABLE = dict( (ord(c), u' ') for c in PUNCTUATION )
+
+
+class Normalizer( object ):
+    """
+    Normalize strings for matching, memoizing the results
+    """
+
+    def __init__( self, subber=None, size=4096 ):
+        """
+          @param subber (callable): a function returning the WordSub with
+            the "normal" substitutions (it is looked up on each memo miss,
+            since the bot may replace it). None means no substitutions
+          @param size (int): maximum number of entries in each memo; when
+            full, a memo is emptied
+        """
+        self._subber = subber
+        self.size = size
+        self._subs = {}
+        self._words = {}
+
+
+    def clear( self ):
+        """
+        Empty the memos (to be called when the substitutions change)
+        """
+        self._subs.clear()
+        self._words.clear()
+
+
+    def sub( self, text ):
+        """
+        Apply the normal substitutions to a string
+        """
+        out = self._subs.get( text )
+        if out is None:
+            out = self._subber().sub( text ) if self._subber else text
+            if len(self._subs) >= self.size:
+                self._subs.clear()
+            self._subs[text] = out
+        return out
+
+
+    def words( self, text ):
+        """
+        Split a (substituted) string into the words used for matching:
+        upper case, with punctuation removed
+          @return (tuple): the words
+        """
+        out = self._words.get( text )
+        if out is None:
+            out = tuple( text.upper().translate(_PUNC_TABLE).split() )
+            if len(self._words) >= self.size:
+                self._words.clear()
+            self._words[text] = out
+        return out
+
+
+    def __call__( self, text ):
+        """
+        Fully normalize a string: substitutions, upper case and
+        punctuation removal, with whitespace collapsed
+        """
+        return u' '.join( self.words(self.sub(text)) )
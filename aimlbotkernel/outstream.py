@@ -0,0 +1,101 @@
+"""
+Buffered forwarding of stdout to the frontend.
+
+The kernel sends what is written to stdout as iopub stream messages. The
+bot prints its progress in small fragments (e.g. print(..., end='')), and
+sending each write as a message would flood the frontend with tiny ZMQ
+messages. The forwarder accumulates writes and sends them as one message
+when a number of lines or characters has been reached, when a short delay
+has elapsed since the first pending write, or when it is flushed (e.g. at
+the end of each execute request).
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import time
+import threading
+
+
+class StdoutForwarder( object ):
+    """
+    Coalesce stdout writes into fewer stream messages
+    """
+
+    def __init__( self, send, max_size=8192, max_lines=32, delay=0.05 ):
+        """
+          @param send (callable): send a block of text to the frontend,
+            called with the text and the header of the request it belongs to
+          @param max_size (int): characters pending that trigger a send
+          @param max_lines (int): lines pending that trigger a send
+          @param delay (float): the maximum seconds a write is kept pending
+        """
+        self._send = send
+        self.max_size, self.max_lines, self.delay = max_size, max_lines, delay
+        # (reentrant, since sending may end up writing to stdout)
+        self._lock = threading.RLock()
+        self._buf = []
+        self._size = self._lines = 0
+        self._parent = None
+        self._timer = None
+        # Writes received, messages sent, characters sent and seconds spent
+        # sending them
+        self._counts = [ 0, 0, 0, 0.0 ]
+
+
+    def write( self, txt, parent=None ):
+        """
+        Add text to the pending block. Text written for a different request
+        than the pending one sends the pending block first
+          @param parent (dict): the header of the request producing the text
+        """
+        with self._lock:
+            if self._buf and parent is not self._parent:
+                self._flush()
+            self._buf.append( txt )
+            self._parent = parent
+            self._size += len(txt)
+            self._lines += txt.count( '\n' )
+            self._counts[0] += 1
+            if self._size >= self.max_size or self._lines >= self.max_lines:
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer( self.delay, self.flush )
+                self._timer.daemon = True
+                self._timer.start()
+
+
+    def flush( self ):
+        """
+        Send the pending block, if any
+        """
+        with self._lock:
+            self._flush()
+
+
+    def _flush( self ):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buf:
+            return
+        txt = u''.join( self._buf )
+        parent = self._parent
+        self._buf, self._size, self._lines = [], 0, 0
+        start = time.time()
+        self._send( txt, parent )
+        self._counts[1] += 1
+        self._counts[2] += len(txt)
+        self._counts[3] += time.time() - start
+
+
+    def counts( self, clear=False ):
+        """
+        Return the number of writes received, messages sent, characters sent
+        and seconds spent sending them
+          @param clear (bool): start counting again
+        """
+        with self._lock:
+            counts = tuple( self._counts )
+            if clear:
+                self._counts = [ 0, 0, 0, 0.0 ]
+            return counts
@@ -0,0 +1,111 @@
+"""
+Profiling counters for AimlBot: how many times each category was used,
+the time spent evaluating each type of template element, and the slowest
+requests.
+
+Element timings are collected by the instrumented variant of the compiled
+templates (see TemplateCompiler), so they are only paid for while
+profiling; times
+are inclusive (the time of a <srai> includes the whole response it
+produces).
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import time
+import heapq
+from itertools import count
+
+
+# Highest resolution clock available
+clock = getattr( time, 'perf_counter', time.time )
+
+
+class Profiler( object ):
+    """
+    A set of profiling counters
+    """
+
+    def __init__( self, slowest=25 ):
+        """
+          @param slowest (int): number of slowest requests to keep
+        """
+        self.slowest = slowest
+        # [pattern/that/topic] key -> uses (by category, since categories
+        # with identical templates share a single template object)
+        self.hits = {}
+        # element name -> [evaluations, total time, max time]
+        self.elements = {}
+        # A min-heap of (elapsed, seq, input, session) for the slowest requests
+        self.inputs = []
+        self._seq = count()
+        self.requests = self.nomatch = 0
+        self.elapsed = 0.0
+
+
+    def hit( self, key ):
+        """
+        Count a use of a category, given its [pattern/that/topic] key (None
+        means no category matched)
+        """
+        if key is None:
+            self.nomatch += 1
+            return
+        self.hits[key] = self.hits.get( key, 0 ) + 1
+
+
+    def request( self, input_, sessionID, elapsed ):
+        """
+        Record the time taken to respond to a request
+        """
+        self.requests += 1
+        self.elapsed += elapsed
+        item = elapsed, next(self._seq), input_, sessionID
+        if len(self.inputs) < self.slowest:
+            heapq.heappush( self.inputs, item )
+        elif elapsed > self.inputs[0][0]:
+            heapq.heapreplace( self.inputs, item )
+
+
+    def call( self, name, fn, sid ):
+        """
+        Evaluate a compiled template function, adding its evaluation time
+        to the counters for its element name
+        """
+        stats = self.elements.get( name )
+        if stats is None:
+            stats = self.elements[name] = [ 0, 0.0, 0.0 ]
+        start = clock()
+        try:
+            return fn( sid )
+        finally:
+            elapsed = clock() - start
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed > stats[2]:
+                stats[2] = elapsed
+
+
+    def top_categories( self, num ):
+        """
+        Return the most used categories, as a list of (uses, key)
+        """
+        return heapq.nlargest( num, ( (n, k) for k, n in self.hits.items() ),
+                               key=lambda h: h[0] )
+
+
+    def top_elements( self ):
+        """
+        Return the element statistics, sorted by decreasing total time, as
+        a list of (name, evaluations, total time, max time)
+        """
+        out = [ (name,) + tuple(s) for name, s in self.elements.items() if s[0] ]
+        return sorted( out, key=lambda e: -e[2] )
+
+
+    def top_inputs( self ):
+        """
+        Return the slowest requests, slowest first, as a list of
+        (elapsed, input, session)
+        """
+        return [ (e, i, s) for e, _, i, s in sorted(self.inputs, reverse=True) ]
@@ -0,0 +1,105 @@
+"""
+A response cache for AimlBot: bot responses that are a deterministic
+function of the input, <that>, topic and the session predicates read by
+the templates involved can be stored and reused.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+from collections import OrderedDict
+
+
+# Template elements that make a response non-cacheable: they produce
+# random or time-dependent output, have side effects, or depend on the
+# conversation history or the session id
+VOLATILE_ELEMENTS = frozenset( ('random', 'set', 'date', 'system', 'learn',
+                                'input', 'that', 'id') )
+
+# The dependencies of templates that read no predicates (the most common
+# case), shared by all of them
+_NO_DEPS = frozenset()
+
+
+def template_deps( elem ):
+    """
+    Classify a template element list.
+      @param elem (list): a template, as produced by the AimlHandler
+      @return (frozenset): the names of the session predicates read by the
+        template, or None if the template output is not cacheable
+    """
+    deps = set()
+    pending = [ elem ]
+    while pending:
+        e = pending.pop()
+        name = e[0]
+        if name == 'text':
+            continue
+        if name in VOLATILE_ELEMENTS:
+            return None
+        if name in ('get', 'condition', 'li') and 'name' in e[1]:
+            deps.add( e[1]['name'] )
+        elif name == 'topicstar':
+            # uses the raw topic, while the cache key holds the normalized one
+            deps.add( 'topic' )
+        pending.extend( e[2:] )
+    return frozenset( deps ) if deps else _NO_DEPS
+
+
+# -------------------------------------------------------------------------
+
+class ResponseCache( object ):
+    """
+    An LRU cache of responses. Each entry is a tuple (deps, response), where
+    \c deps is a tuple of (predicate name, value) pairs that must hold for
+    the entry to be valid
+    """
+
+    def __init__( self, size=1000 ):
+        self.size = size
+        self._data = OrderedDict()
+        self.hits = self.misses = self.invalidations = 0
+
+
+    def __len__( self ):
+        return len(self._data)
+
+
+    def get( self, key ):
+        """
+        Fetch an entry, moving it to the most recently used position
+        """
+        entry = self._data.pop( key, None )
+        if entry is not None:
+            self._data[key] = entry
+        return entry
+
+
+    def put( self, key, deps, response ):
+        """
+        Store an entry, evicting the least recently used one if full
+        """
+        self._data.pop( key, None )
+        self._data[key] = deps, response
+        if len(self._data) > self.size:
+            self._data.popitem( last=False )
+
+
+    def clear( self ):
+        """
+        Remove all entries (keeping the hit/miss counters)
+        """
+        if self._data:
+            self._data.clear()
+            self.invalidations += 1
+
+
+    def stats( self ):
+        """
+        Return the cache statistics, as a list of (name, value) tuples
+        """
+        total = self.hits + self.misses
+        return [ ('entries', '{}/{}'.format(len(self._data), self.size)),
+                 ('hits', self.hits),
+                 ('misses', self.misses),
+                 ('hit ratio', '{:.1%}'.format(self.hits/total if total else 0)),
+                 ('invalidations', self.invalidations) ]
@@ -0,0 +1,506 @@
+"""
+A bounded session store for AimlBot.
+
+pyAIML keeps the predicates of every session (including the input and
+output histories) in a dict that grows without limit. SessionStore is a
+replacement for that dict which keeps in memory at most a given number of
+sessions, in LRU order, and optionally only those used within an idle
+time limit. Sessions evicted from memory are written to a local SQLite
+database (or a dbm file, if sqlite3 is not available) and read back
+transparently the next time they are used.
+
+The input and output histories of each session are kept in History
+objects: fixed-capacity ring buffers, instead of lists that pyAIML
+truncates by popping their first element.
+
+All the sessions in a store can be written in bulk as a session table: the
+encoded data of each session, one after the other, followed by an index of
+session ids and offsets. A table held in a buffer (e.g. mapped from a .bot
+file) can be added to a store, and its sessions are decoded only when they
+are first used.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os.path
+import time
+import struct
+import marshal
+import shutil
+import tempfile
+from collections import OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+try:
+    import dbm
+except ImportError:
+    import anydbm as dbm
+
+
+class _SqliteSpill( object ):
+    """
+    Sessions spilled to an SQLite database: session id -> encoded data
+    """
+
+    def __init__( self, filename ):
+        # Autocommit, without syncing: this is a cache of evicted sessions,
+        # not a durable store
+        self._db = sqlite3.connect( filename, isolation_level=None,
+                                    check_same_thread=False )
+        self._db.execute( 'PRAGMA synchronous=OFF' )
+        self._db.execute( 'CREATE TABLE IF NOT EXISTS sessions '
+                          '(id TEXT PRIMARY KEY, data BLOB)' )
+
+    def get( self, sid ):
+        row = self._db.execute( 'SELECT data FROM sessions WHERE id=?',
+                                (sid,) ).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def put( self, sid, data ):
+        self._db.execute( 'INSERT OR REPLACE INTO sessions VALUES (?,?)',
+                          (sid, sqlite3.Binary(data)) )
+
+    def delete( self, sid ):
+        self._db.execute( 'DELETE FROM sessions WHERE id=?', (sid,) )
+
+    def __contains__( self, sid ):
+        return self._db.execute( 'SELECT 1 FROM sessions WHERE id=?',
+                                 (sid,) ).fetchone() is not None
+
+    def __len__( self ):
+        return self._db.execute( 'SELECT COUNT(*) FROM sessions' ).fetchone()[0]
+
+    def keys( self ):
+        return [ r[0] for r in self._db.execute('SELECT id FROM sessions') ]
+
+    def close( self ):
+        self._db.close()
+
+
+class _DbmSpill( object ):
+    """
+    Sessions spilled to a dbm file: session id -> encoded data
+    """
+
+    def __init__( self, filename ):
+        self._db = dbm.open( filename, 'c' )
+
+    def get( self, sid ):
+        return self._db.get( sid.encode('utf-8') )
+
+    def put( self, sid, data ):
+        self._db[sid.encode('utf-8')] = data
+
+    def delete( self, sid ):
+        key = sid.encode('utf-8')
+        if key in self._db:
+            del self._db[key]
+
+    def __contains__( self, sid ):
+        return sid.encode('utf-8') in self._db
+
+    def __len__( self ):
+        return len(self._db)
+
+    def keys( self ):
+        return [ k.decode('utf-8') for k in self._db.keys() ]
+
+    def close( self ):
+        self._db.close()
+
+
+# -------------------------------------------------------------------------
+
+# The trailer of a session table: magic, format version, offset and size of
+# the index
+_TABLE_MAGIC = b'AIMLSES\x00'
+_TABLE_TRAILER = struct.Struct( '<8sIQQ' )
+
+
+def write_table( items, f ):
+    """
+    Write a session table to a file object. The data of each session is
+    written as it comes; only the index is kept until the end
+      @param items (iterable): (session id, encoded session data) tuples
+      @return (int): the number of sessions written
+    """
+    ids, offsets = [], [ 0 ]
+    for sid, raw in items:
+        f.write( raw )
+        ids.append( sid )
+        offsets.append( offsets[-1] + len(raw) )
+    index = marshal.dumps( (ids, offsets) )
+    f.write( index )
+    f.write( _TABLE_TRAILER.pack(_TABLE_MAGIC, 1, offsets[-1], len(index)) )
+    return len(ids)
+
+
+class SessionTable( object ):
+    """
+    The sessions in a session table held in a buffer: session id -> encoded
+    data. Sessions taken from the table are no longer in it (the buffer is
+    read-only)
+    """
+
+    def __init__( self, buf ):
+        buf = memoryview( buf )
+        if len(buf) < _TABLE_TRAILER.size:
+            raise ValueError( 'not a session table' )
+        magic, version, start, size = _TABLE_TRAILER.unpack_from(
+            buf, len(buf) - _TABLE_TRAILER.size )
+        if magic != _TABLE_MAGIC or version != 1:
+            raise ValueError( 'not a session table' )
+        ids, offsets = marshal.loads( buf[start:start+size].tobytes() )
+        self._buf = buf
+        self._index = dict( (sid, (offsets[n], offsets[n+1]))
+                            for n, sid in enumerate(ids) )
+
+    def get( self, sid ):
+        pos = self._index.get( sid )
+        return None if pos is None else self._buf[pos[0]:pos[1]].tobytes()
+
+    def take( self, sid ):
+        raw = self.get( sid )
+        self._index.pop( sid, None )
+        return raw
+
+    def __contains__( self, sid ):
+        return sid in self._index
+
+    def __len__( self ):
+        return len(self._index)
+
+    def keys( self ):
+        return list( self._index )
+
+
+# -------------------------------------------------------------------------
+
+class History( object ):
+    """
+    A fixed-capacity ring buffer holding the most recent entries of a
+    conversation history. It supports the list operations pyAIML uses on
+    history lists: append(), len() and indexing (a negative index counts
+    back from the most recent entry). Appending to a full buffer drops the
+    oldest entry
+    """
+    __slots__ = ( '_items', '_next', '_len' )
+
+    def __init__( self, depth, items=() ):
+        self._items = [ None ] * max( 1, depth )
+        self._next = self._len = 0
+        for item in list(items)[-len(self._items):]:
+            self.append( item )
+
+    def append( self, item ):
+        items = self._items
+        items[self._next] = item
+        self._next += 1
+        if self._next == len(items):
+            self._next = 0
+        if self._len < len(items):
+            self._len += 1
+
+    def __getitem__( self, index ):
+        n = self._len
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError( 'history index out of range' )
+        return self._items[ (self._next - n + index) % len(self._items) ]
+
+    def __len__( self ):
+        return self._len
+
+    def __iter__( self ):
+        return ( self[i] for i in range(self._len) )
+
+    def __eq__( self, other ):
+        return list(self) == list(other)
+
+    def __ne__( self, other ):
+        return not self == other
+
+    def __reduce__( self ):
+        return History, ( len(self._items), list(self) )
+
+    def __repr__( self ):
+        return 'History({}, {!r})'.format( len(self._items), list(self) )
+
+    @property
+    def depth( self ):
+        """The capacity of the buffer"""
+        return len(self._items)
+
+
+# -------------------------------------------------------------------------
+
+class SessionStore( object ):
+    """
+    A mapping session id -> session data (a dict of predicates), with the
+    dict operations pyAIML uses on its session dict. Session ids must be
+    strings.
+
+    Memory holds the most recently used sessions, up to \c max_sessions,
+    and (if \c ttl is set) only those used in the last \c ttl seconds;
+    the others are spilled to disk, to a file created on the first
+    eviction. A spilled session moves back to memory when accessed, and
+    so do the sessions of a session table added with load_table().
+    """
+
+    def __init__( self, max_sessions=0, ttl=0, filename=None ):
+        """
+          @param max_sessions (int): maximum number of sessions in memory
+            (0 means no limit)
+          @param ttl (float): idle time, in seconds, after which a session
+            is spilled (0 means no limit)
+          @param filename (str): the spill file. If not given, a temporary
+            file is used (and deleted on close()). Sessions already in the
+            file are available to this store
+        """
+        self.max_sessions = max( 1, max_sessions ) if max_sessions else 0
+        self.ttl = ttl
+        self._filename = filename
+        self._tmpdir = None
+        self._spill = None if filename is None else self._open( filename )
+        # Sessions from a session table, not used yet
+        self._table = None
+        # Resident sessions, in LRU order, and their last access time
+        self._data = OrderedDict()
+        self._atime = {}
+        # The session used last (repeated accesses to it are the fast path)
+        self._last = self._lastdata = None
+        self.evictions = self.restores = 0
+
+
+    def _open( self, filename ):
+        """
+        Open the spill file
+        """
+        return _SqliteSpill( filename ) if sqlite3 else _DbmSpill( filename )
+
+
+    def __getitem__( self, sid ):
+        if sid == self._last:
+            return self._lastdata
+        data = self._data.pop( sid, None )
+        if data is None:
+            data = self._restore( sid )
+        self._data[sid] = data
+        self._touch( sid, data )
+        return data
+
+
+    def __setitem__( self, sid, data ):
+        if self._data.pop( sid, None ) is None:
+            self._discard( sid )
+        self._data[sid] = data
+        self._touch( sid, data )
+
+
+    def __delitem__( self, sid ):
+        if self.pop( sid, None ) is None:
+            raise KeyError( sid )
+
+
+    def __contains__( self, sid ):
+        return sid in self._data or \
+            (self._spill is not None and sid in self._spill) or \
+            (self._table is not None and sid in self._table)
+
+
+    def __len__( self ):
+        return len(self._data) + (len(self._spill) if self._spill else 0) + \
+            (len(self._table) if self._table else 0)
+
+
+    def __iter__( self ):
+        return iter( self.keys() )
+
+
+    def __deepcopy__( self, memo ):
+        # A copy of all the sessions, as a regular dict
+        out = dict( (sid, pickle.loads(raw)) for sid, raw in self._encoded() )
+        out.update( (sid, pickle.loads(pickle.dumps(data, -1)))
+                    for sid, data in self._data.items() )
+        return out
+
+
+    def keys( self ):
+        return list( self._data ) + \
+            ( self._spill.keys() if self._spill else [] ) + \
+            ( self._table.keys() if self._table else [] )
+
+
+    def get( self, sid, default=None ):
+        try:
+            return self[sid]
+        except KeyError:
+            return default
+
+
+    def pop( self, sid, *default ):
+        """
+        Remove a session, and return its data
+        """
+        if sid == self._last:
+            self._last = self._lastdata = None
+        data = self._data.pop( sid, None )
+        if data is not None:
+            del self._atime[sid]
+        elif self._spill is not None and sid in self._spill:
+            data = pickle.loads( self._spill.get(sid) )
+            self._spill.delete( sid )
+        elif self._table is not None and sid in self._table:
+            data = pickle.loads( self._table.take(sid) )
+        elif default:
+            return default[0]
+        else:
+            raise KeyError( sid )
+        return data
+
+
+    def _touch( self, sid, data ):
+        """
+        Register a use of a session, and evict sessions as needed
+        """
+        now = time.time()
+        # The previous session was in use until now
+        if self._last in self._atime:
+            self._atime[self._last] = now
+        self._atime[sid] = now
+        self._last, self._lastdata = sid, data
+        # Evict the least recently used sessions (never the current one)
+        data = self._data
+        while self.max_sessions and len(data) > self.max_sessions:
+            self._evict( next(iter(data)) )
+        if self.ttl:
+            limit = now - self.ttl
+            while len(data) > 1:
+                oldest = next( iter(data) )
+                if self._atime[oldest] >= limit:
+                    break
+                self._evict( oldest )
+
+
+    def _evict( self, sid ):
+        """
+        Move a session from memory to the spill file
+        """
+        if self._spill is None:
+            self._tmpdir = tempfile.mkdtemp( prefix='aimlbot-' )
+            self._filename = os.path.join( self._tmpdir, 'sessions.db' )
+            self._spill = self._open( self._filename )
+        data = self._data.pop( sid )
+        del self._atime[sid]
+        self._spill.put( sid, pickle.dumps(data, -1) )
+        self.evictions += 1
+
+
+    def _restore( self, sid ):
+        """
+        Move a session from the spill file (or the session table) to
+        memory, and return its data
+        """
+        raw = self._spill.get( sid ) if self._spill is not None else None
+        if raw is not None:
+            self._spill.delete( sid )
+        elif self._table is not None:
+            raw = self._table.take( sid )
+        if raw is None:
+            raise KeyError( sid )
+        self.restores += 1
+        return pickle.loads( raw )
+
+
+    def _discard( self, sid ):
+        """
+        Remove a session that is not in memory
+        """
+        if self._spill is not None:
+            self._spill.delete( sid )
+        if self._table is not None:
+            self._table.take( sid )
+
+
+    def _encoded( self ):
+        """
+        Iterate over the encoded data of the sessions not in memory, as
+        (session id, data) tuples
+        """
+        for src in (self._spill, self._table):
+            if src is not None:
+                for sid in src.keys():
+                    yield sid, src.get( sid )
+
+
+    def dump( self, f ):
+        """
+        Write all the sessions (in memory, spilled or not used yet) to a
+        file object, as a session table. Sessions not in memory are copied
+        without decoding them
+          @return (int): the number of sessions written
+        """
+        def items():
+            for sid, data in self._data.items():
+                yield sid, pickle.dumps( data, -1 )
+            for item in self._encoded():
+                yield item
+        return write_table( items(), f )
+
+
+    def load_table( self, table ):
+        """
+        Add the sessions in a session table, replacing those with the same
+        ids. They are decoded (and moved to memory) when first used
+          @param table (SessionTable): the table
+          @return (int): the number of sessions in the table
+        """
+        for sid in table.keys():
+            if sid == self._last:
+                self._last = self._lastdata = None
+            if self._data.pop( sid, None ) is not None:
+                del self._atime[sid]
+            else:
+                self._discard( sid )
+        # (sessions from a previous table are kept in memory)
+        if self._table:
+            for sid in self._table.keys():
+                self[sid]
+        self._table = table
+        return len(table)
+
+
+    def close( self ):
+        """
+        Close the spill file (deleting it, if temporary). Spilled sessions
+        are lost, unless the spill file was given by the caller
+        """
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        self._table = None
+        if self._tmpdir is not None:
+            shutil.rmtree( self._tmpdir, ignore_errors=True )
+            self._tmpdir = self._filename = None
+
+
+    def stats( self ):
+        """
+        Return the store statistics, as a list of (name, value) tuples
+        """
+        return [ ('resident', len(self._data)),
+                 ('spilled', len(self._spill) if self._spill else 0),
+                 ('loaded, not used yet', len(self._table) if self._table else 0),
+                 ('max sessions', self.max_sessions or 'unlimited'),
+                 ('idle ttl', '{}s'.format(self.ttl) if self.ttl else 'unlimited'),
+                 ('evictions', self.evictions),
+                 ('restores', self.restores),
+                 ('spill file', self._filename or '-') ]
@@ -1,12 +1,24 @@
 """
-Install a logging configuration for kernel modules
-"""
+Install a logging configuration for kernel modules.
 
+Optionally the log file is written by a separate thread: loggers only put
+the records in a queue (without even formatting them), so that logging
+does not add file I/O to the execution of cells.
+"""
 
+import sys
+import logging
 from logging.config import dictConfig
 import tempfile
+import atexit
 import os
 import os.path
+try:
+    from logging.handlers import QueueHandler, QueueListener
+    import queue
+except ImportError:
+    # Python 2: no queue mode
+    QueueHandler = None
 
 
 # ----------------------------------------------------------------------
@@ -28,10 +40,10 @@ LOGCONFIG = {
         },
 
     'loggers' : { 
-                  # the parent logger for sparqlkernel modules
-                  'sparqlkernel' : { 'level' : 'INFO',
-                                     'propagate' : False,
-                                     'handlers' : ['default'] },
+                  # the parent logger for aimlbotkernel modules
+                  'aimlbotkernel' : { 'level' : 'INFO',
+                                      'propagate' : False,
+                                      'handlers' : ['default'] },
 
                   # This is the logger for the base kernel app
                   'IPKernelApp' : { 'level' : 'INFO',
@@ -46,9 +58,60 @@ LOGCONFIG = {
 }
 
 
+# The thread writing the queued records, in queue mode
+_listener = None
+
+
+if QueueHandler is not None:
+
+    class _RecordQueueHandler( QueueHandler ):
+        """
+        A QueueHandler that merges the message arguments into the record
+        (so that they can be modified after being logged), but leaves the
+        formatting of tracebacks to the listener thread
+        """
+        def prepare( self, record ):
+            record.msg = record.getMessage()
+            record.args = None
+            return record
+
+
+def _queue_handlers():
+    """
+    Move the handlers set by the configuration to a listener thread, and
+    make the loggers use a queue instead
+    """
+    global _listener
+    _stop_listener()
+    handlers = []
+    q = queue.Queue( -1 )
+    qhandler = _RecordQueueHandler( q )
+    for name in [ None ] + list( LOGCONFIG['loggers'] ):
+        logger = logging.getLogger( name )
+        for h in logger.handlers[:]:
+            if h not in handlers:
+                handlers.append( h )
+            logger.removeHandler( h )
+        logger.addHandler( qhandler )
+    _listener = QueueListener( q, *handlers, respect_handler_level=True )
+    _listener.start()
+
+
+def _stop_listener():
+    """
+    Stop the listener thread, once it has written all the queued records
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register( _stop_listener )
+
+
 # ----------------------------------------------------------------------
 
-def set_logging( logfilename=None, level=None ):
+def set_logging( logfilename=None, level=None, threaded=False ):
     """
     Set a logging configuration, with a rolling file appender.
     If passed a filename, use it as the logfile, else use a default name.
@@ -56,6 +119,9 @@ def set_logging( logfilename=None, level=None ):
     The default logfile is \c aimlbotkernel-<uid>.log, placed in the directory 
     given by (in this order) the \c LOGDIR environment variable, the logdir
     specified upon kernel installation or the default temporal directory.
+
+    If \c threaded is true (and the Python version supports it), the file
+    is written by a separate thread, fed through a queue.
     """
     if logfilename is None:
         # Find the logging diectory
@@ -72,10 +138,29 @@ def set_logging( logfilename=None, level=None ):
             logname = '{}.log'.format( basename )
         logfilename = os.path.join( logdir, logname )
     
+    _stop_listener()
     LOGCONFIG['handlers']['default']['filename'] = logfilename
     if level is not None:
-        LOGCONFIG['loggers']['sparqlkernel']['level'] = level
+        LOGCONFIG['loggers']['aimlbotkernel']['level'] = level
     dictConfig( LOGCONFIG )
+    if threaded and QueueHandler is not None:
+        _queue_handlers()
+
+
+def set_level( level, name=None ):
+    """
+    Set the level of a logger: the parent logger of the kernel modules (by
+    default), the logger of one of them (given its module name, e.g.
+    \c kernel) or any other one (e.g. \c IPKernelApp)
+      @return (str): the name of the logger
+    """
+    package = __name__.rsplit( '.', 1 )[0]
+    if name is None:
+        name = package
+    elif package + '.' + name in sys.modules:
+        name = package + '.' + name
+    logging.getLogger( name ).setLevel( level )
+    return name
 
 
 def logfilename():
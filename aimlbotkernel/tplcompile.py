@@ -0,0 +1,301 @@
+"""
+Compile AIML templates into Python closures.
+
+pyAIML evaluates a template by walking its element list on every use, with
+a dict lookup and a method call per element and repeated string
+concatenation. Here each template is converted once into a tree of
+closures: text is normalized in advance and folded into constants, and
+each element becomes a function of the session id that produces its
+output. Elements without a specialized translation fall back to the
+regular interpreter (the Kernel element processors).
+
+A template can also be compiled in an instrumented variant, used while the
+bot is profiling or tracing: each non-constant element function is wrapped
+to time it, and the interpreter fallback goes through the bot's
+_TRACE_processElement(). The wrappers look up the bot's profiler and tracer
+on each call, so both variants stay valid when those are switched or reset.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import re
+import random
+import string
+
+
+class TemplateCompiler( object ):
+    """
+    Compile template element lists for a given bot (a Kernel instance)
+    """
+
+    def __init__( self, bot ):
+        self._bot = bot
+        self._compilers = {
+            'template' :  self._cmpConcat,
+            'li' :        self._cmpConcat,
+            'text' :      self._cmpText,
+            'condition' : self._cmpCondition,
+            'formal' :    lambda e : self._cmpPost( e, string.capwords ),
+            'lowercase' : lambda e : self._cmpPost( e, lambda s : s.lower() ),
+            'uppercase' : lambda e : self._cmpPost( e, lambda s : s.upper() ),
+            'gender' :    self._cmpSubber,
+            'person' :    self._cmpSubber,
+            'person2' :   self._cmpSubber,
+            'random' :    self._cmpRandom,
+            'sentence' :  self._cmpSentence,
+            'set' :       self._cmpSet,
+            'srai' :      self._cmpSrai,
+            'think' :     self._cmpThink,
+            'gossip' :    self._cmpThink,
+            'javascript' :self._cmpThink,
+            'get' :       self._cmpGet,
+            'bot' :       self._cmpBot,
+        }
+        # Atomic elements: delegate directly to their element processor
+        self._atomic = ( 'date', 'id', 'input', 'size', 'sr', 'star', 'that',
+                         'thatstar', 'topicstar', 'version' )
+        # Compiling the instrumented variant
+        self._instrumented = False
+
+
+    def compile( self, elem, instrumented=False ):
+        """
+        Compile an element list into a function that takes a session id
+        and returns the element output
+          @param instrumented (bool): compile the variant for profiling and
+            tracing
+        """
+        self._instrumented = instrumented
+        try:
+            return self._element( elem )
+        finally:
+            self._instrumented = False
+
+
+    def _element( self, elem ):
+        """
+        Compile an element list, instrumenting it if needed
+        """
+        fn = self._compile( elem )
+        if isinstance(fn,_Const) or not self._instrumented:
+            return fn
+        return self._instrument( elem[0], fn )
+
+
+    def _instrument( self, name, fn ):
+        """
+        Wrap an element function to time its evaluations, for the profiler
+        and the tracer the bot has when it is called
+        """
+        bot = self._bot
+        def profiled( sid ):
+            profiler = bot._profiler
+            if profiler is None:
+                return fn( sid )
+            return profiler.call( name, fn, sid )
+        def instrumented( sid ):
+            tracer = bot._tracer
+            if tracer is None or not tracer.wants( name ):
+                return profiled( sid )
+            return tracer.call( name, profiled, sid )
+        return instrumented
+
+
+    def _compile( self, elem ):
+        """
+        Compile an element list, without instrumenting it
+        """
+        name = elem[0]
+        cmp = self._compilers.get( name )
+        if cmp is not None:
+            try:
+                return cmp( elem )
+            except (KeyError, IndexError, TypeError, AttributeError):
+                # malformed element (e.g. missing attributes): leave it for
+                # the interpreter, which will report the problem at runtime
+                pass
+        else:
+            proc = self._bot._elementProcessors.get( name )
+            if name in self._atomic and proc is not None:
+                return lambda sid : proc( elem, sid )
+        # Anything else: use the interpreter for the whole subtree
+        process = self._bot._TRACE_processElement if self._instrumented \
+                  else self._bot._processElement
+        return lambda sid : process( elem, sid )
+
+
+    def _children( self, elem ):
+        """
+        Compile the children of an element, merging consecutive constant
+        strings. Return a list of functions, or a string if all the
+        children are constant
+        """
+        out = []
+        for e in elem[2:]:
+            f = self._element( e )
+            if isinstance(f,_Const) and out and isinstance(out[-1],_Const):
+                out[-1] = _Const( out[-1].value + f.value )
+            else:
+                out.append( f )
+        if not out:
+            return u""
+        elif len(out) == 1 and isinstance(out[0],_Const):
+            return out[0].value
+        return out
+
+
+    def _concat( self, elem ):
+        """
+        Return a function that evaluates and joins the children of an
+        element, or a _Const if they are all constant
+        """
+        fns = self._children( elem )
+        if not isinstance(fns,list):
+            return _Const( fns )
+        elif len(fns) == 1:
+            return fns[0]
+        return lambda sid : u''.join( [ f(sid) for f in fns ] )
+
+    # -----------------------------------------------------------------
+
+    def _cmpConcat( self, elem ):
+        return self._concat( elem )
+
+
+    def _cmpPost( self, elem, post ):
+        content = self._concat( elem )
+        return lambda sid : post( content(sid) )
+
+
+    def _cmpText( self, elem ):
+        # Same whitespace handling as Kernel._processText
+        if elem[1]["xml:space"] == "default":
+            return _Const( re.sub(r"\s+", " ", elem[2]) )
+        return _Const( elem[2] )
+
+
+    def _cmpGet( self, elem ):
+        getPredicate, name = self._bot.getPredicate, elem[1]['name']
+        return lambda sid : getPredicate( name, sid )
+
+
+    def _cmpBot( self, elem ):
+        getBotPredicate, name = self._bot.getBotPredicate, elem[1]['name']
+        return lambda sid : getBotPredicate( name )
+
+
+    def _cmpSubber( self, elem ):
+        bot, name = self._bot, elem[0]
+        if len(elem) == 2:
+            # atomic <person/> is a shortcut for <person><star/></person>
+            star = bot._elementProcessors['star']
+            content = lambda sid : star( ['star', {}], sid )
+        else:
+            content = self._concat( elem )
+        return lambda sid : bot._subbers[name].sub( content(sid) )
+
+
+    def _cmpThink( self, elem ):
+        fns = self._children( elem )
+        if not isinstance(fns,list):
+            return _Const( u"" )
+        def think( sid ):
+            for f in fns:
+                f( sid )
+            return u""
+        return think
+
+
+    def _cmpSet( self, elem ):
+        setPredicate, name = self._bot.setPredicate, elem[1]['name']
+        content = self._concat( elem )
+        def set_( sid ):
+            value = content( sid )
+            setPredicate( name, value, sid )
+            return value
+        return set_
+
+
+    def _cmpSrai( self, elem ):
+        bot = self._bot
+        content = self._concat( elem )
+        if isinstance(content,_Const) and content.value:
+            # constant input: the bot may resolve it in advance
+            text = content.value
+            return lambda sid : bot._srai( text, sid )
+        return lambda sid : bot._respond( content(sid), sid )
+
+
+    def _cmpSentence( self, elem ):
+        content = self._concat( elem )
+        def sentence( sid ):
+            words = content( sid ).strip().split( " ", 1 )
+            words[0] = words[0].capitalize()
+            return ' '.join( words )
+        return sentence
+
+
+    def _cmpRandom( self, elem ):
+        items = [ self._element(e) for e in elem[2:] if e[0] == 'li' ]
+        if not items:
+            return _Const( u"" )
+        def random_( sid ):
+            # Shuffle a fresh list, to use the same random sequence as
+            # Kernel._processRandom
+            lst = list( items )
+            random.shuffle( lst )
+            return lst[0]( sid )
+        return random_
+
+
+    def _cmpCondition( self, elem ):
+        attr = elem[1]
+        getPredicate = self._bot.getPredicate
+        if 'name' in attr and 'value' in attr:
+            # Block condition
+            name, value = attr['name'], attr['value']
+            content = self._concat( elem )
+            return lambda sid : content(sid) if getPredicate(name,sid) == value else u""
+
+        # Single or multi-predicate condition: a list of <li> elements
+        listitems = [ e for e in elem[2:] if e[0] == 'li' ]
+        if not listitems:
+            return _Const( u"" )
+        name = attr.get( 'name' )
+        tests = []
+        for li in listitems[:-1]:
+            liAttr = li[1]
+            # (a KeyError for a malformed item sends it to the interpreter)
+            tests.append( (name if name is not None else liAttr['name'],
+                           liAttr['value'], self._element(li)) )
+        # The last item may be a default item, if it has no attributes
+        last = listitems[-1]
+        default = None
+        if len(last[1]) == 0:
+            default = self._element( last )
+        else:
+            tests.append( (name if name is not None else last[1]['name'],
+                           last[1]['value'], self._element(last)) )
+
+        def condition( sid ):
+            for n, v, f in tests:
+                if getPredicate( n, sid ) == v:
+                    return f( sid )
+            return default( sid ) if default is not None else u""
+        return condition
+
+
+# -------------------------------------------------------------------------
+
+class _Const( object ):
+    """
+    A constant-valued template fragment. Callable, so it can be used as
+    any other compiled function; compilers check for it to fold constants
+    """
+    __slots__ = ( 'value', )
+
+    def __init__( self, value ):
+        self.value = value
+
+    def __call__( self, sid ):
+        return self.value
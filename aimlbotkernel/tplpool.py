@@ -0,0 +1,173 @@
+"""
+A pool of shared template elements.
+
+The AIML parsers produce a separate element list for every template, with
+a separate attribute dict for every element, even though many templates
+are identical (thousands of the ALICE categories are just a <srai>) and
+most elements have the same attributes. Templates added to the pool are
+hash-consed bottom up: each distinct element (and attribute dict) is kept
+once, and shared by all the templates that contain it.
+
+Shared elements must not be modified afterwards. The only modification
+done by the pyAIML interpreter is the whitespace normalization of text
+elements the first time they are used; the pool applies it in advance, so
+that the interpreter leaves them alone.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import re
+import sys
+import marshal
+
+
+_WHITESPACE = re.compile( r"\s+" )
+
+_PRESERVE = 'xml:space', 'preserve'
+
+
+class TemplatePool( object ):
+    """
+    Deduplicate template element lists. Elements are indexed by a hash of
+    their name, attribute dict and (already shared) children
+    """
+
+    def __init__( self ):
+        self.clear()
+
+
+    def clear( self ):
+        """
+        Forget all the elements in the pool
+        """
+        # hash -> element
+        self._elems = {}
+        # sorted attribute items -> attribute dict
+        self._preserve = { _PRESERVE[0] : _PRESERVE[1] }
+        self._noattrs = {}
+        self._attrs = { (_PRESERVE,) : self._preserve, () : self._noattrs }
+        # templates added, and those found already in the pool
+        self.added = self.reused = 0
+
+
+    def __len__( self ):
+        return len(self._elems)
+
+
+    def checkpoint( self ):
+        """
+        Return the current contents of the pool, for rollback()
+        """
+        return dict(self._elems), dict(self._attrs), self.added, self.reused
+
+
+    def rollback( self, state ):
+        """
+        Forget the elements added to the pool since a checkpoint
+        """
+        elems, attrs, self.added, self.reused = state
+        self._elems, self._attrs = elems, attrs
+
+
+    def share( self, template ):
+        """
+        Return the pooled version of a template: either an identical one
+        already in the pool, or a copy of it built from pooled elements
+        """
+        self.added += 1
+        size = len(self._elems)
+        elem = self._share( template )
+        if len(self._elems) == size:
+            self.reused += 1
+        return elem
+
+
+    def share_many( self, templates ):
+        """
+        Return the pooled versions of a list of templates. Templates that
+        are identical within the list (e.g. the many <srai> ones in an AIML
+        file) are pooled only once
+        """
+        seen = {}
+        out = []
+        for tem in templates:
+            blob = marshal.dumps( tem )
+            elem = seen.get( blob )
+            if elem is None:
+                elem = seen[blob] = self.share( tem )
+            else:
+                self.added += 1
+                self.reused += 1
+            out.append( elem )
+        return out
+
+
+    def _share( self, elem ):
+        """
+        Pool an element and its children (recursively)
+        """
+        name, attr = elem[0], elem[1]
+        if name == 'text' and attr.get('xml:space') == 'default':
+            # Same whitespace handling as Kernel._processText
+            new = [ name, self._preserve, _WHITESPACE.sub(u" ", elem[2]) ]
+            key = hash( (name, id(new[1]), new[2]) )
+        else:
+            if attr:
+                items = tuple( sorted(attr.items()) )
+                shared = self._attrs.get( items )
+                if shared is None:
+                    shared = self._attrs[items] = dict( attr )
+            else:
+                shared = self._noattrs
+            new = [ name, shared ]
+            new += [ self._share(c) if isinstance(c,list) else c
+                     for c in elem[2:] ]
+            key = hash( (name, id(shared)) +
+                        tuple([ id(c) if isinstance(c,list) else c
+                                for c in new[2:] ]) )
+        found = self._elems.get( key )
+        if found is not None and found == new:
+            return found
+        # (on a hash collision, the new element replaces the old one)
+        self._elems[key] = new
+        return new
+
+
+    def stats( self ):
+        """
+        Return the pool statistics, as a list of (name, value) tuples
+        """
+        return [ ('templates added', self.added),
+                 ('templates shared', self.reused),
+                 ('distinct elements', len(self._elems)),
+                 ('distinct attribute sets', len(self._attrs)) ]
+
+
+def deep_size( objects ):
+    """
+    Return the approximate memory used by a collection of (possibly nested)
+    lists, dicts and strings, counting shared objects only once
+      @param objects (iterable): the top-level objects
+    """
+    seen = set()
+    total = 0
+    pending = list( objects )
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add( id(obj) )
+        total += sys.getsizeof( obj )
+        if isinstance(obj, (list,tuple)):
+            pending.extend( obj )
+        elif isinstance(obj, dict):
+            pending.extend( obj.keys() )
+            pending.extend( obj.values() )
+    return total
+
+
+def format_size( size ):
+    """
+    Format a number of bytes for display
+    """
+    return u'{:.1f} MB'.format( size/(1024*1024) )
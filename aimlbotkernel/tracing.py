@@ -0,0 +1,235 @@
+"""
+Structured request tracing for AimlBot.
+
+A Tracer records compact events into a bounded ring buffer (the oldest
+events are dropped when it is full):
+ * request: a top-level input, with its session, wall-clock time and the
+   total time taken to respond
+ * input: an input reaching the matcher (a sentence of a request, or the
+   content of a <srai>), with the normalized <that> and topic
+ * match: the template matched by the preceding input (None if none)
+ * cache: the preceding input was answered from the response cache or the
+   <srai> memo
+ * element: the evaluation of a template element, with its duration
+
+Every event has the sequence number of its request, the <srai> depth at
+which it happened and (for elements) the element nesting level. Events are
+recorded in evaluation order, so an element comes before the elements it
+contains.
+
+Requests are sampled, and can be filtered by session and by an input
+regex; element events can be restricted to some element names. Element
+events are produced by the instrumented variant of the compiled templates
+(see TemplateCompiler), so there is no cost for them while tracing is off,
+and only a flag check for requests not sampled.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import re
+import io
+import json
+import time
+import random
+from collections import deque
+from itertools import count
+
+from .profiler import clock
+
+
+class TraceEvent( object ):
+    """
+    A trace record
+    """
+    __slots__ = ( 'request', 'kind', 'depth', 'level', 'name', 'data',
+                  'duration' )
+
+    def __init__( self, request, kind, depth, level=0, name=None, data=None ):
+        self.request = request
+        self.kind = kind
+        self.depth = depth
+        self.level = level
+        self.name = name
+        self.data = data
+        self.duration = None
+
+
+    def as_dict( self, resolve=None ):
+        """
+        Convert the event into a dict, with only the fields meaningful for
+        its kind
+          @param resolve (callable): a function returning the
+            [pattern/that/topic] key of a template (for match events)
+        """
+        out = { 'request' : self.request, 'event' : self.kind,
+                'depth' : self.depth }
+        if self.kind == 'request':
+            out.update( session=self.name, input=self.data[0],
+                        time=self.data[1] )
+        elif self.kind == 'input':
+            out.update( zip(('input', 'that', 'topic'), self.data) )
+        elif self.kind == 'match':
+            key = None
+            if self.data is not None and resolve is not None:
+                key = resolve( self.data )
+            out.update( matched=self.data is not None,
+                        pattern=list(key) if key else None )
+        elif self.kind == 'element':
+            out.update( element=self.name, level=self.level )
+        if self.duration is not None:
+            out['duration'] = self.duration
+        return out
+
+
+class Tracer( object ):
+    """
+    A ring buffer of trace events, and the state of the request being traced
+    """
+
+    def __init__( self, size=10000, sample=1.0, sessions=None, inputs=None,
+                  elements=None ):
+        """
+          @param size (int): maximum number of events kept
+          @param sample (float): fraction of the requests traced
+          @param sessions (iterable): trace only requests in these sessions
+            (None for all)
+          @param inputs (str): trace only requests whose input matches
+            this regex (searched, case-insensitive)
+          @param elements (iterable): record only these template elements
+            (None for all, empty for none)
+        """
+        self.events = deque( maxlen=max(1, size) )
+        self.sample = sample
+        self.sessions = None if sessions is None else frozenset( sessions )
+        self.inputs = re.compile( inputs, re.I ) if inputs else None
+        self.elements = None if elements is None else frozenset( elements )
+        # State of the current request
+        self.active = False
+        self.depth = self.level = 0
+        self.current = None
+        self._seq = count( 1 )
+        self.requests = self.traced = 0
+
+
+    def wants( self, name ):
+        """
+        Check if an element type should be recorded
+        """
+        return self.elements is None or name in self.elements
+
+
+    def begin( self, input_, sessionID ):
+        """
+        Start a request. If it is sampled, record it and return its event
+        (to be passed to end()), else return None
+        """
+        self.requests += 1
+        if self.active:
+            return None
+        if self.sessions is not None and sessionID not in self.sessions:
+            return None
+        if self.inputs is not None and not self.inputs.search( input_ ):
+            return None
+        if self.sample < 1 and random.random() >= self.sample:
+            return None
+        self.traced += 1
+        self.current = next( self._seq )
+        self.active = True
+        self.depth = self.level = 0
+        ev = TraceEvent( self.current, 'request', 0, 0, sessionID,
+                         (input_, time.time()) )
+        self.events.append( ev )
+        return ev
+
+
+    def end( self, ev, elapsed ):
+        """
+        Finish a traced request
+        """
+        ev.duration = elapsed
+        self.active = False
+
+
+    def event( self, kind, depth, data=None ):
+        """
+        Record an event in the current request
+        """
+        self.events.append( TraceEvent(self.current, kind, depth, 0, None,
+                                       data) )
+
+
+    def call( self, name, fn, sid ):
+        """
+        Evaluate a compiled template function, recording the evaluation as
+        an element event if the request is being traced
+        """
+        if not self.active:
+            return fn( sid )
+        ev = TraceEvent( self.current, 'element', self.depth, self.level,
+                         name )
+        self.events.append( ev )
+        self.level += 1
+        start = clock()
+        try:
+            return fn( sid )
+        finally:
+            ev.duration = clock() - start
+            self.level -= 1
+
+
+    def request_events( self, request=None ):
+        """
+        Return the events of a request (by default, the last one traced)
+        """
+        if request is None:
+            request = self.current
+        return [ ev for ev in self.events if ev.request == request ]
+
+
+    def records( self, resolve=None, last=None ):
+        """
+        Return the buffered events as dicts
+          @param resolve (callable): see TraceEvent.as_dict()
+          @param last (int): return only the events of the last \c last
+            requests traced
+        """
+        events = self.events
+        if last is not None and self.current is not None:
+            first = self.current - last
+            events = ( ev for ev in events if ev.request > first )
+        return [ ev.as_dict(resolve) for ev in events ]
+
+
+    def export( self, filename, resolve=None ):
+        """
+        Write the buffered events to a file, in JSON Lines format
+          @return (int): the number of events written
+        """
+        records = self.records( resolve )
+        with io.open( filename, 'w', encoding='utf-8' ) as f:
+            for r in records:
+                f.write( u'{}\n'.format(json.dumps(r, ensure_ascii=False)) )
+        return len(records)
+
+
+    def clear( self ):
+        """
+        Discard the buffered events
+        """
+        self.events.clear()
+
+
+    def stats( self ):
+        """
+        Return the tracer state, as a list of (name, value) tuples
+        """
+        return [ ('requests seen', self.requests),
+                 ('requests traced', self.traced),
+                 ('buffered events', len(self.events)),
+                 ('buffer size', self.events.maxlen),
+                 ('sample rate', self.sample),
+                 ('sessions', ' '.join(sorted(self.sessions))
+                  if self.sessions is not None else 'all'),
+                 ('inputs', self.inputs.pattern if self.inputs else 'all'),
+                 ('elements', ' '.join(sorted(self.elements))
+                  if self.elements is not None else 'all') ]
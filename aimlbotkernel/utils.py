@@ -3,7 +3,10 @@ Miscellaneous utility functions
 """
 from __future__ import absolute_import, division, print_function
 
+import os
+import io
 import logging
+from contextlib import contextmanager
 
 # A logger for this file
 LOG = None
@@ -129,7 +132,10 @@ class KrnlException( Exception ):
             msg = repr( msg )
         elif len(msg):
             msg = msg.format(*args)
-        getLogger().warn( "KrnlException: %s", msg, exc_info=1 )
+        # (these are expected errors: only trace them when debugging)
+        log = getLogger()
+        log.warn( "KrnlException: %s", msg,
+                  exc_info=log.isEnabledFor(logging.DEBUG) )
         super(KrnlException,self).__init__(msg)
 
     def __call__(self):
@@ -143,4 +149,23 @@ class KrnlException( Exception ):
                  'metadata' : {} }
 
 
+# ----------------------------------------------------------------------
 
+@contextmanager
+def atomic_write( filename, mode='wb', **kwargs ):
+    """
+    Open a file for writing under a temporary name, and rename it to the
+    final name once it has been written. If writing fails, the temporary
+    file is removed, and a previous version of the file is left untouched
+    """
+    tmpname = '{}.{}.tmp'.format( filename, os.getpid() )
+    try:
+        with io.open( tmpname, mode, **kwargs ) as f:
+            yield f
+        getattr( os, 'replace', os.rename )( tmpname, filename )
+    except BaseException:
+        try:
+            os.unlink( tmpname )
+        except OSError:
+            pass
+        raise
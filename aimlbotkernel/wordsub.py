@@ -0,0 +1,153 @@
+"""
+A substitution engine for AimlBot, replacing pyAIML's WordSub matching.
+
+WordSub compiles all its keys into a single regex alternation of the form
+\c \\bkey1\\b|\\bkey2\\b|..., rebuilt each time the dict changes, and the
+regex engine tries every alternative at every position of the text. With
+thousands of substitutions both the compilation and the matching become
+slow.
+
+TrieWordSub keeps the same dict of substitutions (including the lower,
+capitalized and upper case variants WordSub adds for each entry), but
+compiles the keys into a character trie, built once per bulk load. To
+apply it, the word boundaries followed by the first character of some key
+are located with a single regex scan, and the trie is walked only from
+those positions (a match must start at a word boundary). Among the keys
+found at a position that also end at a word boundary, the one added first
+is chosen, which is the alternative the WordSub regex would select, so the
+output is identical.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import re
+import string
+
+from aiml.WordSub import WordSub
+
+
+# Word boundaries, with the same definition of word characters as the
+# WordSub regex
+_BOUNDARY = re.compile( r'\b' )
+
+# Trie node entry holding the (order, replacement) of the key ending there
+_KEY = 0
+
+
+class TrieWordSub( WordSub ):
+    """
+    A WordSub that matches keys with a trie instead of a regex alternation
+    """
+
+    def __init__( self, defaults={} ):
+        dict.__init__( self )
+        self._regex = None
+        self._trie = self._starts = None
+        self._regexIsDirty = True
+        self.load( defaults.items() )
+
+
+    @classmethod
+    def from_subber( cls, subber ):
+        """
+        Create an instance holding exactly the same entries (in the same
+        order) as an existing WordSub
+        """
+        new = cls()
+        dict.update( new, subber )
+        return new
+
+
+    def load( self, items ):
+        """
+        Add a sequence of substitutions in bulk: the trie is rebuilt only
+        once, the next time the subber is used
+          @param items (iterable): (before, after) tuples
+          @return (int): the number of substitutions added
+        """
+        setitem = dict.__setitem__
+        capwords = string.capwords
+        n = 0
+        for n, (k, v) in enumerate( items, 1 ):
+            setitem( self, k.lower(), v.lower() )
+            setitem( self, capwords(k), capwords(v) )
+            setitem( self, k.upper(), v.upper() )
+        self._regexIsDirty = True
+        return n
+
+
+    def __setitem__( self, key, value ):
+        # (WordSub's version calls super(type(self),...), which recurses
+        # forever in a subclass)
+        self.load( ((key, value),) )
+
+
+    def __delitem__( self, key ):
+        self._regexIsDirty = True
+        dict.__delitem__( self, key )
+
+
+    def _update_regex( self ):
+        """
+        Build the trie from the current keys. An empty key (which would
+        match at every word boundary) is left to the WordSub regex
+        """
+        self._regexIsDirty = False
+        if '' in self:
+            self._trie = None
+            WordSub._update_regex( self )
+            return
+        trie = {}
+        for order, (k, v) in enumerate( self.items() ):
+            node = trie
+            for c in k:
+                nxt = node.get( c )
+                if nxt is None:
+                    nxt = node[c] = {}
+                node = nxt
+            node[_KEY] = order, v
+        self._trie = trie
+        # The positions where a match can start
+        first = u''.join( sorted(trie) )
+        self._starts = ( re.compile(r'\b(?=[' + re.escape(first) + '])')
+                         if first else None )
+
+
+    def sub( self, text ):
+        """Translate text, returns the modified text."""
+        if self._regexIsDirty:
+            self._update_regex()
+        trie = self._trie
+        if trie is None:
+            return self._regex.sub( self, text )
+        if self._starts is None:
+            return text
+
+        boundary = _BOUNDARY.match
+        n = len(text)
+        out = []
+        cursor = 0
+        for m in self._starts.finditer( text ):
+            p = m.start()
+            if p < cursor:
+                continue
+            node = trie[text[p]]
+            best = None
+            q = p + 1
+            while node is not None:
+                hit = node.get( _KEY )
+                if hit is not None and (best is None or hit[0] < best[0]) \
+                   and boundary( text, q ):
+                    best = hit[0], hit[1], q
+                if q == n:
+                    break
+                node = node.get( text[q] )
+                q += 1
+            if best is not None:
+                out.append( text[cursor:p] )
+                out.append( best[1] )
+                cursor = best[2]
+        if not out:
+            return text
+        out.append( text[cursor:] )
+        return u''.join( out )
@@ -0,0 +1,179 @@
+"""
+Compare the pyAIML PatternMgr against the compiled pattern matcher, using
+the ALICE and standard AIML sets bundled with python-aiml.
+
+For each set, both matchers are loaded with the same categories and then
+timed on
+ * match: direct calls to the matcher, over inputs generated from the
+   category patterns (wildcards are filled with random words, and some
+   inputs get extra words so that they fall through to generic patterns)
+ * star: the same inputs, followed by the <star/> extraction that templates
+   perform after a match
+ * respond: full AimlBot.respond() calls over a set of chat utterances
+
+Before timing, both matchers are checked to extract the same <star/> text
+for inputs that contain punctuation-only tokens.
+
+Usage: python benchmarks/bench_matcher.py [--sets alice,standard] [--num N]
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import sys
+import os
+import os.path
+import glob
+import random
+import time
+import argparse
+
+sys.path.insert( 0, os.path.join(os.path.dirname(__file__), '..') )
+
+import aiml
+from aiml.AimlParser import create_parser
+from aimlbotkernel.aimlbot import AimlBot
+
+
+BOTDATA = os.path.join( os.path.dirname(aiml.__file__), 'botdata' )
+LOAD = { 'alice' : 'load alice', 'standard' : 'load aiml b' }
+
+# Chat utterances for the respond benchmark
+UTTERANCES = [ 'Hello', 'What is your name?', 'How are you today',
+               'Do you like movies', 'I am a student', 'Tell me a joke',
+               'What is the meaning of life?', 'Who created you',
+               'My name is Peter', 'Where do you live', 'I like pizza',
+               'Are you a robot?', 'What time is it', 'Can you sing',
+               'Why is the sky blue', 'I do not understand you',
+               'What do you think about politics', 'Goodbye',
+               'Yes', 'No', 'Maybe later', 'What is AIML',
+               'Do you know my favorite color is green',
+               'Tell me something about history' ]
+
+FILLER = [ 'THE', 'DOG', 'YOU', 'MY', 'FRIEND', 'IS', 'A', 'VERY', 'GOOD',
+           'BIG', 'HOUSE', 'WHAT', 'I', 'LIKE', 'PIZZA', 'TODAY', 'ROBOT' ]
+
+
+# <star/> extraction checks: (input, expected response). Tokens made only
+# of punctuation disappear when the input is normalized, but stay in the
+# star text
+STAR_RULES = [ u'<category><pattern>WHAT IS *</pattern>'
+               u'<template>About <star/>.</template></category>',
+               u'<category><pattern>MY NAME IS *</pattern>'
+               u'<template>Hello <star/>!</template></category>' ]
+STAR_CHECKS = [ (u'what is a + b', u'About a + b.'),
+                (u'what is - a', u'About - a.'),
+                (u'my name is Jean - Paul', u'Hello Jean - Paul!'),
+                (u'my name is Jean -', u'Hello Jean -!') ]
+
+
+def check_star():
+    """Check the <star/> text extracted by both matchers"""
+    failed = 0
+    for matcher in ('pyaiml','compiled'):
+        bot = AimlBot( matcher=matcher )
+        bot.verbose( False )
+        bot.learn_buffer( STAR_RULES )
+        for inp, expected in STAR_CHECKS:
+            out = bot.respond( inp )
+            if not isinstance( out, type(expected) ):
+                out = out.decode( 'utf-8' )
+            if out != expected:
+                print( 'star check failed ({}): {!r} -> {!r}, expected {!r}'.format(
+                    matcher, inp, out, expected) )
+                failed += 1
+    return failed == 0
+
+
+def load_bot( name, matcher ):
+    """Create a bot and load an AIML set into it"""
+    bot = AimlBot( matcher=matcher )
+    bot.verbose( False )
+    prev = os.getcwd()
+    try:
+        os.chdir( os.path.join(BOTDATA, name) )
+        bot.learn( 'startup.xml' )
+        bot.respond( LOAD[name] )
+    finally:
+        os.chdir( prev )
+    return bot
+
+
+def make_inputs( name, num, rnd ):
+    """Generate (input, that, topic) match arguments out of the patterns"""
+    keys = []
+    for f in sorted( glob.glob(os.path.join(BOTDATA, name, '*.aiml')) ):
+        parser = create_parser()
+        try:
+            parser.parse( f )
+        except Exception:
+            continue
+        keys += sorted( parser.getContentHandler().categories )
+    fill = lambda : ' '.join( rnd.choice(FILLER)
+                              for _ in range(rnd.randint(1,4)) )
+    inputs = []
+    for _ in range(num):
+        pattern, that, topic = rnd.choice( keys )
+        words = [ fill() if w in ('*','_') else w for w in pattern.split() ]
+        if rnd.random() < 0.3:
+            words.insert( rnd.randint(0,len(words)), fill() )
+        that = ' '.join( fill() if w in ('*','_') else w for w in that.split() )
+        inputs.append( (' '.join(words), that if rnd.random() < 0.5 else '',
+                        '') )
+    return inputs
+
+
+def timeit( func, *args ):
+    start = time.time()
+    func( *args )
+    return time.time() - start
+
+
+def run_match( bot, inputs ):
+    match = bot._brain.match
+    for args in inputs:
+        match( *args )
+
+
+def run_star( bot, inputs ):
+    brain = bot._brain
+    for args in inputs:
+        if brain.match( *args ) is not None:
+            brain.star( 'star', args[0], args[1], args[2], 1 )
+
+
+def run_respond( bot, rounds ):
+    for _ in range(rounds):
+        for u in UTTERANCES:
+            bot.respond( u )
+
+
+def main():
+    parser = argparse.ArgumentParser( description='Pattern matcher benchmark' )
+    parser.add_argument( '--sets', default='alice,standard' )
+    parser.add_argument( '--num', type=int, default=20000,
+                         help='number of match inputs per set' )
+    parser.add_argument( '--rounds', type=int, default=20,
+                         help='rounds over the respond utterances' )
+    parser.add_argument( '--seed', type=int, default=42 )
+    args = parser.parse_args()
+
+    if not check_star():
+        sys.exit( 1 )
+    print( '{:10} {:10} {:>8} {:>10} {:>10} {:>10}'.format(
+        'set', 'matcher', 'load', 'match', 'star', 'respond') )
+    for name in args.sets.split(','):
+        inputs = make_inputs( name, args.num, random.Random(args.seed) )
+        for matcher in ('pyaiml','compiled'):
+            start = time.time()
+            bot = load_bot( name, matcher )
+            load = time.time() - start
+            random.seed( args.seed )
+            res = ( timeit(run_match, bot, inputs),
+                    timeit(run_star, bot, inputs),
+                    timeit(run_respond, bot, args.rounds) )
+            print( '{:10} {:10} {:8.2f} {:10.3f} {:10.3f} {:10.3f}'.format(
+                name, matcher, load, *res) )
+
+
+if __name__ == '__main__':
+    main()
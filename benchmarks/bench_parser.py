@@ -0,0 +1,94 @@
+"""
+Compare the XML ingestion engines: the pyAIML SAX handler and the
+ElementTree-based engine in aimlbotkernel.aimlparse, over the ALICE and
+standard AIML sets bundled with python-aiml and the AIML files in the
+examples directory.
+
+For each set this reports
+ * parse: the time taken to parse all the files (best of N rounds)
+ * learn: the parsing time as part of a full AimlBot.learn() of the set
+   (where garbage collection also has to deal with the categories already
+   learnt)
+and it checks that both engines produce the same categories for each file.
+
+Usage: python benchmarks/bench_parser.py [--sets alice,standard,examples]
+                                         [--rounds N]
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import sys
+import os
+import os.path
+import glob
+import time
+import argparse
+
+sys.path.insert( 0, os.path.join(os.path.dirname(__file__), '..') )
+
+import aiml
+from aimlbotkernel.aimlbot import AimlBot
+from aimlbotkernel.aimlparse import ENGINES, parse_file
+
+
+BOTDATA = os.path.join( os.path.dirname(aiml.__file__), 'botdata' )
+EXAMPLES = os.path.join( os.path.dirname(__file__), '..', 'examples' )
+
+
+def set_files( name ):
+    """Return the AIML files in a set"""
+    base = EXAMPLES if name == 'examples' else os.path.join( BOTDATA, name )
+    return sorted( glob.glob(os.path.join(base, '*.aiml')) )
+
+
+def parse_all( files, engine ):
+    """Parse a list of files, returning the categories in each one"""
+    out = []
+    for f in files:
+        try:
+            out.append( parse_file(f, 'UTF-8', engine) )
+        except Exception as e:
+            out.append( str(e) )
+    return out
+
+
+def time_learn( files, engine ):
+    """Learn a list of files, returning the time spent on parsing them"""
+    bot = AimlBot( matcher='compiled', parser=engine )
+    bot.verbose( False )
+    for f in files:
+        bot.learn( f )
+    return sum( p for _, _, p, _ in bot.learn_log() )
+
+
+def main():
+    parser = argparse.ArgumentParser( description='AIML parser benchmark' )
+    parser.add_argument( '--sets', default='alice,standard,examples' )
+    parser.add_argument( '--rounds', type=int, default=3,
+                         help='parse rounds per engine (the best is kept)' )
+    args = parser.parse_args()
+
+    # Silence the parse errors in the AIML sets
+    stderr, sys.stderr = sys.stderr, open( os.devnull, 'w' )
+    try:
+        print( '{:10} {:6} {:>6} {:>8} {:>8} {:>10}'.format(
+            'set', 'parser', 'files', 'parse', 'learn', 'identical') )
+        for name in args.sets.split(','):
+            files = set_files( name )
+            ref = parse_all( files, 'sax' )
+            for engine in ENGINES:
+                best = None
+                for _ in range(args.rounds):
+                    start = time.time()
+                    res = parse_all( files, engine )
+                    elapsed = time.time() - start
+                    best = elapsed if best is None else min( best, elapsed )
+                learn = time_learn( files, engine )
+                print( '{:10} {:6} {:6} {:8.3f} {:8.3f} {:>10}'.format(
+                    name, engine, len(files), best, learn, str(res == ref)) )
+    finally:
+        sys.stderr = stderr
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,497 @@
+"""
+A benchmark suite for AimlBot and the Jupyter kernel, runnable offline.
+
+It uses two kinds of datasets:
+ * examples: the AIML files in the examples directory
+ * synthetic brains of a given number of categories (e.g. "syn10000"),
+   generated deterministically: plain patterns, patterns with wildcards,
+   patterns with a <that>, and chains of <srai> redirections
+
+For each dataset and pattern matcher this measures
+ * learn_buffer: AimlBot.learn_buffer() throughput, with the categories
+   in simplified text format and in AIML (in cell-sized buffers)
+ * learn: AimlBot.learn() throughput over the AIML files
+ * respond: AimlBot.respond() latency percentiles, for inputs that match
+   categories without <srai> and for inputs that start a <srai> chain
+ * save/load: AimlBot.save() and AimlBot.load() times, and file size
+ * memory: the peak resident memory of the process
+and then the kernel end to end: execute requests (chat inputs and magics)
+are dispatched to an in-process AimlBotKernel, with the Jupyter message
+serialization but no sockets, and their latency measured.
+
+Each dataset/matcher combination runs in a separate process, so that its
+peak memory is its own. The results are written to a JSON file, and can be
+compared against those of a previous run.
+
+Usage: python benchmarks/bench_suite.py [--sizes 10000,50000,200000]
+                                        [--matchers compiled,pyaiml]
+                                        [--inputs N] [--cache N]
+                                        [--output FILE] [--compare FILE]
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import sys
+import os
+import os.path
+import io
+import glob
+import json
+import time
+import random
+import shutil
+import logging
+import platform
+import tempfile
+import subprocess
+import argparse
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert( 0, os.path.join(os.path.dirname(__file__), '..') )
+
+from aiml.constants import VERSION as pyaiml_version
+from aimlbotkernel import __version__
+from aimlbotkernel.aimlbot import AimlBot
+from aimlbotkernel.aimlparse import parse_file
+from aimlbotkernel.profiler import clock
+
+
+EXAMPLES = os.path.join( os.path.dirname(__file__), '..', 'examples' )
+
+# Synthetic brains: categories per generated AIML file and per
+# learn_buffer() call, and depth of the <srai> chains
+FILE_SIZE = 5000
+CELL_SIZE = 1000
+CHAIN = 4
+
+FILLER = [ 'THE', 'DOG', 'YOU', 'MY', 'FRIEND', 'IS', 'A', 'VERY', 'GOOD',
+           'BIG', 'HOUSE', 'WHAT', 'I', 'LIKE', 'PIZZA', 'TODAY', 'ROBOT' ]
+
+SYLLABLES = [ 'BA', 'KO', 'RI', 'TE', 'MU', 'SA', 'LO', 'NE', 'DI', 'FU',
+              'GA', 'PE', 'ZO', 'VI', 'HU', 'JA' ]
+
+
+# -------------------------------------------------------------------------
+
+def rss_peak():
+    """Return the peak resident memory of the process, in MB"""
+    if resource is None:
+        return None
+    peak = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    return round( peak / (1024*1024 if sys.platform == 'darwin' else 1024), 1 )
+
+
+def percentiles( values ):
+    """Summarize a list of latencies (seconds) in milliseconds"""
+    values = sorted( values )
+    n = len(values)
+    pct = lambda p : 1000*values[ min(n-1, int(p*n)) ]
+    return { 'count' : n, 'mean' : 1000*sum(values)/n, 'p50' : pct(0.5),
+             'p90' : pct(0.9), 'p99' : pct(0.99), 'max' : 1000*values[-1] }
+
+
+def fill( rnd ):
+    """Random words to replace a wildcard"""
+    return ' '.join( rnd.choice(FILLER) for _ in range(rnd.randint(1,3)) )
+
+
+def wildcard_input( pattern, rnd ):
+    """Build an input matching a pattern"""
+    return ' '.join( fill(rnd) if w in ('*','_') else w
+                     for w in pattern.split() )
+
+
+# -------------------------------------------------------------------------
+
+class Dataset( object ):
+    """
+    A set of categories, available as AIML files, AIML buffers and
+    simplified text buffers (both in cell-sized chunks), plus the inputs
+    used to test them
+    """
+
+    def __init__( self, name, tmpdir, num_inputs, seed ):
+        self.name = name
+        rnd = random.Random( seed )
+        if name == 'examples':
+            self._load_examples( rnd, num_inputs )
+        elif name.startswith('syn') and name[3:].isdigit():
+            self._generate( int(name[3:]), rnd, num_inputs )
+        else:
+            raise ValueError( 'unknown dataset: ' + name )
+        # Write the AIML files, unless they are already there
+        if not self.files:
+            for n in range(0, len(self.aiml), FILE_SIZE):
+                fname = os.path.join( tmpdir, '{}-{:03}.aiml'.format(
+                    name, n//FILE_SIZE) )
+                with io.open( fname, 'w', encoding='utf-8' ) as f:
+                    f.write( aiml_document(self.aiml[n:n+FILE_SIZE]) )
+                self.files.append( fname )
+
+
+    def _load_examples( self, rnd, num_inputs ):
+        self.files = sorted( glob.glob(os.path.join(EXAMPLES, '*.aiml')) )
+        self.aiml, self.text = [], []
+        self.buffers = [ io.open(f, encoding='utf-8').read().split('\n')
+                         for f in self.files ]
+        plain, srai = [], []
+        for f in self.files:
+            for (pattern, that, topic), tpl in parse_file( f, 'UTF-8' ).items():
+                if that == '*' and topic == '*':
+                    (srai if 'srai' in repr(tpl) else plain).append( pattern )
+        self.categories = sum( len(parse_file(f,'UTF-8')) for f in self.files )
+        self.plain = [ wildcard_input(rnd.choice(plain), rnd)
+                       for _ in range(num_inputs) ]
+        self.srai = [ wildcard_input(rnd.choice(srai), rnd)
+                      for _ in range(num_inputs) ] if srai else []
+
+
+    def _generate( self, size, rnd, num_inputs ):
+        """
+        Generate a synthetic brain: 60% plain patterns, 20% with a
+        wildcard, 10% with a <that> and 10% in <srai> chains
+        """
+        self.files = []
+        self.aiml, self.text = [], []
+        words = set()
+        while len(words) < 4000:
+            words.add( ''.join(rnd.choice(SYLLABLES)
+                               for _ in range(rnd.randint(2,4))) )
+        words = sorted( words )
+        seen = set()
+        def new_pattern( n ):
+            while True:
+                p = ' '.join( rnd.choice(words) for _ in range(n) )
+                if p not in seen:
+                    seen.add( p )
+                    return p
+
+        plain, heads = [], []
+        num = 0
+        while num < size:
+            kind = rnd.random()
+            if kind < 0.6:
+                p = new_pattern( rnd.randint(2,5) )
+                self._add( p, None, u'Reply number {}.'.format(num) )
+                plain.append( p )
+            elif kind < 0.8:
+                p = new_pattern( rnd.randint(1,3) ) + ' *'
+                self._add( p, None, u'You said <star/>.' )
+                plain.append( p )
+            elif kind < 0.9:
+                p = new_pattern( rnd.randint(1,3) )
+                self._add( p, u'REPLY NUMBER {}'.format(num),
+                           u'Following up on {}.'.format(num) )
+            else:
+                p = new_pattern( 2 )
+                for d in range(CHAIN, 0, -1):
+                    self._add( u'{} {}'.format(p, d), None,
+                               u'<srai>{} {}</srai>'.format(p, d-1) )
+                self._add( u'{} 0'.format(p), None,
+                           u'End of chain <set name="chain">{}</set>.'.format(p) )
+                heads.append( u'{} {}'.format(p, CHAIN) )
+                num += CHAIN
+            num += 1
+        self.categories = len(self.aiml)
+        self.buffers = [ self.aiml[n:n+CELL_SIZE]
+                         for n in range(0, len(self.aiml), CELL_SIZE) ]
+        self.text = [ [ l for rule in self.text[n:n+CELL_SIZE] for l in rule ]
+                      for n in range(0, len(self.text), CELL_SIZE) ]
+        self.plain = [ wildcard_input(rnd.choice(plain), rnd)
+                       for _ in range(num_inputs) ]
+        self.srai = [ rnd.choice(heads) for _ in range(num_inputs) ]
+
+
+    def _add( self, pattern, that, template ):
+        """Add a category in both AIML and simplified text format"""
+        that_aiml = u'' if that is None else u'<that>{}</that>'.format(that)
+        self.aiml.append( u'<category><pattern>{}</pattern>{}'
+                          u'<template>{}</template></category>'.format(
+                              pattern, that_aiml, template) )
+        self.text.append( [ pattern ] + ( [] if that is None else
+                                          [u'<that>{}'.format(that)] ) +
+                          [ template, u'' ] )
+
+
+def aiml_document( categories ):
+    """Wrap a list of categories into an AIML document"""
+    return u'<?xml version="1.0" encoding="UTF-8"?>\n<aiml version="1.0">\n' \
+           + u'\n'.join( categories ) + u'\n</aiml>\n'
+
+
+# -------------------------------------------------------------------------
+
+def timed( func, *args ):
+    """Call a function, returning the elapsed time"""
+    start = clock()
+    func( *args )
+    return clock() - start
+
+
+def new_bot( matcher, cache ):
+    bot = AimlBot( matcher=matcher, cache_size=cache )
+    bot.verbose( False )
+    return bot
+
+
+def throughput( categories, elapsed ):
+    return { 'seconds' : elapsed,
+             'categories_per_s' : categories/elapsed if elapsed else None }
+
+
+def bench_dataset( name, matcher, args ):
+    """
+    Run the benchmarks for a dataset and a matcher
+      @return (dict): the results
+    """
+    tmpdir = tempfile.mkdtemp( prefix='aimlbench-' )
+    try:
+        data = Dataset( name, tmpdir, args.inputs, args.seed )
+        res = { 'dataset' : name, 'matcher' : matcher,
+                'categories' : data.categories }
+
+        # learn_buffer, in simplified text format and in AIML
+        if data.text:
+            bot = new_bot( matcher, args.cache )
+            res['learn_buffer_text'] = throughput( data.categories, timed(
+                lambda : [ bot.learn_buffer(c, 'text') for c in data.text ]) )
+        bot = new_bot( matcher, args.cache )
+        res['learn_buffer_aiml'] = throughput( data.categories, timed(
+            lambda : [ bot.learn_buffer(b) for b in data.buffers ]) )
+        bot = None
+
+        # learn from files; this bot is used for the rest
+        bot = new_bot( matcher, args.cache )
+        res['learn'] = throughput( data.categories, timed(
+            lambda : [ bot.learn(f) for f in data.files ]) )
+        res['rss_after_learn_mb'] = rss_peak()
+
+        # respond latencies
+        for kind in ('plain', 'srai'):
+            inputs = getattr( data, kind )
+            if not inputs:
+                continue
+            random.seed( args.seed )
+            lat = []
+            for n, text in enumerate(inputs):
+                start = clock()
+                bot.respond( text, 'bench{}'.format(n % 10) )
+                lat.append( clock() - start )
+            res['respond_' + kind] = percentiles( lat )
+
+        # save & load
+        base = os.path.join( tmpdir, 'bench' )
+        res['save'] = { 'seconds' : timed( bot.save, base ) }
+        res['save']['bytes'] = os.path.getsize( base + '.bot' )
+        loaded = new_bot( matcher, args.cache )
+        res['load'] = { 'seconds' : timed( loaded.load, base + '.bot' ) }
+        res['load']['identical'] = loaded.numCategories() == bot.numCategories()
+
+        res['peak_rss_mb'] = rss_peak()
+        return res
+    finally:
+        shutil.rmtree( tmpdir, ignore_errors=True )
+
+
+def bench_kernel( args ):
+    """
+    Measure execute requests dispatched to an in-process kernel, with a
+    synthetic brain loaded
+      @return (dict): the results
+    """
+    import asyncio
+    from jupyter_client.session import Session
+    from ipykernel.inprocess.socket import DummySocket
+    from aimlbotkernel.kernel import AimlBotKernel
+
+    tmpdir = tempfile.mkdtemp( prefix='aimlbench-' )
+    # The kernel takes over stdout: keep it for our own output
+    write = sys.stdout.write
+    try:
+        data = Dataset( 'syn{}'.format(args.kernel_size), tmpdir, args.inputs,
+                        args.seed )
+        session = Session()
+        iopub, shell = DummySocket(), DummySocket()
+        kernel = AimlBotKernel( session=session, iopub_socket=iopub,
+                                log=logging.getLogger('bench') )
+        sys.stdout.write = write
+        kernel.bot.verbose( False )
+        for f in data.files:
+            kernel.bot.learn( f )
+
+        def execute( code ):
+            msg = session.msg( 'execute_request',
+                               { 'code' : code, 'silent' : False,
+                                 'store_history' : True,
+                                 'user_expressions' : {},
+                                 'allow_stdin' : False } )
+            start = clock()
+            r = kernel.execute_request( shell, [b'bench'], msg )
+            if asyncio.iscoroutine(r):
+                asyncio.get_event_loop().run_until_complete( r )
+            return clock() - start
+
+        res = { 'dataset' : data.name, 'categories' : data.categories }
+        cells = { 'chat' : data.plain,
+                  'srai' : data.srai,
+                  'magic' : [ '%show size' ] * (len(data.plain)//10 or 1),
+                  'aiml' : [ u'%aiml\n\nBENCH CELL {}\nReply {}\n'.format(n, n)
+                             for n in range(len(data.plain)//10 or 1) ] }
+        for kind, codes in sorted( cells.items() ):
+            res['execute_' + kind] = percentiles( [ execute(c) for c in codes ] )
+        res['iopub_messages'] = iopub.message_sent
+        res['peak_rss_mb'] = rss_peak()
+        return res
+    finally:
+        sys.stdout.write = write
+        shutil.rmtree( tmpdir, ignore_errors=True )
+
+
+# -------------------------------------------------------------------------
+
+def flatten( results ):
+    """
+    Turn a results document into a dict: metric path -> number
+    """
+    out = {}
+    for r in results['runs']:
+        prefix = r['dataset'] + '/' + r.get( 'matcher', 'kernel' )
+        for k, v in r.items():
+            items = v.items() if isinstance(v, dict) else [ (None, v) ]
+            for sub, val in items:
+                if isinstance(val, (int, float)) and not isinstance(val, bool):
+                    out[ '/'.join(p for p in (prefix, k, sub) if p) ] = val
+    return out
+
+
+def compare( base, new ):
+    """
+    Print the metrics of two result documents side by side
+    """
+    b, n = flatten( base ), flatten( new )
+    print( '\n{:60} {:>12} {:>12} {:>7}'.format('metric', 'base', 'new',
+                                                 'ratio') )
+    for k in sorted( set(b) & set(n) ):
+        ratio = '{:7.2f}'.format( n[k]/b[k] ) if b[k] else '      -'
+        print( '{:60} {:12.4g} {:12.4g} {}'.format(k, b[k], n[k], ratio) )
+
+
+def report( run ):
+    """
+    Print a one-line summary of a run
+    """
+    fmt = lambda k, f : ( f.format(run[k[0]][k[1]]) if k[0] in run and
+                          run[k[0]].get(k[1]) is not None else '-' )
+    if 'matcher' in run:
+        print( '{:10} {:9} {:>7} {:>9} {:>9} {:>8} {:>8} {:>7} {:>7} '
+               '{:>8} {:>7}'.format(
+                   run['dataset'], run['matcher'], run['categories'],
+                   fmt(('learn','categories_per_s'), '{:.0f}'),
+                   fmt(('learn_buffer_text','categories_per_s'), '{:.0f}'),
+                   fmt(('respond_plain','p50'), '{:.3f}'),
+                   fmt(('respond_srai','p50'), '{:.3f}'),
+                   fmt(('save','seconds'), '{:.2f}'),
+                   fmt(('load','seconds'), '{:.2f}'),
+                   fmt(('save','bytes'), '{:.0f}'),
+                   run.get('peak_rss_mb') or '-' ) )
+    else:
+        print( '\nkernel ({} categories): execute p50/p99 ms: {}'.format(
+            run['categories'], ', '.join(
+                '{} {:.3f}/{:.3f}'.format(k[8:], v['p50'], v['p99'])
+                for k, v in sorted(run.items()) if k.startswith('execute_') ) ) )
+
+
+def run_worker( spec, args ):
+    """
+    Run one benchmark in a separate process, and return its results
+    """
+    fd, out = tempfile.mkstemp( suffix='.json' )
+    os.close( fd )
+    try:
+        cmd = [ sys.executable, os.path.abspath(__file__), '--worker', spec,
+                '--out', out, '--inputs', str(args.inputs),
+                '--cache', str(args.cache), '--seed', str(args.seed),
+                '--kernel-size', str(args.kernel_size) ]
+        with open( os.devnull, 'w' ) as null:
+            subprocess.check_call( cmd, stdout=null )
+        with io.open( out, encoding='utf-8' ) as f:
+            return json.load( f )
+    finally:
+        os.unlink( out )
+
+
+def main():
+    parser = argparse.ArgumentParser( description='AimlBot benchmark suite' )
+    parser.add_argument( '--sizes', default='10000,50000,200000',
+                         help='sizes of the synthetic brains' )
+    parser.add_argument( '--matchers', default='compiled,pyaiml' )
+    parser.add_argument( '--no-examples', action='store_true',
+                         help='skip the examples dataset' )
+    parser.add_argument( '--no-kernel', action='store_true',
+                         help='skip the kernel round-trip benchmark' )
+    parser.add_argument( '--kernel-size', type=int, default=10000,
+                         help='size of the brain loaded in the kernel' )
+    parser.add_argument( '--inputs', type=int, default=2000,
+                         help='inputs per respond benchmark' )
+    parser.add_argument( '--cache', type=int, default=0,
+                         help='response cache size (0 measures every '
+                         'response being computed)' )
+    parser.add_argument( '--seed', type=int, default=42 )
+    parser.add_argument( '--output', default='bench-results.json' )
+    parser.add_argument( '--compare', metavar='FILE',
+                         help='a previous results file to compare with' )
+    parser.add_argument( '--worker', help=argparse.SUPPRESS )
+    parser.add_argument( '--out', help=argparse.SUPPRESS )
+    args = parser.parse_args()
+
+    # Inside a worker process: run a single benchmark
+    if args.worker:
+        if args.worker == 'kernel':
+            res = bench_kernel( args )
+        else:
+            name, matcher = args.worker.split( ':' )
+            res = bench_dataset( name, matcher, args )
+        with io.open( args.out, 'w', encoding='utf-8' ) as f:
+            f.write( json.dumps(res) )
+        return
+
+    datasets = [] if args.no_examples else [ 'examples' ]
+    datasets += [ 'syn' + s for s in args.sizes.split(',') if s ]
+    specs = [ '{}:{}'.format(d, m) for d in datasets
+              for m in args.matchers.split(',') ]
+    if not args.no_kernel:
+        specs.append( 'kernel' )
+
+    results = { 'meta' : { 'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                           'aimlbotkernel' : __version__,
+                           'python-aiml' : pyaiml_version,
+                           'python' : platform.python_version(),
+                           'platform' : platform.platform(),
+                           'inputs' : args.inputs, 'cache' : args.cache,
+                           'seed' : args.seed },
+                'runs' : [] }
+    print( '{:10} {:9} {:>7} {:>9} {:>9} {:>8} {:>8} {:>7} {:>7} '
+           '{:>8} {:>7}'.format( 'dataset', 'matcher', 'cats', 'learn/s',
+                                 'text/s', 'plain ms', 'srai ms', 'save',
+                                 'load', 'bytes', 'rss MB') )
+    for spec in specs:
+        run = run_worker( spec, args )
+        results['runs'].append( run )
+        report( run )
+
+    with io.open( args.output, 'w', encoding='utf-8' ) as f:
+        f.write( json.dumps(results, indent=1, sort_keys=True) )
+    print( '\nResults written to', args.output )
+
+    if args.compare:
+        with io.open( args.compare, encoding='utf-8' ) as f:
+            compare( json.load(f), results )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Check that a bot survives a save/load round-trip through a .bot file
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os.path
+
+import pytest
+
+from aimlbotkernel.aimlbot import AimlBot, MATCHERS
+from aimlbotkernel.utils import KrnlException
+
+
+RULES = u'''
+HELLO
+hello <get name="name"/>, I am <bot name="name"/>
+
+MY NAME IS *
+<think><set name="name"><star/></set></think>ok
+
+WHAT IS *
+<person><star/></person>
+'''
+
+
+def new_bot( matcher ):
+    bot = AimlBot( matcher=matcher )
+    bot.verbose( False )
+    return bot
+
+
+@pytest.fixture( params=MATCHERS )
+def bot( request ):
+    bot = new_bot( request.param )
+    bot.learn_buffer( RULES.strip().split(u'\n'), 'text' )
+    bot.setBotPredicate( 'name', u'Robbie' )
+    bot.respond( u'my name is Ann' )
+    return bot
+
+
+@pytest.mark.parametrize( 'compression', ['stored', 'deflate', 'lzma'] )
+def test_roundtrip( bot, compression, tmpdir ):
+    name = os.path.join( str(tmpdir), 'test' )
+    bot.save( name, compression=compression )
+    assert os.path.exists( name + '.bot' )
+    other = new_bot( bot._matcher )
+    other.load( name )
+    assert other.numCategories() == bot.numCategories()
+    assert other.getBotPredicate( 'name' ) == u'Robbie'
+    assert other.getPredicate( 'name' ) == u'Ann'
+    for text in (u'hello', u'what is your name', u'my name is Bob'):
+        assert other.respond( text ) == bot.respond( text )
+
+
+def test_skip( bot, tmpdir ):
+    name = os.path.join( str(tmpdir), 'test' )
+    bot.save( name, ['noses', 'nobot'] )
+    other = new_bot( bot._matcher )
+    other.load( name )
+    assert other.numCategories() == bot.numCategories()
+    assert other.getPredicate( 'name' ) == u''
+    assert other.getBotPredicate( 'name' ) != u'Robbie'
+
+
+def test_unknown_compression( bot, tmpdir ):
+    with pytest.raises( KrnlException ):
+        bot.save( os.path.join(str(tmpdir), 'test'), compression='bzip' )
+
+
+@pytest.mark.parametrize( 'compression', ['stored', 'deflate'] )
+def test_allsessions( compression, tmpdir ):
+    bot = AimlBot( max_sessions=2 )
+    bot.verbose( False )
+    bot.learn_buffer( RULES.strip().split(u'\n'), 'text' )
+    names = [ u'user{}'.format(n) for n in range(5) ]
+    for n, name in enumerate( names ):
+        bot.respond( u'my name is ' + name, str(n) )
+    # (plus the global session)
+    assert dict( bot.session_stats() )['spilled'] == 4
+    filename = os.path.join( str(tmpdir), 'test' )
+    bot.save( filename, ['allsessions'], compression=compression )
+
+    other = new_bot( bot._matcher )
+    other.load( filename )
+    assert dict( other.session_stats() )['loaded, not used yet'] == 6
+    for n, name in enumerate( names ):
+        assert other.getPredicate( 'name', str(n) ) == name
+        assert list( other.getPredicate('_inputHistory', str(n)) ) == \
+            [ u'my name is ' + name ]
+        assert other.respond( u'hello', str(n) ) == \
+            bot.respond( u'hello', str(n) )
+    assert dict( other.session_stats() )['loaded, not used yet'] == 1
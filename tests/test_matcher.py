@@ -0,0 +1,78 @@
+"""
+Check the compiled pattern matcher against the pyAIML one
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+from aimlbotkernel.aimlbot import AimlBot
+
+
+RULES = u'''
+MY NAME IS *
+hi <star/>
+
+* LIKES *
+<star index="1"/> likes <star index="2"/>
+
+_ IS GREAT
+great: <star/>
+
+WHAT IS *
+about <star/>
+
+WHO IS *
+<that>* CALLED *</that>
+that star: <thatstar index="2"/>, star: <star/>
+'''
+
+# (punctuation-only words vanish when the input is normalized)
+INPUTS = [ u'my name is Jean-Luc Picard',
+           u'my name is Jean - Paul',
+           u'my name is Jean -',
+           u'Bob likes rock-n-roll and jazz',
+           u'life is great',
+           u"it's ... is great",
+           u'what is a + b',
+           u'what is - a',
+           u'what is the U.S.A.',
+         ]
+
+
+def new_bot( matcher ):
+    bot = AimlBot( matcher=matcher )
+    bot.verbose( False )
+    bot.learn_buffer( RULES.strip().split(u'\n'), 'text' )
+    return bot
+
+
+@pytest.fixture( scope='module' )
+def bots():
+    return new_bot( 'pyaiml' ), new_bot( 'compiled' )
+
+
+@pytest.mark.parametrize( 'text', INPUTS )
+def test_star_spans( bots, text ):
+    """<star/> gives the same input words for both matchers"""
+    ref, bot = bots
+    assert bot.respond( text ) == ref.respond( text )
+
+
+def test_thatstar( bots ):
+    """<thatstar/> spans are taken from the previous bot output"""
+    for bot in bots:
+        bot.learn_buffer( [u'NAME IT', u'it is called big - ben too'], 'text' )
+        bot.respond( u'name it' )
+    ref, bot = bots
+    assert bot.respond( u'who is that' ) == ref.respond( u'who is that' )
+
+
+def test_priority( bots ):
+    """_ matches before words, and words before *"""
+    for bot in bots:
+        bot.learn_buffer( [u'_ LIKES JAZZ', u'underscore', u'',
+                           u'BOB LIKES *', u'word'], 'text' )
+        assert bot.respond( u'bob likes jazz' ) == b'underscore'
+        assert bot.respond( u'bob likes rock' ) == b'word'
+        assert bot.respond( u'ann likes rock' ) == b'ann likes rock'
@@ -0,0 +1,98 @@
+"""
+Check that cached responses are reused only while the session predicates
+read by their templates keep their values
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+from aimlbotkernel.aimlbot import AimlBot
+from aimlbotkernel.respcache import template_deps
+
+
+RULES = u'''
+HELLO
+hello <get name="name"/>
+
+GREET
+<srai>HELLO</srai>
+
+CALL ME *
+<think><set name="name"><star/></set></think>ok
+
+PLAIN
+just text
+
+PICK
+<random><li>a</li><li>b</li></random>
+'''
+
+
+def stat( bot, name ):
+    return dict( bot.cache_stats() )[name]
+
+
+@pytest.fixture
+def bot():
+    bot = AimlBot( matcher='compiled' )
+    bot.verbose( False )
+    bot.learn_buffer( RULES.strip().split(u'\n'), 'text' )
+    return bot
+
+
+def test_template_deps():
+    assert template_deps( ['template', {}, ['text', {}, u'x']] ) == set()
+    assert template_deps( ['template', {},
+                           ['get', {'name': 'name'}]] ) == set(['name'])
+    assert template_deps( ['template', {},
+                           ['set', {'name': 'name'}]] ) is None
+
+
+def test_hit( bot ):
+    # the first response changes <that>, and so the cache key
+    responses = [ bot.respond(u'plain') for _ in range(3) ]
+    assert responses == [ b'just text' ] * 3
+    assert stat( bot, 'hits' ) == 1
+    assert stat( bot, 'misses' ) == 2
+
+
+def test_disabled():
+    bot = AimlBot( cache_size=0 )
+    assert bot.cache_stats() == [ ('status', 'disabled') ]
+
+
+def test_set_predicate( bot ):
+    bot.setPredicate( 'name', u'Ann' )
+    assert bot.respond( u'hello' ) == b'hello Ann'
+    bot.setPredicate( 'name', u'Bob' )
+    assert bot.respond( u'hello' ) == b'hello Bob'
+    bot.setPredicate( 'name', u'Ann' )
+    assert bot.respond( u'hello' ) == b'hello Ann'
+
+
+def test_set_element( bot ):
+    bot.respond( u'call me Ann' )
+    assert bot.respond( u'greet' ) == b'hello Ann'
+    bot.respond( u'call me Bob' )
+    assert bot.respond( u'greet' ) == b'hello Bob'
+    assert bot.respond( u'hello' ) == b'hello Bob'
+
+
+def test_sessions( bot ):
+    bot.setPredicate( 'name', u'Ann', 's1' )
+    bot.setPredicate( 'name', u'Bob', 's2' )
+    assert bot.respond( u'hello', 's1' ) == b'hello Ann'
+    assert bot.respond( u'hello', 's2' ) == b'hello Bob'
+
+
+def test_volatile( bot ):
+    for _ in range(3):
+        bot.respond( u'pick' )
+    assert stat( bot, 'entries' ) == '0/1000'
+
+
+def test_learn( bot ):
+    assert bot.respond( u'plain' ) == b'just text'
+    bot.learn_buffer( [u'PLAIN', u'other text'], 'text' )
+    assert bot.respond( u'plain' ) == b'other text'
@@ -0,0 +1,171 @@
+"""
+Check the bounded session store
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import io
+import os.path
+import time
+
+import pytest
+
+from aimlbotkernel.aimlbot import AimlBot
+from aimlbotkernel.sessions import SessionStore, SessionTable, History
+
+
+def session( n ):
+    return { 'name': u'user{}'.format(n), '_inputHistory': [u'hi'] * n }
+
+
+def stat( store, name ):
+    return dict( store.stats() )[name]
+
+
+@pytest.fixture
+def store():
+    store = SessionStore( max_sessions=2 )
+    yield store
+    store.close()
+
+
+def test_eviction( store ):
+    for n in range(5):
+        store[str(n)] = session( n )
+    assert stat( store, 'resident' ) == 2
+    assert stat( store, 'spilled' ) == 3
+    assert store.evictions == 3
+    assert len(store) == 5
+    assert sorted(store.keys()) == [ '0', '1', '2', '3', '4' ]
+
+
+def test_restore( store ):
+    for n in range(5):
+        store[str(n)] = session( n )
+    for n in range(5):
+        assert store[str(n)] == session( n )
+    assert store.restores == 5
+    assert stat( store, 'resident' ) == 2
+    assert '0' in store and '5' not in store
+    assert store.get( '5' ) is None
+
+
+def test_update( store ):
+    store['a'] = session( 1 )
+    store['a']['name'] = u'changed'
+    store['b'] = session( 2 )
+    store['c'] = session( 3 )
+    assert store['a']['name'] == u'changed'
+
+
+def test_remove( store ):
+    for n in range(4):
+        store[str(n)] = session( n )
+    assert store.pop( '0' ) == session( 0 )
+    del store['3']
+    assert sorted(store.keys()) == [ '1', '2' ]
+    with pytest.raises( KeyError ):
+        del store['0']
+    assert store.pop( '0', None ) is None
+
+
+def test_ttl():
+    store = SessionStore( ttl=0.01 )
+    # (a session is in use until the next one is accessed)
+    store['a'] = session( 1 )
+    store['b'] = session( 2 )
+    time.sleep( 0.05 )
+    store['c'] = session( 3 )
+    assert stat( store, 'spilled' ) == 1
+    assert store['a'] == session( 1 )
+    store.close()
+
+
+def test_spill_file( tmpdir ):
+    name = os.path.join( str(tmpdir), 'sessions.db' )
+    store = SessionStore( max_sessions=1, filename=name )
+    for n in range(3):
+        store[str(n)] = session( n )
+    store.close()
+    assert os.path.exists( name )
+    # spilled sessions are available to a store using the same file
+    store = SessionStore( max_sessions=1, filename=name )
+    assert sorted(store.keys()) == [ '0', '1' ]
+    assert store['1'] == session( 1 )
+    store.close()
+
+
+def test_bot():
+    bot = AimlBot( max_sessions=2 )
+    bot.verbose( False )
+    for n in range(5):
+        bot.setPredicate( 'name', u'user{}'.format(n), str(n) )
+    for n in range(5):
+        assert bot.getPredicate( 'name', str(n) ) == u'user{}'.format(n)
+    assert dict( bot.session_stats() )['resident'] == 2
+
+
+def test_history():
+    h = History( 3 )
+    assert len(h) == 0
+    with pytest.raises( IndexError ):
+        h[-1]
+    for n in range(5):
+        h.append( n )
+    assert len(h) == 3 and h.depth == 3
+    assert list(h) == [ 2, 3, 4 ]
+    assert (h[0], h[-1], h[-3]) == (2, 4, 2)
+    with pytest.raises( IndexError ):
+        h[-4]
+    assert h == [ 2, 3, 4 ]
+    assert History( 2, h ) == [ 3, 4 ]
+
+
+def test_history_spill( store ):
+    h = History( 3, [u'a', u'b'] )
+    store['a'] = { '_outputHistory': h }
+    store['b'] = session( 2 )
+    store['c'] = session( 3 )
+    out = store['a']['_outputHistory']
+    assert isinstance( out, History )
+    assert out == h and out.depth == 3
+
+
+def test_bot_history():
+    bot = AimlBot( history=2 )
+    bot.verbose( False )
+    bot.learn_buffer( [u'SAY *', u'<star/>', u'',
+                       u'PREVIOUS', u'<input index="2"/> / <that/>'], 'text' )
+    for word in (u'one', u'two', u'three'):
+        bot.respond( u'say ' + word )
+    assert bot.respond( u'previous' ) == b'say three / three'
+    assert list( bot.getPredicate('_inputHistory') ) == \
+        [ u'say three', u'previous' ]
+    assert bot.set_history( 5 ) == 2
+    history = bot.getPredicate( '_inputHistory' )
+    assert history.depth == 5 and len(history) == 2
+
+
+def test_table( store ):
+    for n in range(4):
+        store[str(n)] = session( n )
+    out = io.BytesIO()
+    assert store.dump( out ) == 4
+    table = SessionTable( out.getvalue() )
+    assert sorted(table.keys()) == [ '0', '1', '2', '3' ]
+
+    other = SessionStore()
+    other['0'] = session( 9 )
+    other['9'] = session( 9 )
+    assert other.load_table( table ) == 4
+    assert len(other) == 5
+    assert other['0'] == session( 0 )
+    assert dict( other.stats() )['loaded, not used yet'] == 3
+    assert other.pop( '3' ) == session( 3 )
+    assert sorted(other.keys()) == [ '0', '1', '2', '9' ]
+    other.close()
+
+
+def test_bad_table():
+    with pytest.raises( ValueError ):
+        SessionTable( b'not a session table, just some bytes' )
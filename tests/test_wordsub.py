@@ -0,0 +1,71 @@
+"""
+Check that TrieWordSub produces the same output as pyAIML's WordSub
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+from aiml import DefaultSubs
+from aiml.WordSub import WordSub
+
+from aimlbotkernel.wordsub import TrieWordSub
+
+
+SUBS = [ 'defaultGender', 'defaultNormal', 'defaultPerson', 'defaultPerson2' ]
+
+TEXTS = [ u"I can't believe he's not coming, she said.",
+          u"You're telling me that I was wrong? I'm sure he wasn't.",
+          u"What's up with him and her? They're with me.",
+          u"Visit www.example.com or mail me at a.b@c.com :-)",
+          u"HE SAID I AM HERE, and you are there",
+          u"Myself, yourself & himself; it's theirs, not ours.",
+          u"wont dont cant isnt im youre",
+          u"",
+        ]
+
+
+def sentences( subs ):
+    """
+    The test texts, plus a sentence made of every key of a substitution
+    dict, with the keys also appearing inside other words
+    """
+    keys = sorted( k for k in subs if k.strip() )
+    return TEXTS + [ u' '.join(keys), u'x'.join(keys), u'-'.join(keys) ]
+
+
+@pytest.mark.parametrize( 'name', SUBS )
+def test_defaults( name ):
+    subs = getattr( DefaultSubs, name )
+    ref, trie = WordSub( subs ), TrieWordSub( subs )
+    assert dict(ref) == dict(trie)
+    for text in sentences( ref ):
+        assert trie.sub( text ) == ref.sub( text )
+
+
+@pytest.mark.parametrize( 'name', SUBS )
+def test_from_subber( name ):
+    ref = WordSub( getattr(DefaultSubs, name) )
+    trie = TrieWordSub.from_subber( ref )
+    for text in sentences( ref ):
+        assert trie.sub( text ) == ref.sub( text )
+
+
+def test_update():
+    ref, trie = WordSub(), TrieWordSub()
+    for sub in (ref, trie):
+        sub[u'a b'] = u'ab'
+        sub[u'a'] = u'x'
+        sub[u'b c'] = u'bc'
+    text = u'a b c a bc b c'
+    assert trie.sub( text ) == ref.sub( text )
+    # (WordSub does not rebuild its regex after a deletion)
+    del trie[u'a b']
+    ref = WordSub()
+    ref[u'a'] = u'x'
+    ref[u'b c'] = u'bc'
+    assert trie.sub( text ) == ref.sub( text )
+
+
+def test_empty():
+    assert TrieWordSub().sub( u'some text' ) == u'some text'